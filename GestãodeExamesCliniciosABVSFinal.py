@@ -22,75 +22,83 @@ Objetivo:
         
         - Pesquisar
         - Exportar para CSV
+        - Importar listas de exames (CSV ou JSON)
         - Ver estado (Aprovado / Pendente)
+        - Ver estatísticas: tempos de espera, ocupação das vagas e antecedência (com NumPy)
+
+Organização:
+    - nucleo_exames.py: agendamento, armazenamento, pesquisa, exportação e importação (sem interface)
+    - este ficheiro: a interface gráfica (Tkinter), por cima do ServicoExames do núcleo
+    - cli_exames.py: as mesmas operações na linha de comandos
+    - analise_exames.py: as estatísticas (NumPy, opcional)
+    - simulador_exames.py: simulador de capacidade (o que acontece à espera com outras horas/capacidades)
+    - servidor_exames.py: servidor HTTP/JSON para vários postos marcarem na mesma agenda
+      (carga_api.py faz o teste de carga)
+    - gerador_exames.py: gera exames de teste realistas (1 000, 100 000, 1 000 000 ...)
+    - desempenho_exames.py: testes de desempenho com esses exames (resultados comparáveis entre versões)
 
 Tecnologias usadas:
     - Python
     - Tkinter (interface gráfica)
     - JSON (guardar dados)
-    - CSV (exportar dados)
+    - SQLite (guardar dados, em alternativa ao JSON)
+    - CSV (exportar e importar dados)
+    - NumPy (estatísticas, opcional)
 """
 
-import json
-import csv
-import os
-from datetime import datetime, date, timedelta
+import sys
+import threading
+import queue
 
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 
-# =================== CONFIGURAÇÃO ===================
-
-FICHEIRO_EXAMES = "exames.json"
-FORMATO_DATA = "%d-%m-%Y"
-
-# Tipos de exame disponíveis
-TIPOS_EXAME = [
-    "Raio-X", "Análises", "ECG", "Ressonância", "Ecografia", "TAC",
-    "Mamografia", "Endoscopia", "Colonoscopia", "Hemograma", "Urina (EAS)",
-    "PCR/Microbiologia", "Prova de Esforço", "Holter", "MAPA"
-]
-
-# Capacidade diária máxima para cada tipo de exame (usada como referência)
-CAPACIDADE_DIARIA = {
-    "Raio-X": 3,
-    "Análises": 6,
-    "ECG": 2,
-    "Ressonância": 3,
-    "Ecografia": 4,
-    "TAC": 2,
-    "Mamografia": 3,
-    "Endoscopia": 3,
-    "Colonoscopia": 4,
-    "Hemograma": 6,
-    "Urina (EAS)": 5,
-    "PCR/Microbiologia": 5,
-    "Prova de Esforço": 4,
-    "Holter": 2,
-    "MAPA": 2
+from nucleo_exames import (
+    FICHEIRO_EXAMES, FICHEIRO_SQLITE, LIMITES_HISTOGRAMA_MS, TIPOS_EXAME,
+    ErroExames, ErroArmazenamento, ExportacaoCancelada, ServicoExames,
+    data_hoje, valores_linha, migrar_json_para_sqlite, segundos_ate_meia_noite,
+    medir, ativar_medicoes, medicoes_ativas, limpar_medicoes, obter_medicoes, gravar_medicoes,
+    iniciar_perfil, perfil_ativo, parar_perfil,
+)
+from analise_exames import NUMPY_DISPONIVEL, analisar
+
+# =================== CONFIGURAÇÃO DA INTERFACE ===================
+
+# Tabela virtual: acima deste nº de linhas, só as linhas visíveis (mais uma margem) existem na Treeview
+LIMIAR_TABELA_VIRTUAL = 2000
+LINHAS_MARGEM_VIRTUAL = 10
+ALTURA_LINHA = 22
+
+# Pesquisa em direto: espera (ms) depois da última tecla antes de pesquisar, e de quanto em quanto
+# tempo (ms) a interface vai ver se a pesquisa (feita noutra thread) já terminou
+ESPERA_PESQUISA_MS = 250
+INTERVALO_RESPOSTA_PESQUISA_MS = 30
+
+# Gravação: "imediata", "agrupada" ou "intervalo" (ver MODO_GRAVACAO no núcleo). Com "agrupada", as
+# edições seguidas são gravadas de uma só vez numa thread, sem a janela ficar à espera; ao sair e no
+# botão Guardar ficheiro grava-se logo. De quanto em quanto tempo (ms) se atualiza o estado no rodapé:
+MODO_GRAVACAO_INTERFACE = "agrupada"
+INTERVALO_ESTADO_GRAVACAO_MS = 250
+
+# Janela de diagnóstico: de quanto em quanto tempo (ms) as medições são atualizadas enquanto está aberta
+INTERVALO_DIAGNOSTICO_MS = 1000
+
+# Títulos das colunas da tabela
+TITULOS_COLUNAS = {
+    "num": "Nº",
+    "paciente": "Paciente",
+    "utente": "Utente",
+    "nascimento": "Nascimento",
+    "tipo": "Tipo de Exame",
+    "data_registo": "Registo",
+    "data_marcada": "Data",
+    "hora_marcada": "Hora",
+    "dias_espera": "Espera (dias)",
+    "resultado": "Estado",
 }
 
-# Horas fixas por tipo de exame (1 "vaga" = 1 hora)
-HORAS_POR_TIPO = {
-    "Raio-X": ["09:00", "11:00", "15:00"],
-    "Análises": ["08:00", "08:30", "09:00", "09:30", "10:00", "10:30"],
-    "ECG": ["10:00", "14:00"],
-    "Ressonância": ["09:00", "13:00", "16:00"],
-    "Ecografia": ["09:00", "10:30", "14:00", "15:30"],
-    "TAC": ["09:00", "15:00"],
-    "Mamografia": ["10:00", "11:30", "15:00"],
-    "Endoscopia": ["09:00", "11:00", "14:00"],
-    "Colonoscopia": ["08:30", "10:30", "14:00", "16:00"],
-    "Hemograma": ["08:00", "08:15", "08:30", "08:45", "09:00", "09:15"],
-    "Urina (EAS)": ["09:00", "09:20", "09:40", "10:00", "10:20"],
-    "PCR/Microbiologia": ["10:00", "10:30", "11:00", "11:30", "12:00"],
-    "Prova de Esforço": ["09:00", "11:00", "15:00", "16:30"],
-    "Holter": ["09:00", "15:00"],
-    "MAPA": ["08:30", "14:30"]
-}
-
-# Dias de antecedência mínima para marcação (ex.: 2 dias)
-dias_antecedencia = 2
+# Janela de análise: grupos de dias de antecedência (registo -> marcação) mostrados na tabela
+GRUPOS_ANTECEDENCIA = [("0-2", 0, 3), ("3-7", 3, 8), ("8-14", 8, 15), ("15-30", 15, 31), ("31-59", 31, 60), ("60+", 60, None)]
 
 # Paleta de cores
 BG = "#f5fbf8"        # fundo geral
@@ -98,225 +106,6 @@ TOP = "#2f6f5e"       # barra topo
 ACCENT = "#9bd1b7"    # destaques
 TEXT_DARK = "#154138" # texto principal
 
-# =================== FUNÇÕES AUXILIARES ===================
-
-def data_hoje():
-    """Devolve a data de hoje em string com a formatação desejada (dd-mm-yyyy)."""
-    hoje = date.today()
-    texto = hoje.strftime(FORMATO_DATA)
-    return texto
-
-
-def dia_inicial_marcacao():
-    """Primeiro dia possível para marcar exames (hoje + dias_antecedencia)."""
-    return date.today() + timedelta(days=dias_antecedencia) #como estamos a ir buscar as datas à biblioteca e elas seguem já um formato definido
-                                                            #time delta é para conseguirmos fazer a soma das datas 
-
-def ler_dados():
-    """
-    Lê os exames do ficheiro JSON.
-    Se não existir ou der erro, devolve lista vazia
-    """
-    if not os.path.exists(FICHEIRO_EXAMES): #vai ler o caminho, o "path" e verifica se é existente se há path que ligue o programa ao .json
-        return [] #se não, abre uma lista vazia
-
-    try:
-        with open(FICHEIRO_EXAMES, "r", encoding="utf-8") as f: #se existir, tenta ler o ficheiro e ver se não está corrompido
-            exames = json.load(f)
-            return exames
-    except (json.JSONDecodeError, OSError):
-        messagebox.showwarning(
-            "Aviso",
-            "Não foi possível ler o ficheiro de exames. Vai ser iniciada uma lista vazia."
-        )
-        return []
-
-
-def gravar_dados(exames):
-    """Guarda a lista de exames no ficheiro JSON."""
-    try:
-        with open(FICHEIRO_EXAMES, "w", encoding="utf-8") as f:
-            json.dump(exames, f, ensure_ascii=False, indent=2) #Permite que seja escrito com caracteres especiais e uma indentenção especial
-        return True
-    except OSError as e:
-        messagebox.showerror("Erro", f"Erro ao gravar os dados: {e}")
-        return False
-
-
-def proximo_numero(exames):
-    """
-    Devolve o próximo número de exame disponível.
-    Percorre a lista de exames um a um 
-    Procura o maior número existente e soma 1.
-    Se não houver exames, começa em 1.
-    """
-    max_num = 0
-
-    for exame in exames:
-        num_str = exame.get("num", 0)
-        try:
-            num = int(num_str)
-        except (TypeError, ValueError):
-            num = 0
-        if num > max_num:
-            max_num = num
-
-    proximo = max_num + 1
-    return proximo
-
-
-def validar_data(texto_data):
-    """Verifica se uma data está no formato dd-mm-yyyy e é válida."""
-    try:
-        datetime.strptime(texto_data, FORMATO_DATA)
-        return True
-    except ValueError:
-        return False
-
-
-def validar_utente(numero_utente):
-    """Verifica se o nº de utente tem só dígitos e entre 9 e 11 caracteres."""
-    if not numero_utente.isdigit():
-        return False
-
-    tamanho = len(numero_utente)
-    if tamanho < 9 or tamanho > 11:
-        return False
-
-    return True
-
-
-def contar_marcados(exames, tipo_exame, data_marcada_str, ignorar_num=None):
-    """
-    Funciona como uma dupla verificação: conta quantos exames existem de um certo tipo numa certa data.
-    Pode ignorar o número de exame se estivermos a editar um exame (para não contar como se fosse um novo). (com o ignorar_num)
-    O resultado da função é informar se ainda há capacidade de realização nesse dia. 
-    (Garantimos que não ultrapassamos o limite diário.)
-    """
-    contador = 0
-
-    for exame in exames:
-        tipo = exame.get("tipo", "")
-        data_marcada = exame.get("data_marcada", "")
-        num = exame.get("num", None)
-
-        if tipo == tipo_exame and data_marcada == data_marcada_str:
-            if ignorar_num is not None:
-                try:
-                    if int(num) != int(ignorar_num):
-                        contador = contador + 1
-                except (TypeError, ValueError):
-                    contador = contador + 1
-            else:
-                contador = contador + 1
-
-    return contador
-
-def primeira_marcacao_livre(exames, tipo_exame: str, inicio: date, ignorar_num=None):
-    """
-    Motor de agendamento: percorre a funcão e procura o primeiro dia e hora disponível para o 'tipo_exame',
-    usando as HORAS_POR_TIPO como slots fixos.
-    Se todas as horas desse tipo estiverem cheias NAQUELE dia, avança para o dia seguinte.
-    Também respeita o limite diário de CAPACIDADE_DIARIA, se estiver definido.
-    """
-    limite_diario = int(CAPACIDADE_DIARIA.get(tipo_exame, len(horas_para_tipo(tipo_exame))))
-    horas = horas_para_tipo(tipo_exame)
-
-    dia = inicio
-    while True:
-        data_str = dia.strftime(FORMATO_DATA)
-
-        ocupados_dia = contar_marcados(exames, tipo_exame, data_str, ignorar_num)
-        if ocupados_dia < limite_diario:
-            for h in horas:
-                if not slot_ocupado(exames, tipo_exame, data_str, h, ignorar_num):
-                    return dia, h
-
-        dia = dia + timedelta(days=1)
-
-def horas_para_tipo(tipo_exame: str):
-    """Devolve a lista de horas fixas para um tipo"""
-    if tipo_exame in HORAS_POR_TIPO:
-        return HORAS_POR_TIPO[tipo_exame]
-    
-    
-def calcular_estado_exame(data_marcada_date):
-    """
-    Recebe a data marcada (tipo date) e devolve:
-    - "Aprovado" e 0 dias se a data é hoje ou anterior.
-    - "Pendente" e nº de dias em espera se é futura.
-    """
-    hoje_date = date.today()
-
-    if data_marcada_date <= hoje_date:
-        return "Aprovado", 0
-    else:
-        diferenca = data_marcada_date - hoje_date
-        dias = diferenca.days #Quando subtraímos duas datas, o Python dá-nos um timedelta (usado tbm em cima) que é um intervalo de tempo. Usamos .days para ficar só com o número de dias,
-        return "Pendente", dias
-
-
-def replanear_pendentes_por_tipo(exames, tipo_exame):
-    """
-    Reorganiza exames FUTUROS de um determinado tipo, a partir do dia_inicial_marcacao(),
-    para que ocupem (data, hora) o mais cedo possível, respeitando:
-    - horas fixas por tipo (HORAS_POR_TIPO)
-    - limite diário de CAPACIDADE_DIARIA
-    Não mexe em exames de datas anteriores ao dia inicial.
-    """
-    base_date = dia_inicial_marcacao()
-
-    # 1. Selecionar exames deste tipo com data >= base_date
-    exames_tipo = []  #criar lista vazia e percorre todos os exames
-    for exame in exames: 
-        tipo = exame.get("tipo", "")
-        if tipo == tipo_exame:
-            data_str = exame.get("data_marcada", data_hoje())
-            try:
-                data = datetime.strptime(data_str, FORMATO_DATA).date()
-            except ValueError:
-                data = base_date
-
-            if data >= base_date:
-                exames_tipo.append(exame) #adicionamos o exame à lista
-
-    # 2. Ordenar por número (ordem previsível) 
-    n = len(exames_tipo)   
-    for i in range(n - 1):  #numa lista vamos percorrer os exames e verificar o número do exame em questão (i)
-        for j in range(i + 1, n):  #de seguida vamos percorrer os exames e ver qual é o número do exame a seguir ao i (j)
-            num_i = int(exames_tipo[i].get("num", 0))
-            num_j = int(exames_tipo[j].get("num", 0))
-            if num_j < num_i:   #se j for menor que i (tipo j= 2 e i= 3), então trocamos a ordem 
-                temp = exames_tipo[i]
-                exames_tipo[i] = exames_tipo[j]
-                exames_tipo[j] = temp
-
-    # 3. Para cada exame, voltar a marcar dia+hora com base nas vagas disponíveis
-    for exame in exames_tipo: #vagas libertas, reorganizar
-        num = exame.get("num")
-        dia, hora = primeira_marcacao_livre(exames, tipo_exame, base_date, ignorar_num=num)
-        estado, dias_espera = calcular_estado_exame(dia)
-
-        exame["data_marcada"] = dia.strftime(FORMATO_DATA)
-        exame["hora_marcada"] = hora
-        exame["resultado"] = estado
-        exame["dias_espera"] = dias_espera
-
-def slot_ocupado(exames, tipo_exame: str, data_str: str, hora_str: str, ignorar_num=None) -> bool:
-    """
-    Retorna True se já há um exame do mesmo tipo no mesmo slot (data+hora).
-    """
-    for e in exames: #vai percorrer a lista de exames que temos e com o e.get (semelhante ao exame[0], por exemplo) vamos buscar o tipo
-        if e.get("tipo") == tipo_exame and e.get("data_marcada") == data_str and e.get("hora_marcada") == hora_str: #a data e a hora disponivel
-            if ignorar_num is not None:
-                try:
-                    if int(e.get("num", -1)) == int(ignorar_num):
-                        continue   #o ignorar_num começa com none (não existente) 
-                except (TypeError, ValueError): #e quando abrimos um exame para editar este parâmetro assume esse número, ignorando-o 
-                    pass  #porque estamos apenas a editar algum parâmetro do exame, não a mudar o número dele
-            return True
-    return False
-
 # =================== CLASSE PRINCIPAL ===================
 
 class GestorExames(tk.Tk): 
@@ -329,7 +118,8 @@ class GestorExames(tk.Tk):
 
         self.configurar_estilos()
 
-        self.exames = ler_dados()
+        self.servico = ServicoExames(carregar=False, modo_gravacao=MODO_GRAVACAO_INTERFACE)
+        self._ler_exames()
 
         self.var_num = tk.StringVar()
         self.var_paciente = tk.StringVar()
@@ -342,8 +132,37 @@ class GestorExames(tk.Tk):
         # entrada de pesquisa vai ser guardada aqui depois
         self.entrada_pesquisa = None
 
+        # o que está neste momento na tabela (para só mexer nas linhas que mudam)
+        self._ordem_tabela = []
+        self._linhas_tabela = {}
+
+        # ordenação escolhida no cabeçalho (None = por data e hora)
+        self._coluna_ordem = None
+        self._ordem_decrescente = False
+
+        # tabela virtual: resultado completo (já ordenado) e 1ª linha visível
+        self._resultado_tabela = []
+        self._modo_virtual = False
+        self._inicio_virtual = 0
+
+        # pesquisa em direto: cada pesquisa tem um nº (geração); só se mostra o resultado da mais recente
+        self._pesquisa_agendada = None
+        self._geracao_pesquisa = 0
+        self._geracao_mostrada = 0
+        self._pedidos_pesquisa = queue.Queue()
+        self._respostas_pesquisa = queue.Queue()
+        self._trabalhador_pesquisa = None
+        self._a_receber_pesquisa = False
+
+        # rodapé: contagens (atualizar_tabela) e estado da gravação (_acompanhar_gravacao)
+        self._texto_contagens = ""
+        self._texto_gravacao = ""
+
         self.criar_interface()
         self.atualizar_tabela()
+        self._agendar_mudanca_dia()
+        self._acompanhar_gravacao()
+        self.protocol("WM_DELETE_WINDOW", self.sair)
 
     def configurar_estilos(self):
         style = ttk.Style(self)
@@ -379,7 +198,7 @@ class GestorExames(tk.Tk):
             background="white",
             fieldbackground="white",
             foreground=TEXT_DARK,
-            rowheight=22,
+            rowheight=ALTURA_LINHA,
             borderwidth=0
         )
         style.configure(
@@ -417,6 +236,18 @@ class GestorExames(tk.Tk):
             command=self.recarregar
         ).pack(side=tk.RIGHT, padx=5, pady=8)
 
+        ttk.Button(
+            topo,
+            text="📊 Análise",
+            command=self.abrir_analise
+        ).pack(side=tk.RIGHT, padx=5, pady=8)
+
+        ttk.Button(
+            topo,
+            text="⏱ Diagnóstico",
+            command=self.abrir_diagnostico
+        ).pack(side=tk.RIGHT, padx=5, pady=8)
+
         form = ttk.LabelFrame(self, text="Novo / Editar Exame", padding=10)
         form.pack(fill=tk.X, padx=10, pady=(8, 8))
 
@@ -465,10 +296,12 @@ class GestorExames(tk.Tk):
         self.entrada_pesquisa = ttk.Entry(frame_pesquisa, textvariable=self.var_busca, width=40)
         self.entrada_pesquisa.pack(side=tk.LEFT, padx=5)
         self.entrada_pesquisa.bind("<Return>", self._enter_pesquisa)
+        self.var_busca.trace_add("write", self._ao_escrever_pesquisa)
 
         ttk.Button(frame_pesquisa, text="🔍 Procurar", command=self.atualizar_tabela).pack(side=tk.LEFT, padx=3)
         ttk.Button(frame_pesquisa, text="Limpar filtro", command=self.limpar_filtro).pack(side=tk.LEFT, padx=3)
         ttk.Button(frame_pesquisa, text="Exportar CSV", command=self.exportar_csv).pack(side=tk.RIGHT)
+        ttk.Button(frame_pesquisa, text="Importar", command=self.importar_ficheiro).pack(side=tk.RIGHT, padx=3)
 
         frame_tabela = ttk.Frame(self)
         frame_tabela.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
@@ -487,16 +320,9 @@ class GestorExames(tk.Tk):
             selectmode="extended"
         )
 
-        self.tabela.heading("num", text="Nº")
-        self.tabela.heading("paciente", text="Paciente")
-        self.tabela.heading("utente", text="Utente")
-        self.tabela.heading("nascimento", text="Nascimento")
-        self.tabela.heading("tipo", text="Tipo de Exame")
-        self.tabela.heading("data_registo", text="Registo")
-        self.tabela.heading("data_marcada", text="Data")
-        self.tabela.heading("hora_marcada", text="Hora")
-        self.tabela.heading("dias_espera", text="Espera (dias)")
-        self.tabela.heading("resultado", text="Estado")
+        # clicar num cabeçalho ordena por essa coluna (outra vez: ao contrário)
+        for coluna, titulo in TITULOS_COLUNAS.items():
+            self.tabela.heading(coluna, text=titulo, command=lambda c=coluna: self.ordenar_por_coluna(c))
 
         self.tabela.column("num", width=60, anchor="center")
         self.tabela.column("paciente", width=220, anchor="w")
@@ -509,12 +335,19 @@ class GestorExames(tk.Tk):
         self.tabela.column("dias_espera", width=90, anchor="center")
         self.tabela.column("resultado", width=100, anchor="center")
 
-        scrollbar = ttk.Scrollbar(frame_tabela, orient="vertical", command=self.tabela.yview)
-        self.tabela.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(frame_tabela, orient="vertical", command=self._rolar_tabela)
+        self.tabela.configure(yscrollcommand=self._ao_rolar_treeview)
+        self.scrollbar = scrollbar
 
         self.tabela.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
+        # No modo virtual a roda do rato e o redimensionamento mudam as linhas que estão na tabela
+        self.tabela.bind("<MouseWheel>", self._roda_tabela)
+        self.tabela.bind("<Button-4>", self._roda_tabela)
+        self.tabela.bind("<Button-5>", self._roda_tabela)
+        self.tabela.bind("<Configure>", self._ao_redimensionar_tabela)
+
         self.tabela.bind("<<TreeviewSelect>>", self.carregar_selecao)
         # Duplo clique abre janela de detalhes
         self.tabela.bind("<Double-1>", self.abrir_detalhes_exame)
@@ -573,85 +406,298 @@ class GestorExames(tk.Tk):
 
     # ---------- LÓGICA PRINCIPAL ----------
 
+    @medir("atualizar_tabela", registos=lambda _, janela: len(janela._resultado_tabela))
     def atualizar_tabela(self):
-    # 1) Atualizar estado e dias_espera de todos os exames em função da data marcada
-       for exame in self.exames: #vamos buscar o ficheiro onde temos os exames e percorremos o dicionario, a lista
-        data_str = exame.get("data_marcada", "") #e vamos buscar a data em formato string
-        if not data_str:
-            continue
+        """
+        Atualiza a tabela em três passos:
+        1) estados em dia (o núcleo só tem trabalho se o dia mudou)
+        2) filtro da pesquisa
+        3) uma única ordenação e um único acerto da Treeview (só mexe nas linhas que mudaram)
+        Uma pesquisa em direto que ainda esteja a decorrer deixa de contar.
+        """
+        self._cancelar_pesquisa_agendada()
+        self._geracao_pesquisa = self._geracao_pesquisa + 1
+        self._geracao_mostrada = self._geracao_pesquisa
+
+        termo = self.var_busca.get()   #lemos o que esta escrito na caixa de pesquisa
+        exames_a_mostrar = self.servico.pesquisar(termo, self._coluna_ordem, self._ordem_decrescente) #já vem ordenado
+        self._mostrar_resultado(exames_a_mostrar)
+
+        total, aprovados, pendentes = self.servico.contagens()   #resumidamente atualizamos o rodapé e a aplicação 
+        self._texto_contagens = f"Total de exames: {total} | Aprovados: {aprovados} | Pendentes: {pendentes}"
+        self._mostrar_rodape()
+
+    def _mostrar_rodape(self):
+        texto = self._texto_contagens
+        if self._texto_gravacao:
+            texto = texto + " | " + self._texto_gravacao
+        self.label_status.config(text=texto)
+
+    def _mostrar_resultado(self, exames_a_mostrar):
+        """Põe na tabela um resultado já filtrado e ordenado (em modo virtual se for grande)."""
+        self._resultado_tabela = exames_a_mostrar
+        self._modo_virtual = len(exames_a_mostrar) > LIMIAR_TABELA_VIRTUAL
+        if self._modo_virtual:
+            self._desenhar_janela_virtual()
+        else:
+            self._sincronizar_tabela(exames_a_mostrar)
+
+    def ordenar_por_coluna(self, coluna):
+        """
+        Clique no cabeçalho: ordena o que está na tabela por essa coluna (um 2º clique inverte a ordem).
+        Não volta a pesquisar: reordena o resultado atual com as chaves que o núcleo já tem guardadas.
+        """
+        if self._coluna_ordem == coluna:
+            self._ordem_decrescente = not self._ordem_decrescente
+        else:
+            self._coluna_ordem = coluna
+            self._ordem_decrescente = False
+
+        for nome, titulo in TITULOS_COLUNAS.items():
+            if nome == self._coluna_ordem:
+                titulo = titulo + (" ▼" if self._ordem_decrescente else " ▲")
+            self.tabela.heading(nome, text=titulo)
 
+        self._inicio_virtual = 0
+        self._mostrar_resultado(
+            self.servico.ordenar(self._resultado_tabela, self._coluna_ordem, self._ordem_decrescente)
+        )
+        if self._geracao_mostrada != self._geracao_pesquisa:
+            self._lancar_pesquisa()   # a pesquisa em direto que ainda vem a caminho tinha a ordem antiga
+
+    # ---------- GRAVAÇÃO ----------
+
+    def _acompanhar_gravacao(self):
+        """
+        De INTERVALO_ESTADO_GRAVACAO_MS em INTERVALO_ESTADO_GRAVACAO_MS: mostra no rodapé o estado da gravação
+        (que corre noutra thread) e, se outra instância gravou entretanto, junta as versões.
+        """
+        erro = None
+        try:
+            self.servico.verificar_gravacao()
+        except ErroExames as e:
+            erro = str(e)
+        texto = self._descrever_gravacao(erro)
+        if texto != self._texto_gravacao:
+            self._texto_gravacao = texto
+            self._mostrar_rodape()
+        self.after(INTERVALO_ESTADO_GRAVACAO_MS, self._acompanhar_gravacao)
+
+    def _descrever_gravacao(self, erro=None):
+        por_gravar, a_gravar, gravado_em, erro_gravacao = self.servico.estado_gravacao()
+        erro = erro or erro_gravacao
+        if erro:
+            return f"⚠ Erro ao gravar ({por_gravar} por gravar): {erro}"
+        if a_gravar:
+            return "A gravar..."
+        if por_gravar:
+            return f"Por gravar: {por_gravar}"
+        if gravado_em is not None:
+            return f"Gravado às {gravado_em:%H:%M:%S}"
+        return ""
+
+    def sair(self):
+        """Fechar a janela: grava primeiro o que estiver por gravar; se falhar, pergunta se sai na mesma."""
         try:
-            data_marcada_date = datetime.strptime(data_str, FORMATO_DATA).date()
-        except ValueError:
-            # Se a data estiver mal formatada ou não estiver marcada, ignoramos este exame
-            continue
-
-        estado, dias_espera = calcular_estado_exame(data_marcada_date) #vamos chamar a função auxiliar que
-        exame["resultado"] = estado                                   # decide se o estado é aprovado ou pendente
-        exame["dias_espera"] = dias_espera
-
-        termo = self.var_busca.get().strip().lower()   #lemos o que esta escrito na caixa de pesquisa
-                                                       #configuramos e tiramos o espaço e pomos tudo em miniscula para facilitar comparação
-        if termo == "":           #se tiver vazio, não ha filtro, mostramos todos os exames
-            exames_a_mostrar = self.exames
+            self.servico.fechar()
+        except ErroExames as e:
+            sair = messagebox.askyesno(
+                "Erro ao gravar",
+                f"{e}\n\nAs últimas alterações não foram gravadas. Sair mesmo assim?"
+            )
+            if not sair:
+                return
+        self.destroy()
+
+    # ---------- MUDANÇA DE DIA ----------
+
+    def _agendar_mudanca_dia(self):
+        # um segundo depois da meia-noite, para o relógio já estar no dia novo
+        self.after(int(segundos_ate_meia_noite() * 1000) + 1000, self._mudar_dia)
+
+    def _mudar_dia(self):
+        """Meia-noite: os exames de hoje passam a Aprovado e os dias de espera descem um (só muda a tabela)."""
+        self.servico.virar_dia()
+        self.atualizar_tabela()
+        self._agendar_mudanca_dia()
+
+    # ---------- PESQUISA EM DIRETO ----------
+
+    def _ao_escrever_pesquisa(self, *args):
+        """Cada alteração na caixa de pesquisa volta a contar o tempo; só se pesquisa quando se pára de escrever."""
+        self._cancelar_pesquisa_agendada()
+        self._pesquisa_agendada = self.after(ESPERA_PESQUISA_MS, self._lancar_pesquisa)
+
+    def _cancelar_pesquisa_agendada(self):
+        if self._pesquisa_agendada is not None:
+            self.after_cancel(self._pesquisa_agendada)
+            self._pesquisa_agendada = None
+
+    def _lancar_pesquisa(self):
+        """Manda a pesquisa para a thread de pesquisa e começa a esperar pela resposta."""
+        self._pesquisa_agendada = None
+        termo = self.var_busca.get().strip().lower()
+
+        self._geracao_pesquisa = self._geracao_pesquisa + 1
+        self._pedidos_pesquisa.put((self._geracao_pesquisa, termo, self._coluna_ordem, self._ordem_decrescente))
+
+        if self._trabalhador_pesquisa is None:
+            self._trabalhador_pesquisa = threading.Thread(target=self._trabalhar_pesquisa, daemon=True)
+            self._trabalhador_pesquisa.start()
+
+        if not self._a_receber_pesquisa:
+            self._a_receber_pesquisa = True
+            self.after(INTERVALO_RESPOSTA_PESQUISA_MS, self._receber_pesquisa)
+
+    def _trabalhar_pesquisa(self):
+        """
+        Thread de pesquisa (não mexe no Tk): faz a pesquisa e a ordenação e deixa o resultado
+        na fila de respostas. Pedidos ultrapassados por outros mais recentes são descartados.
+        """
+        while True:
+            geracao, termo, coluna, decrescente = self._pedidos_pesquisa.get()
+            while not self._pedidos_pesquisa.empty():
+                geracao, termo, coluna, decrescente = self._pedidos_pesquisa.get()   # só interessa o último pedido
+
+            if geracao != self._geracao_pesquisa:
+                continue
+            resultado = self.servico.filtrar(termo, coluna, decrescente)
+
+            if geracao != self._geracao_pesquisa:
+                continue   # entretanto o utilizador continuou a escrever
+            self._respostas_pesquisa.put((geracao, resultado))
+
+    def _receber_pesquisa(self):
+        """Corre no Tk (via after): mostra a resposta da pesquisa mais recente, se já tiver chegado."""
+        while not self._respostas_pesquisa.empty():
+            geracao, resultado = self._respostas_pesquisa.get()
+            if geracao == self._geracao_pesquisa:
+                self._geracao_mostrada = geracao
+                self._mostrar_resultado(resultado)
+
+        if self._geracao_mostrada != self._geracao_pesquisa:
+            self.after(INTERVALO_RESPOSTA_PESQUISA_MS, self._receber_pesquisa)
+        else:
+            self._a_receber_pesquisa = False
+
+    # ---------- TABELA VIRTUAL ----------
+
+    def _linhas_visiveis(self):
+        """Quantas linhas cabem na parte visível da tabela."""
+        altura = self.tabela.winfo_height() - ALTURA_LINHA  # tirar o cabeçalho
+        return max(int(self.tabela.cget("height")), altura // ALTURA_LINHA)
+
+    def _desenhar_janela_virtual(self):
+        """
+        Modo virtual: só põe na Treeview as linhas visíveis e uma pequena margem antes e depois,
+        tiradas do resultado já ordenado. A scrollbar representa o resultado inteiro.
+        """
+        total = len(self._resultado_tabela)
+        visiveis = self._linhas_visiveis()
+
+        self._inicio_virtual = max(0, min(self._inicio_virtual, total - visiveis))
+        inicio = max(0, self._inicio_virtual - LINHAS_MARGEM_VIRTUAL)
+        fim = min(total, self._inicio_virtual + visiveis + LINHAS_MARGEM_VIRTUAL)
+
+        janela = self._resultado_tabela[inicio:fim]
+        self._sincronizar_tabela(janela)
+        if janela:
+            # a 1ª linha visível fica no topo; a margem de cima fica escondida
+            self.tabela.yview_moveto((self._inicio_virtual - inicio) / len(janela))
+        self._atualizar_scrollbar_virtual()
+
+    def _atualizar_scrollbar_virtual(self):
+        total = len(self._resultado_tabela)
+        if total == 0:
+            self.scrollbar.set(0, 1)
+            return
+        visiveis = self._linhas_visiveis()
+        self.scrollbar.set(self._inicio_virtual / total, min(1, (self._inicio_virtual + visiveis) / total))
+
+    def _deslocar_virtual(self, novo_inicio):
+        """Muda a 1ª linha visível do modo virtual e redesenha a janela."""
+        self._inicio_virtual = int(novo_inicio)
+        self._desenhar_janela_virtual()
+
+    def _rolar_tabela(self, *args):
+        """Comando da scrollbar: no modo normal passa à Treeview, no virtual muda a janela de linhas."""
+        if not self._modo_virtual:
+            self.tabela.yview(*args)
+            return
+
+        total = len(self._resultado_tabela)
+        if args[0] == "moveto":
+            self._deslocar_virtual(float(args[1]) * total)
+        elif args[0] == "scroll":
+            passos = int(args[1])
+            if args[2] == "pages":
+                passos = passos * self._linhas_visiveis()
+            self._deslocar_virtual(self._inicio_virtual + passos)
+
+    def _ao_rolar_treeview(self, primeiro, ultimo):
+        """yscrollcommand da Treeview: no modo virtual a scrollbar mostra a posição no resultado inteiro."""
+        if self._modo_virtual:
+            self._atualizar_scrollbar_virtual()
+        else:
+            self.scrollbar.set(primeiro, ultimo)
+
+    def _roda_tabela(self, event):
+        if not self._modo_virtual:
+            return None  # a Treeview trata da roda do rato sozinha
+
+        if event.num == 4 or event.delta > 0:
+            passos = -3
         else:
-            exames_a_mostrar = []                         #se houver, criamos uma lista vazia
-            for exame in self.exames:                      # e para cada exame vamos buscar este parametros
-                nome = exame.get("paciente", "").lower()
-                tipo = exame.get("tipo", "").lower()
-                utente = exame.get("utente", "").lower()
-                estado = exame.get("resultado", "").lower()
-
-                if (termo in nome
-                        or termo in tipo
-                        or termo in utente
-                        or termo in estado):
-                    exames_a_mostrar.append(exame) #se o termo estiver presente, adicionamos à lista, se não, não filtra
-
-        def chave_ordem(exame):
-            data_marcada = exame.get("data_marcada", data_hoje())
-            hora_marcada = exame.get("hora_marcada", "00:00")
-            return (data_marcada, hora_marcada) #esta função devolve um par (data e hora)
-
-        tamanho = len(exames_a_mostrar)
-        for i in range(tamanho - 1):
-            for j in range(i + 1, tamanho):
-                if chave_ordem(exames_a_mostrar[j]) < chave_ordem(exames_a_mostrar[i]):
-                    temp = exames_a_mostrar[i]
-                    exames_a_mostrar[i] = exames_a_mostrar[j]
-                    exames_a_mostrar[j] = temp    #vai seguir a mesma lógica que a função replanear pendentes e organiza por ordem cronologica
-
-        for item in self.tabela.get_children():
-            self.tabela.delete(item)
+            passos = 3
+        self._deslocar_virtual(self._inicio_virtual + passos)
+        return "break"
+
+    def _ao_redimensionar_tabela(self, event):
+        if self._modo_virtual:
+            self._desenhar_janela_virtual()
 
+    def _sincronizar_tabela(self, exames_a_mostrar):
+        """
+        Deixa a Treeview com as linhas de exames_a_mostrar, por esta ordem, fazendo só o necessário:
+        apaga as linhas que saíram, insere as novas, muda de sítio as que trocaram de posição
+        e reescreve os valores apenas das linhas que mudaram.
+        """
+        novas = []
+        valores_novos = {}
         for exame in exames_a_mostrar:
-            valores = (
-                exame.get("num", ""),
-                exame.get("paciente", ""),
-                exame.get("utente", ""),
-                exame.get("nascimento", ""),
-                exame.get("tipo", ""),
-                exame.get("data_registo", ""),
-                exame.get("data_marcada", ""),
-                exame.get("hora_marcada", ""),
-                exame.get("dias_espera", ""),
-                exame.get("resultado", "")
-            )
-            self.tabela.insert("", tk.END, iid=str(exame.get("num", "")), values=valores)
-
-        total = len(self.exames)
-        pendentes = 0
-        aprovados = 0
-        for exame in self.exames:
-            estado = exame.get("resultado", "")
-            if estado == "Pendente":
-                pendentes = pendentes + 1
-            elif estado == "Aprovado":
-                aprovados = aprovados + 1                 #resumidamente atualizamos o rodapé e a aplicação 
-
-        self.label_status.config(
-            text=f"Total de exames: {total} | Aprovados: {aprovados} | Pendentes: {pendentes}"
-        )
+            iid = str(exame.get("num", ""))
+            novas.append(iid)
+            valores_novos[iid] = valores_linha(exame)
+
+        # 1. apagar de uma só vez as linhas que já não aparecem
+        a_apagar = [iid for iid in self._ordem_tabela if iid not in valores_novos]
+        if a_apagar:
+            self.tabela.delete(*a_apagar)
+        antigas = [iid for iid in self._ordem_tabela if iid in valores_novos]
+
+        # 2. percorrer a nova ordem; as posições 0..i-1 da tabela já estão certas
+        movidas = set()
+        j = 0
+        for i, iid in enumerate(novas):
+            while j < len(antigas) and antigas[j] in movidas:
+                j = j + 1
+
+            valores = valores_novos[iid]
+            if iid not in self._linhas_tabela:
+                self.tabela.insert("", i, iid=iid, values=valores)
+                continue
+
+            if j < len(antigas) and antigas[j] == iid:
+                j = j + 1          # já está no sítio certo
+            else:
+                self.tabela.move(iid, "", i)
+                movidas.add(iid)
+
+            if self._linhas_tabela[iid] != valores:
+                self.tabela.item(iid, values=valores)
+
+        self._ordem_tabela = novas
+        self._linhas_tabela = valores_novos
 
     def limpar_filtro(self): #apaga a pesquisa e atualiza a tabela
         self.var_busca.set("")
@@ -659,7 +705,7 @@ class GestorExames(tk.Tk):
 
     def novo_exame(self): #prepara um novo registo e limpa o formulário
         self.limpar_formulario()
-        proximo = proximo_numero(self.exames)
+        proximo = self.servico.proximo_numero()
         self.var_num.set(str(proximo))
 
     def limpar_formulario(self): #limpa todos os campos de entrada de dados
@@ -680,166 +726,69 @@ class GestorExames(tk.Tk):
         data_registo = self.var_registo.get().strip()
         num_str = self.var_num.get().strip()
 
-        if nome == "":
-            messagebox.showerror("Erro", "Indique o nome do paciente.")
-            return
-
-        if not validar_utente(utente):
-            messagebox.showerror("Erro", "Nº de utente inválido. Deve ter 9 a 11 dígitos.")
+        try:
+            exame, novo = self.servico.guardar(nome, utente, nascimento, tipo, data_registo, num_str)
+        except ErroArmazenamento as e:
+            # o exame ficou guardado em memória, só a gravação falhou
+            messagebox.showerror("Erro", str(e))
+            self.atualizar_tabela()
             return
-
-        if not validar_data(nascimento):
-            messagebox.showerror("Erro", "Data de nascimento inválida. Use o formato dd-mm-yyyy.")
+        except ErroExames as e:
+            messagebox.showerror("Erro", str(e))
             return
 
-        inicio_marcacao = dia_inicial_marcacao()
-
-        exame_existente = None
-        if num_str != "":
-            for exame in self.exames:
-                if str(exame.get("num")) == num_str:
-                    exame_existente = exame
-                    break
-
-        if exame_existente is not None:
-            numero = exame_existente.get("num")
-            tipo_antigo = exame_existente.get("tipo", "")
-
-            dia, hora = primeira_marcacao_livre(self.exames, tipo, inicio_marcacao, ignorar_num=numero)
-            estado, dias_espera = calcular_estado_exame(dia)
-            data_marcada_str = dia.strftime(FORMATO_DATA)
-
-            exame_existente["paciente"] = nome
-            exame_existente["utente"] = utente
-            exame_existente["nascimento"] = nascimento
-            exame_existente["tipo"] = tipo
-            exame_existente["data_registo"] = data_registo
-            exame_existente["data_marcada"] = data_marcada_str
-            exame_existente["hora_marcada"] = hora
-            exame_existente["resultado"] = estado
-            exame_existente["dias_espera"] = dias_espera
-
-            if tipo_antigo != "" and tipo_antigo != tipo:
-                replanear_pendentes_por_tipo(self.exames, tipo_antigo)
-
-            replanear_pendentes_por_tipo(self.exames, tipo)
-
-            gravar_dados(self.exames)
-            self.atualizar_tabela()
-            messagebox.showinfo("Atualizado", f"Exame #{numero} atualizado com sucesso.")
-        else:
-            if num_str == "":
-                numero = proximo_numero(self.exames)
-            else:
-                numero = int(num_str)
-
-            dia, hora = primeira_marcacao_livre(self.exames, tipo, inicio_marcacao)
-            estado, dias_espera = calcular_estado_exame(dia)
-            data_marcada_str = dia.strftime(FORMATO_DATA)
-
-            novo_exame = {
-                "num": numero,
-                "paciente": nome,
-                "utente": utente,
-                "nascimento": nascimento,
-                "tipo": tipo,
-                "data_registo": data_registo,
-                "data_marcada": data_marcada_str,
-                "hora_marcada": hora,
-                "resultado": estado,
-                "dias_espera": dias_espera
-            }
-
-            self.exames.append(novo_exame)
-
-            replanear_pendentes_por_tipo(self.exames, tipo)
-
-            gravar_dados(self.exames)
+        numero = exame.get("num")
+        self.atualizar_tabela()
+        if novo:
             self.var_num.set(str(numero))
-            self.atualizar_tabela()
             messagebox.showinfo("Guardado", f"Exame #{numero} registado com sucesso.")
+        else:
+            messagebox.showinfo("Atualizado", f"Exame #{numero} atualizado com sucesso.")
 
     def apagar_exame(self): #se existirem linhas selecionadas
         selecionados = self.tabela.selection() #vamos buscar a função que nos permite selecionar itens 
 
         if selecionados: #se selecionarmos
             numeros_para_apagar = [] #recolhe uma lista dos exames 
-            tipos_afetados = []  # e dos tipos de exame
-
             for iid in selecionados:
-                num_str = str(iid)    #por cada elemento dos selecionados nos vamos converter numa sring e vamos buscar ao ficheiro
-                for exame in self.exames:
-                    if str(exame.get("num")) == num_str:
-                        numeros_para_apagar.append(num_str)
-                        tipos_afetados.append(exame.get("tipo", ""))
-                        break
+                num_str = str(iid)    #por cada elemento dos selecionados vemos se o exame ainda existe
+                if self.servico.existe(num_str):
+                    numeros_para_apagar.append(num_str)
 
             if len(numeros_para_apagar) == 0: 
                 messagebox.showerror("Erro", "Não foi possível encontrar os exames selecionados.")
                 return
 
             texto_lista = ", ".join(numeros_para_apagar)
+            pergunta = f"Tem a certeza que pretende apagar os exames #{texto_lista}?"
+            mensagem = f"Exames #{texto_lista} removidos."
+        else:
+            num_str = self.var_num.get().strip()
 
-            confirmar = messagebox.askyesno(
-                "Confirmar",
-                f"Tem a certeza que pretende apagar os exames #{texto_lista}?"
-            )
-
-            if confirmar:
-                nova_lista = []
-                for exame in self.exames:
-                    num_atual = str(exame.get("num", ""))
-                    if num_atual not in numeros_para_apagar:
-                        nova_lista.append(exame)
-
-                self.exames = nova_lista
-
-                tipos_unicos = []
-                for t in tipos_afetados:
-                    if t != "" and t not in tipos_unicos:
-                        tipos_unicos.append(t)
-
-                for t in tipos_unicos:
-                    replanear_pendentes_por_tipo(self.exames, t)
-
-                gravar_dados(self.exames)
-                self.limpar_formulario()
-                self.atualizar_tabela()
-                messagebox.showinfo("Removido", f"Exames #{texto_lista} removidos.")
-            return
-
-        num_str = self.var_num.get().strip()
-
-        if num_str == "":
-            messagebox.showwarning("Aviso", "Selecione um exame na tabela ou no formulário para apagar.")
-            return
+            if num_str == "":
+                messagebox.showwarning("Aviso", "Selecione um exame na tabela ou no formulário para apagar.")
+                return
 
-        exame_a_apagar = None
-        for exame in self.exames:
-            if str(exame.get("num")) == num_str:
-                exame_a_apagar = exame
-                break
+            if not self.servico.existe(num_str):
+                messagebox.showerror("Erro", "Exame não encontrado.")
+                return
 
-        if exame_a_apagar is None:
-            messagebox.showerror("Erro", "Exame não encontrado.")
-            return
+            numeros_para_apagar = [num_str]
+            pergunta = f"Tem a certeza que pretende apagar o exame #{num_str}?"
+            mensagem = f"Exame #{num_str} removido."
 
-        confirmar = messagebox.askyesno(
-            "Confirmar",
-            f"Tem a certeza que pretende apagar o exame #{num_str}?"
-        )
+        confirmar = messagebox.askyesno("Confirmar", pergunta)
 
         if confirmar:
-            tipo_removido = exame_a_apagar.get("tipo", "")
-            self.exames.remove(exame_a_apagar)
-
-            if tipo_removido != "":
-                replanear_pendentes_por_tipo(self.exames, tipo_removido)
-
-            gravar_dados(self.exames)
+            try:
+                self.servico.apagar(numeros_para_apagar)
+            except ErroExames as e:
+                messagebox.showerror("Erro", str(e))
+                self.atualizar_tabela()
+                return
             self.limpar_formulario()
             self.atualizar_tabela()
-            messagebox.showinfo("Removido", f"Exame #{num_str} removido.")
+            messagebox.showinfo("Removido", mensagem)
 
     def carregar_selecao(self, event):
         selecionados = self.tabela.selection()
@@ -850,15 +799,18 @@ class GestorExames(tk.Tk):
         iid = selecionados[0]
         num_selecionado = str(iid)
 
-        for exame in self.exames:
-            if str(exame.get("num")) == num_selecionado:
-                self.var_num.set(str(exame.get("num", "")))
-                self.var_paciente.set(exame.get("paciente", ""))
-                self.var_utente.set(exame.get("utente", ""))
-                self.var_nascimento.set(exame.get("nascimento", ""))
-                self.var_tipo.set(exame.get("tipo", TIPOS_EXAME[0]))
-                self.var_registo.set(exame.get("data_registo", data_hoje()))
-                break
+        try:
+            exame = self.servico.obter(num_selecionado)   # pelo índice de números, sem percorrer a lista
+        except ErroExames:
+            return
+
+        self.var_num.set(str(exame.get("num", "")))
+        self.var_paciente.set(exame.get("paciente", ""))
+        self.var_utente.set(exame.get("utente", ""))
+        self.var_nascimento.set(exame.get("nascimento", ""))
+        self.var_tipo.set(exame.get("tipo", TIPOS_EXAME[0]))
+        self.var_registo.set(exame.get("data_registo", data_hoje()))
+
     def abrir_detalhes_exame(self, event):
         """
         Abre uma janela com os detalhes do exame selecionado
@@ -871,13 +823,9 @@ class GestorExames(tk.Tk):
         iid = selecionados[0]
         num_selecionado = str(iid)
 
-        exame_encontrado = None
-        for exame in self.exames:
-            if str(exame.get("num")) == num_selecionado:
-                exame_encontrado = exame
-                break
-
-        if exame_encontrado is None:
+        try:
+            exame_encontrado = self.servico.obter(num_selecionado)
+        except ErroExames:
             return
 
         janela = tk.Toplevel(self)
@@ -914,74 +862,363 @@ class GestorExames(tk.Tk):
             row=len(campos), column=0, columnspan=2, pady=(10, 0)
         )
 
+    def abrir_analise(self):
+        """
+        Janela com as estatísticas (analise_exames.py): espera por tipo, ocupação por semana e por dia,
+        e antecedência por tipo. Precisa do NumPy; sem ele só avisa.
+        """
+        if not NUMPY_DISPONIVEL:
+            messagebox.showinfo("Análise", "A análise precisa do NumPy (pip install numpy).")
+            return
+
+        janela = tk.Toplevel(self)
+        janela.title("Análise dos exames")
+        janela.geometry("820x460")
+        janela.transient(self)
+
+        separadores = ttk.Notebook(janela)
+        separadores.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 0))
+
+        def criar_tabela(titulo, colunas, mostrar="headings"):
+            frame = ttk.Frame(separadores)
+            separadores.add(frame, text=titulo)
+            tabela = ttk.Treeview(frame, columns=[c for c, _ in colunas], show=mostrar)
+            for coluna, texto in colunas:
+                tabela.heading(coluna, text=texto)
+                tabela.column(coluna, width=90, anchor="center")
+            barra = ttk.Scrollbar(frame, orient="vertical", command=tabela.yview)
+            tabela.configure(yscrollcommand=barra.set)
+            tabela.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+            barra.pack(side=tk.RIGHT, fill=tk.Y)
+            return tabela
+
+        tabela_espera = criar_tabela("Espera por tipo", [
+            ("tipo", "Tipo de Exame"), ("pendentes", "Pendentes"), ("media", "Média (dias)"),
+            ("p50", "p50"), ("p90", "p90"), ("p95", "p95"), ("ultimo_dia", "Último dia marcado"),
+        ])
+        tabela_espera.column("tipo", width=150, anchor="w")
+        tabela_ocupacao = criar_tabela("Ocupação", [
+            ("marcados", "Marcados"), ("capacidade", "Capacidade"), ("ocupacao", "Ocupação"),
+        ], mostrar="tree headings")
+        tabela_ocupacao.heading("#0", text="Semana / Dia")
+        tabela_antecedencia = criar_tabela(
+            "Antecedência", [("tipo", "Tipo de Exame")] + [(nome, f"{nome} dias") for nome, _, _ in GRUPOS_ANTECEDENCIA]
+        )
+        tabela_antecedencia.column("tipo", width=150, anchor="w")
+
+        rodape = ttk.Label(janela, text="", padding=8)
+
+        def preencher():
+            try:
+                resultado = analisar(self.servico)
+            except ErroExames as e:
+                messagebox.showerror("Análise", str(e), parent=janela)
+                return
+            for tabela in (tabela_espera, tabela_ocupacao, tabela_antecedencia):
+                tabela.delete(*tabela.get_children())
+
+            for tipo, espera in resultado["espera_por_tipo"].items():
+                tabela_espera.insert("", tk.END, values=(
+                    tipo, espera["pendentes"], espera["media"], espera["p50"], espera["p90"], espera["p95"],
+                    espera["ultimo_dia"],
+                ))
+
+            # cada semana com os seus dias por baixo
+            dias = iter(resultado["ocupacao_por_dia"])
+            for semana in resultado["ocupacao_por_semana"]:
+                linha = tabela_ocupacao.insert("", tk.END, text=f"Semana de {semana['semana']}", open=False, values=(
+                    semana["marcados"], semana["capacidade"], f"{semana['ocupacao']:.0%}",
+                ))
+                for _ in range(semana["dias"]):
+                    dia = next(dias)
+                    tabela_ocupacao.insert(linha, tk.END, text=dia["data"], values=(
+                        dia["marcados"], dia["capacidade"], f"{dia['ocupacao']:.0%}",
+                    ))
+
+            for tipo, barras in resultado["antecedencia"]["por_tipo"].items():
+                tabela_antecedencia.insert("", tk.END, values=[tipo] + [sum(barras[inicio:fim]) for _, inicio, fim in GRUPOS_ANTECEDENCIA])
+
+            rodape.config(text=f"Hoje: {resultado['hoje']} | Exames analisados: {resultado['total']}")
+
+        botoes = ttk.Frame(janela, padding=(10, 8))
+        botoes.pack(fill=tk.X, side=tk.BOTTOM)
+        ttk.Button(botoes, text="↻ Atualizar", command=preencher).pack(side=tk.LEFT)
+        ttk.Button(botoes, text="Fechar", command=janela.destroy).pack(side=tk.RIGHT)
+        rodape.pack(fill=tk.X, side=tk.BOTTOM)
+
+        preencher()
+
+    def abrir_diagnostico(self):
+        """
+        Janela com as medições das operações mais pesadas (chamadas, registos, durações e histograma;
+        ver medir no núcleo) e o perfil cProfile, que se liga e desliga aqui sem reiniciar a aplicação.
+        """
+        janela = tk.Toplevel(self)
+        janela.title("Diagnóstico")
+        janela.geometry("980x420")
+        janela.transient(self)
+
+        separadores = ttk.Notebook(janela)
+        separadores.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 0))
+
+        frame_medicoes = ttk.Frame(separadores)
+        separadores.add(frame_medicoes, text="Medições")
+        barras = [f"≤{limite}" for limite in LIMITES_HISTOGRAMA_MS] + [f">{LIMITES_HISTOGRAMA_MS[-1]}"]
+        colunas = [
+            ("chamadas", "Chamadas"), ("registos", "Registos"), ("media_ms", "Média (ms)"),
+            ("p50_ms", "p50 (ms)"), ("p95_ms", "p95 (ms)"), ("maximo_ms", "Máx. (ms)"), ("total_ms", "Total (ms)"),
+        ] + [(f"barra{i}", titulo) for i, titulo in enumerate(barras)]
+        tabela = ttk.Treeview(frame_medicoes, columns=[c for c, _ in colunas], show="tree headings")
+        tabela.heading("#0", text="Função")
+        tabela.column("#0", width=190, anchor="w")
+        for coluna, texto in colunas:
+            tabela.heading(coluna, text=texto)
+            tabela.column(coluna, width=70 if coluna.startswith("barra") else 80, anchor="center")
+        barra = ttk.Scrollbar(frame_medicoes, orient="horizontal", command=tabela.xview)
+        tabela.configure(xscrollcommand=barra.set)
+        barra.pack(side=tk.BOTTOM, fill=tk.X)
+        tabela.pack(fill=tk.BOTH, expand=True)
+
+        frame_perfil = ttk.Frame(separadores)
+        separadores.add(frame_perfil, text="Perfil (cProfile)")
+        texto_perfil = tk.Text(frame_perfil, wrap="none", font=("Courier", 9))
+        texto_perfil.insert("1.0", "Ligue o perfil, faça o que está lento e desligue-o para ver aqui o resultado.")
+        texto_perfil.pack(fill=tk.BOTH, expand=True)
+
+        rodape = ttk.Label(janela, text="", padding=8)
+        botoes = ttk.Frame(janela, padding=(10, 8))
+        botao_medicoes = ttk.Button(botoes)
+        botao_perfil = ttk.Button(botoes)
+
+        def preencher():
+            medicoes = obter_medicoes()
+            tabela.delete(*tabela.get_children())
+            for nome, medicao in medicoes["funcoes"].items():
+                tabela.insert("", tk.END, text=nome, values=[medicao[c] for c, _ in colunas[:7]] + medicao["histograma"])
+            botao_medicoes.config(text="⏸ Desligar medições" if medicoes["ativas"] else "▶ Ligar medições")
+            botao_perfil.config(text="■ Parar perfil" if medicoes["perfil"] else "● Iniciar perfil")
+            estado = "ligadas" if medicoes["ativas"] else "desligadas"
+            rodape.config(text=f"Medições {estado}" + (" | perfil ligado" if medicoes["perfil"] else ""))
+
+        def acompanhar():
+            if janela.winfo_exists():
+                preencher()
+                janela.after(INTERVALO_DIAGNOSTICO_MS, acompanhar)
+
+        def trocar_medicoes():
+            ativar_medicoes(not medicoes_ativas())
+            preencher()
+
+        def limpar():
+            limpar_medicoes()
+            preencher()
+
+        def guardar_json():
+            caminho = filedialog.asksaveasfilename(
+                parent=janela, title="Guardar medições", defaultextension=".json",
+                initialfile="medicoes.json", filetypes=[("JSON", "*.json")],
+            )
+            if not caminho:
+                return
+            try:
+                gravar_medicoes(caminho)
+            except ErroExames as e:
+                messagebox.showerror("Diagnóstico", str(e), parent=janela)
+
+        def trocar_perfil():
+            if not perfil_ativo():
+                iniciar_perfil()
+                preencher()
+                return
+            caminho = filedialog.asksaveasfilename(
+                parent=janela, title="Guardar perfil (cancelar: só mostrar)", defaultextension=".prof",
+                initialfile="perfil.prof", filetypes=[("Perfil cProfile", "*.prof")],
+            )
+            try:
+                resumo = parar_perfil(caminho or None)
+            except ErroExames as e:
+                messagebox.showerror("Diagnóstico", str(e), parent=janela)
+                resumo = ""
+            if resumo:
+                texto_perfil.delete("1.0", tk.END)
+                texto_perfil.insert("1.0", resumo)
+                separadores.select(frame_perfil)
+            preencher()
+
+        botao_medicoes.config(command=trocar_medicoes)
+        botao_perfil.config(command=trocar_perfil)
+        botoes.pack(fill=tk.X, side=tk.BOTTOM)
+        botao_medicoes.pack(side=tk.LEFT)
+        ttk.Button(botoes, text="Limpar", command=limpar).pack(side=tk.LEFT, padx=5)
+        ttk.Button(botoes, text="Guardar JSON", command=guardar_json).pack(side=tk.LEFT)
+        botao_perfil.pack(side=tk.LEFT, padx=5)
+        ttk.Button(botoes, text="Fechar", command=janela.destroy).pack(side=tk.RIGHT)
+        rodape.pack(fill=tk.X, side=tk.BOTTOM)
+
+        acompanhar()
+
     def recarregar(self):
-        self.exames = ler_dados()
+        try:
+            self.servico.gravar_pendentes()
+        except ErroExames as e:
+            messagebox.showerror("Erro", f"{e}\n\nHá alterações por gravar: os dados não foram recarregados.")
+            return
+        self._ler_exames()
         self.atualizar_tabela()
         messagebox.showinfo("Recarregado", "Dados recarregados a partir do ficheiro.")
 
     def exportar_csv(self):
-        if len(self.exames) == 0:
+        """
+        Exporta para CSV numa thread à parte, com barra de progresso e botão para cancelar.
+        Se houver um filtro de pesquisa ativo, pergunta se é para exportar só os exames filtrados.
+        """
+        if len(self.servico.exames) == 0:
             messagebox.showinfo("Exportar CSV", "Não há dados para exportar.")
             return
 
+        exames_a_exportar = self.servico.exames
+        if self.var_busca.get().strip() != "" and len(self._resultado_tabela) != len(self.servico.exames):
+            resposta = messagebox.askyesnocancel(
+                "Exportar CSV",
+                f"Exportar só os {len(self._resultado_tabela)} exames filtrados?\n"
+                "(Não = exportar todos os exames)"
+            )
+            if resposta is None:
+                return
+            if resposta:
+                exames_a_exportar = self._resultado_tabela
+
         caminho = filedialog.asksaveasfilename(
             title="Exportar para CSV",
             defaultextension=".csv",
             filetypes=[("Ficheiros CSV", "*.csv")]
         )
 
+        if not caminho:
+            return
+
+        # janela de progresso (modal: não se mexe nos exames enquanto a exportação decorre)
+        janela = tk.Toplevel(self)
+        janela.title("Exportar CSV")
+        janela.transient(self)
+        janela.grab_set()
+        janela.resizable(False, False)
+        janela.protocol("WM_DELETE_WINDOW", lambda: None)
+
+        frame = ttk.Frame(janela, padding=15)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        texto = ttk.Label(frame, text="A exportar...")
+        texto.pack(anchor="w")
+        barra = ttk.Progressbar(frame, orient="horizontal", length=320, mode="determinate", maximum=1)
+        barra.pack(pady=8)
+
+        cancelar = threading.Event()
+        ttk.Button(frame, text="Cancelar", command=cancelar.set).pack()
+
+        exames_a_exportar = list(exames_a_exportar)
+        estado = {"feitos": 0, "total": len(exames_a_exportar), "fim": None}
+
+        def progresso(feitos, total):
+            estado["feitos"] = feitos
+
+        def trabalhar():
+            try:
+                self.servico.exportar_csv(caminho, exames_a_exportar, progresso, cancelar)
+                estado["fim"] = ("ok", None)
+            except ExportacaoCancelada:
+                estado["fim"] = ("cancelada", None)
+            except ErroArmazenamento as e:
+                estado["fim"] = ("erro", e)
+
+        def acompanhar():
+            total = estado["total"]
+            barra.config(maximum=max(total, 1), value=estado["feitos"])
+            texto.config(text=f"A exportar... {estado['feitos']} de {total}")
+            if estado["fim"] is None:
+                self.after(100, acompanhar)
+                return
+
+            janela.grab_release()
+            janela.destroy()
+            resultado, erro = estado["fim"]
+            if resultado == "ok":
+                messagebox.showinfo("Exportar CSV", "Exportação concluída com sucesso.")
+            elif resultado == "cancelada":
+                messagebox.showinfo("Exportar CSV", "Exportação cancelada.")
+            else:
+                messagebox.showerror("Erro", str(erro))
+
+        threading.Thread(target=trabalhar, daemon=True).start()
+        self.after(100, acompanhar)
+
+    def importar_ficheiro(self):
+        """
+        Importa uma lista de exames (CSV ou JSON) de uma só vez: valida as linhas, marca-as,
+        grava uma única vez no fim e mostra as linhas rejeitadas.
+        """
+        caminho = filedialog.askopenfilename(
+            title="Importar exames",
+            filetypes=[("Ficheiros CSV ou JSON", "*.csv *.json"), ("Todos os ficheiros", "*.*")]
+        )
+
         if not caminho:
             return
 
         try:
-            exames_ordenados = list(self.exames)
-            n = len(exames_ordenados)
-            for i in range(n - 1):
-                for j in range(i + 1, n):
-                    num_i = int(exames_ordenados[i].get("num", 0))
-                    num_j = int(exames_ordenados[j].get("num", 0))
-                    if num_j < num_i:
-                        temp = exames_ordenados[i]
-                        exames_ordenados[i] = exames_ordenados[j]
-                        exames_ordenados[j] = temp
-
-            with open(caminho, "w", newline="", encoding="utf-8") as f:
-                escritor = csv.writer(f, delimiter=";")
-                escritor.writerow([
-                    "num", "paciente", "utente", "nascimento", "tipo",
-                    "data_registo", "data_marcada", "hora_marcada",
-                    "dias_espera", "resultado"
-                ])
-
-                for exame in exames_ordenados:
-                    linha = [
-                        exame.get("num", ""),
-                        exame.get("paciente", ""),
-                        exame.get("utente", ""),
-                        exame.get("nascimento", ""),
-                        exame.get("tipo", ""),
-                        exame.get("data_registo", ""),
-                        exame.get("data_marcada", ""),
-                        exame.get("hora_marcada", ""),
-                        exame.get("dias_espera", ""),
-                        exame.get("resultado", "")
-                    ]
-                    escritor.writerow(linha)
-
-            messagebox.showinfo("Exportar CSV", "Exportação concluída com sucesso.")
-        except OSError as e:
-            messagebox.showerror("Erro", f"Erro ao exportar CSV: {e}")
+            novos, rejeitados = self.servico.importar_ficheiro(caminho)
+        except ErroExames as e:
+            messagebox.showerror("Erro", str(e))
+            self.atualizar_tabela()
+            return
+
+        if novos:
+            self.atualizar_tabela()
+
+        texto = f"{len(novos)} exames importados, {len(rejeitados)} linhas rejeitadas."
+        if rejeitados:
+            texto = texto + "\n"
+            for posicao, motivo in rejeitados[:15]:
+                texto = texto + f"\nLinha {posicao}: {motivo}"
+            if len(rejeitados) > 15:
+                texto = texto + f"\n... e mais {len(rejeitados) - 15}"
+        messagebox.showinfo("Importar", texto)
 
     def botao_gravar_ficheiro(self):
-        sucesso = gravar_dados(self.exames)
-        if sucesso:
-            messagebox.showinfo("Gravar", "Dados gravados com sucesso.")
+        try:
+            self.servico.gravar()
+        except ErroExames as e:
+            messagebox.showerror("Erro", str(e))
+            return
+        self._texto_gravacao = self._descrever_gravacao()
+        self._mostrar_rodape()
+        messagebox.showinfo("Gravar", "Dados gravados com sucesso.")
+
+    def _ler_exames(self):
+        """Lê os exames do armazenamento; se der erro, avisa e começa com a lista vazia."""
+        try:
+            self.servico.recarregar()
+        except ErroArmazenamento:
+            messagebox.showwarning(
+                "Aviso",
+                "Não foi possível ler o ficheiro de exames. Vai ser iniciada uma lista vazia."
+            )
+            self.servico.definir_exames([])
 
 # =================== EXECUTAR ===================
 
 if __name__ == "__main__":
-    app = GestorExames()
-    app.mainloop()
+    if sys.argv[1:2] == ["--migrar-sqlite"]:
+        # migração única: python <este ficheiro> --migrar-sqlite
+        try:
+            quantos = migrar_json_para_sqlite(FICHEIRO_EXAMES, FICHEIRO_SQLITE)
+        except ErroExames as e:
+            print(f"Erro: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{quantos} exames migrados de {FICHEIRO_EXAMES} para {FICHEIRO_SQLITE}.")
+    else:
+        app = GestorExames()
+        app.mainloop()
 
 
 # Recursos, referências e inspirações consultados durante o desenvolvimento da aplicação:
@@ -0,0 +1,207 @@
+"""
+Gestor de Exames Clínicos - análise (estatísticas dos tempos de espera e da ocupação).
+
+Lê as colunas dos exames (ColunasExames do núcleo) para arrays NumPy e calcula tudo de uma vez,
+sem percorrer os exames um a um:
+    - dias de espera dos exames pendentes por tipo: média e percentis (p50, p90, p95)
+    - ocupação das vagas (exames marcados / CAPACIDADE_DIARIA) por dia e por semana
+    - horizonte da lista de espera por tipo: até que dia há exames marcados
+    - histograma da antecedência (dias entre o registo e a data marcada), por tipo
+
+    from analise_exames import analisar
+    resultado = analisar(servico)          # dicionário só com listas, números e textos (pronto para JSON)
+
+O NumPy é opcional: sem ele o resto da aplicação funciona e analisar() lança AnaliseIndisponivel.
+"""
+
+from datetime import date
+
+from nucleo_exames import (
+    CAPACIDADE_DIARIA, FORMATO_DATA, ColunasExames, ErroExames, ErroValidacao, dia_de_hoje,
+)
+
+try:
+    import numpy as np
+except ImportError:   # a análise é opcional
+    np = None
+
+NUMPY_DISPONIVEL = np is not None
+
+# =================== CONFIGURAÇÃO ===================
+
+# Dias de ocupação mostrados por omissão (a partir de hoje)
+DIAS_OCUPACAO = 28
+
+# Histograma da antecedência: uma barra por dia até este limite (o último inclui tudo o que passa dele)
+LIMITE_ANTECEDENCIA = 60
+
+PERCENTIS = (50, 90, 95)
+
+
+class AnaliseIndisponivel(ErroExames):
+    """O NumPy não está instalado."""
+
+# =================== COLUNAS ===================
+
+def ler_colunas(servico):
+    """
+    (tipos, marcadas, registos) como arrays NumPy (int64), só com as linhas ocupadas.
+    As colunas são criadas pelo serviço da primeira vez e depois mantidas a par das alterações,
+    por isso aqui só há uma cópia de memória.
+    """
+    if np is None:
+        raise AnaliseIndisponivel("A análise precisa do NumPy (pip install numpy).")
+    tipos, marcadas, registos = servico.colunas().copiar()
+    tipos = np.frombuffer(tipos, dtype=np.int32)
+    ocupadas = tipos >= 0
+    return (tipos[ocupadas].astype(np.int64),
+            np.frombuffer(marcadas, dtype=np.int32)[ocupadas].astype(np.int64),
+            np.frombuffer(registos, dtype=np.int32)[ocupadas].astype(np.int64))
+
+
+def _texto(ordinal):
+    return date.fromordinal(int(ordinal)).strftime(FORMATO_DATA)
+
+# =================== ESTATÍSTICAS ===================
+
+def espera_por_tipo(tipos, marcadas, hoje):
+    """
+    Para cada tipo com exames pendentes (data marcada depois de hoje):
+    {tipo: {"pendentes", "media", "p50", "p90", "p95", "horizonte", "ultimo_dia"}}.
+    Os dias de espera são inteiros pequenos: um só bincount dá o histograma (tipo x dias) de todos
+    os tipos, e a média, os percentis e o horizonte (o maior nº de dias) saem dele.
+    """
+    pendentes = marcadas > hoje
+    codigos = tipos[pendentes]
+    dias = marcadas[pendentes] - hoje
+    if len(dias) == 0:
+        return {}
+
+    quantos_tipos = int(codigos.max()) + 1
+    largura = int(dias.max()) + 1
+    histograma = np.bincount(codigos * largura + dias, minlength=quantos_tipos * largura)
+    histograma = histograma.reshape(quantos_tipos, largura)
+    contagens = histograma.sum(axis=1)
+    somas = np.bincount(codigos, weights=dias, minlength=quantos_tipos)
+
+    # percentil (pela ordem: o menor valor com pelo menos p% dos exames até ele) de todos os tipos de uma vez:
+    # os acumulados de cada linha somam-se a um deslocamento para ficarem todos numa só sequência crescente
+    acumulados = histograma.cumsum(axis=1)
+    deslocamentos = np.arange(quantos_tipos, dtype=np.int64) * (len(dias) + 1)
+    seguidos = (acumulados + deslocamentos[:, None]).ravel()
+    percentis = {}
+    for p in PERCENTIS:
+        alvos = np.maximum(np.ceil(contagens * (p / 100)), 1).astype(np.int64) + deslocamentos
+        percentis[p] = np.searchsorted(seguidos, alvos) - np.arange(quantos_tipos) * largura
+
+    # horizonte: a última coluna do histograma que não está vazia
+    horizontes = largura - 1 - np.argmax(histograma[:, ::-1] > 0, axis=1)
+
+    resultado = {}
+    for codigo, nome in enumerate(ColunasExames.nomes_dos_tipos()[:quantos_tipos]):
+        if contagens[codigo] == 0:
+            continue
+        resultado[nome] = {
+            "pendentes": int(contagens[codigo]),
+            "media": round(float(somas[codigo] / contagens[codigo]), 1),
+            **{f"p{p}": int(percentis[p][codigo]) for p in PERCENTIS},
+            "horizonte": int(horizontes[codigo]),
+            "ultimo_dia": _texto(hoje + horizontes[codigo]),
+        }
+    return resultado
+
+
+def ocupacao(tipos, marcadas, inicio, dias):
+    """
+    Exames marcados / capacidade (CAPACIDADE_DIARIA) nos dias [inicio, inicio + dias):
+    (por dia, por semana, por tipo). A semana começa à segunda-feira e é identificada por esse dia;
+    as semanas nas pontas contam só os dias que estão dentro do intervalo.
+    """
+    nomes = ColunasExames.nomes_dos_tipos()
+    capacidades = np.array([CAPACIDADE_DIARIA.get(nome, 0) for nome in nomes], dtype=np.int64)
+    dentro = (marcadas >= inicio) & (marcadas < inicio + dias)
+    codigos = tipos[dentro]
+    dentro_da_capacidade = capacidades[codigos] > 0      # tipos sem capacidade definida não contam
+    codigos = codigos[dentro_da_capacidade]
+    posicoes = marcadas[dentro][dentro_da_capacidade] - inicio
+
+    por_tipo_e_dia = np.bincount(codigos * dias + posicoes, minlength=len(capacidades) * dias)
+    por_tipo_e_dia = por_tipo_e_dia.reshape(len(capacidades), dias)
+    marcados_dia = por_tipo_e_dia.sum(axis=0)
+    capacidade_dia = int(capacidades.sum())
+
+    ordinais = np.arange(inicio, inicio + dias)
+    semanas = ordinais - (ordinais - 1) % 7          # segunda-feira de cada dia (o ordinal 1 foi uma segunda)
+    primeiras, indice_semana = np.unique(semanas, return_inverse=True)
+    marcados_semana = np.bincount(indice_semana, weights=marcados_dia, minlength=len(primeiras))
+    dias_semana = np.bincount(indice_semana, minlength=len(primeiras))
+
+    por_dia = [
+        {"data": _texto(ordinal), "marcados": int(marcados), "capacidade": capacidade_dia,
+         "ocupacao": _fracao(marcados, capacidade_dia)}
+        for ordinal, marcados in zip(ordinais, marcados_dia)
+    ]
+    por_semana = [
+        {"semana": _texto(segunda), "dias": int(quantos), "marcados": int(marcados),
+         "capacidade": capacidade_dia * int(quantos),
+         "ocupacao": _fracao(marcados, capacidade_dia * quantos)}
+        for segunda, marcados, quantos in zip(primeiras, marcados_semana, dias_semana)
+    ]
+    marcados_tipo = por_tipo_e_dia.sum(axis=1)
+    por_tipo = {
+        nome: _fracao(marcados_tipo[codigo], capacidades[codigo] * dias)
+        for codigo, nome in enumerate(nomes) if capacidades[codigo] > 0
+    }
+    return por_dia, por_semana, por_tipo
+
+
+def antecedencia(tipos, marcadas, registos, limite=LIMITE_ANTECEDENCIA):
+    """
+    Histograma dos dias entre o registo e a data marcada: {"total": [...], "por_tipo": {tipo: [...]}}.
+    A barra i conta os exames com i dias de antecedência; a primeira também os de antecedência negativa
+    e a última (limite) todos os de limite dias ou mais.
+    """
+    validos = (marcadas >= 0) & (registos >= 0)
+    codigos = tipos[validos]
+    dias = np.clip(marcadas[validos] - registos[validos], 0, limite)
+    if len(dias) == 0:
+        return {"total": [0] * (limite + 1), "por_tipo": {}}
+
+    quantos_tipos = int(codigos.max()) + 1
+    histograma = np.bincount(codigos * (limite + 1) + dias, minlength=quantos_tipos * (limite + 1))
+    histograma = histograma.reshape(quantos_tipos, limite + 1)
+    return {
+        "total": histograma.sum(axis=0).tolist(),
+        "por_tipo": {nome: histograma[codigo].tolist()
+                     for codigo, nome in enumerate(ColunasExames.nomes_dos_tipos()[:quantos_tipos])
+                     if histograma[codigo].any()},
+    }
+
+
+def _fracao(parte, todo):
+    return round(float(parte) / float(todo), 3) if todo else 0.0
+
+# =================== ANÁLISE COMPLETA ===================
+
+def analisar(servico, inicio=None, dias=DIAS_OCUPACAO):
+    """
+    Todas as estatísticas dos exames do serviço (dicionário pronto para JSON).
+    A ocupação é a dos dias [inicio, inicio + dias) (inicio é o nº do dia; por omissão, hoje).
+    """
+    if dias < 1:
+        raise ErroValidacao("O nº de dias da ocupação tem de ser pelo menos 1.")
+    hoje = dia_de_hoje()
+    if inicio is None:
+        inicio = hoje
+    tipos, marcadas, registos = ler_colunas(servico)
+
+    por_dia, por_semana, por_tipo = ocupacao(tipos, marcadas, inicio, dias)
+    return {
+        "hoje": _texto(hoje),
+        "total": int(len(tipos)),
+        "espera_por_tipo": espera_por_tipo(tipos, marcadas, hoje),
+        "ocupacao_por_dia": por_dia,
+        "ocupacao_por_semana": por_semana,
+        "ocupacao_por_tipo": por_tipo,
+        "antecedencia": antecedencia(tipos, marcadas, registos),
+    }
@@ -0,0 +1,183 @@
+"""
+Teste de carga do servidor HTTP/JSON (servidor_exames.py).
+
+Abre N clientes em simultâneo (cada um com a sua ligação keep-alive) que fazem marcações
+(POST /exames) e, se pedido, pesquisas (GET /exames?termo=...). No fim mostra as marcações por
+segundo, as latências (p50, p95, p99) e verifica que nenhuma vaga ficou marcada duas vezes.
+
+    python carga_api.py --arrancar                       # arranca um servidor numa pasta temporária
+    python carga_api.py --porta 8765 --clientes 50 --pedidos 200 --leituras 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from nucleo_exames import TIPOS_EXAME
+
+NOMES = ["Ana", "João", "Maria", "José", "Beatriz", "Rui", "Sofia", "Pedro", "Inês", "Tiago"]
+APELIDOS = ["Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa", "Rodrigues", "Martins"]
+
+# =================== CLIENTE ===================
+
+class ClienteHTTP:
+    """Cliente HTTP/1.1 mínimo, com uma só ligação keep-alive."""
+
+    def __init__(self, host, porta):
+        self.host = host
+        self.porta = porta
+        self._leitor = None
+        self._escritor = None
+
+    async def abrir(self):
+        self._leitor, self._escritor = await asyncio.open_connection(self.host, self.porta)
+
+    async def fechar(self):
+        if self._escritor is not None:
+            self._escritor.close()
+            await self._escritor.wait_closed()
+
+    async def pedido(self, metodo, caminho, dados=None):
+        """Devolve (estado HTTP, resposta em JSON)."""
+        corpo = json.dumps(dados).encode("utf-8") if dados is not None else b""
+        self._escritor.write(
+            f"{metodo} {caminho} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(corpo)}\r\n\r\n".encode("latin-1") + corpo
+        )
+        await self._escritor.drain()
+
+        linha = await self._leitor.readline()
+        estado = int(linha.split()[1])
+        tamanho = 0
+        while True:
+            linha = await self._leitor.readline()
+            if linha in (b"\r\n", b""):
+                break
+            nome, _, valor = linha.decode("latin-1").partition(":")
+            if nome.strip().lower() == "content-length":
+                tamanho = int(valor)
+        resposta = await self._leitor.readexactly(tamanho)
+        return estado, json.loads(resposta)
+
+# =================== CARGA ===================
+
+async def cliente(host, porta, pedidos, fracao_leituras, semente, latencias, erros):
+    aleatorio = random.Random(semente)
+    ligacao = ClienteHTTP(host, porta)
+    await ligacao.abrir()
+    try:
+        for _ in range(pedidos):
+            inicio = time.perf_counter()
+            if aleatorio.random() < fracao_leituras:
+                tipo_pedido = "leitura"
+                estado, _ = await ligacao.pedido("GET", "/exames?termo=" + aleatorio.choice(APELIDOS).lower())
+            else:
+                tipo_pedido = "marcacao"
+                estado, _ = await ligacao.pedido("POST", "/exames", {
+                    "paciente": f"{aleatorio.choice(NOMES)} {aleatorio.choice(APELIDOS)}",
+                    "utente": str(aleatorio.randint(100000000, 99999999999)),
+                    "nascimento": "01-01-1980",
+                    "tipo": aleatorio.choice(TIPOS_EXAME),
+                })
+            latencias[tipo_pedido].append(time.perf_counter() - inicio)
+            if estado >= 400:
+                erros.append(estado)
+    finally:
+        await ligacao.fechar()
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+async def correr_carga(host, porta, clientes, pedidos, fracao_leituras):
+    latencias = {"marcacao": [], "leitura": []}
+    erros = []
+    inicio = time.perf_counter()
+    await asyncio.gather(*[
+        cliente(host, porta, pedidos, fracao_leituras, semente, latencias, erros)
+        for semente in range(clientes)
+    ])
+    duracao = time.perf_counter() - inicio
+
+    print(f"{clientes} clientes x {pedidos} pedidos em {duracao:.2f} s")
+    for tipo_pedido, valores in latencias.items():
+        if not valores:
+            continue
+        print(
+            f"  {tipo_pedido:9s} {len(valores):6d} pedidos  {len(valores) / duracao:8.1f}/s  "
+            f"p50 {percentil(valores, 50) * 1000:6.1f} ms  p95 {percentil(valores, 95) * 1000:6.1f} ms  "
+            f"p99 {percentil(valores, 99) * 1000:6.1f} ms"
+        )
+    print(f"  erros: {len(erros)}")
+
+    # nenhuma vaga (tipo, data, hora) pode ter ficado com dois exames
+    ligacao = ClienteHTTP(host, porta)
+    await ligacao.abrir()
+    _, exames = await ligacao.pedido("GET", "/exames")
+    await ligacao.fechar()
+    vagas = [(e["tipo"], e["data_marcada"], e["hora_marcada"]) for e in exames]
+    repetidas = len(vagas) - len(set(vagas))
+    print(f"  exames no servidor: {len(exames)}, vagas marcadas duas vezes: {repetidas}")
+    return repetidas == 0 and not erros
+
+# =================== EXECUTAR ===================
+
+async def esperar_servidor(host, porta, processo):
+    for _ in range(100):
+        if processo.poll() is not None:
+            raise RuntimeError("O servidor terminou ao arrancar.")
+        try:
+            _, escritor = await asyncio.open_connection(host, porta)
+            escritor.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("O servidor não respondeu.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga do servidor de exames")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--clientes", type=int, default=50)
+    parser.add_argument("--pedidos", type=int, default=100, help="pedidos por cliente")
+    parser.add_argument("--leituras", type=float, default=0.0, help="fração dos pedidos que são pesquisas")
+    parser.add_argument("--arrancar", action="store_true",
+                        help="arranca um servidor novo (numa pasta temporária) só para o teste")
+    parser.add_argument("--armazenamento", choices=["sqlite", "json"], default="sqlite")
+    args = parser.parse_args(argv)
+
+    processo = None
+    pasta = None
+    if args.arrancar:
+        pasta = tempfile.TemporaryDirectory()
+        servidor = os.path.join(os.path.dirname(os.path.abspath(__file__)), "servidor_exames.py")
+        processo = subprocess.Popen(
+            [sys.executable, servidor, "--host", args.host, "--porta", str(args.porta),
+             "--armazenamento", args.armazenamento],
+            cwd=pasta.name, stdout=subprocess.DEVNULL,
+        )
+    try:
+        if processo is not None:
+            asyncio.run(esperar_servidor(args.host, args.porta, processo))
+        correu_bem = asyncio.run(correr_carga(args.host, args.porta, args.clientes, args.pedidos, args.leituras))
+    finally:
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+            pasta.cleanup()
+    return 0 if correu_bem else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
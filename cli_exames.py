@@ -0,0 +1,242 @@
+"""
+Gestor de Exames Clínicos - linha de comandos.
+
+Faz as mesmas operações da interface gráfica, sem janelas (usa só o nucleo_exames):
+
+    python cli_exames.py listar [--termo ana]
+    python cli_exames.py mostrar 12
+    python cli_exames.py criar --paciente "Ana Silva" --utente 123456789 --nascimento 01-02-1980 --tipo ECG
+    python cli_exames.py atualizar 12 --tipo TAC
+    python cli_exames.py apagar 12 13
+    python cli_exames.py replanear [--tipo ECG] [--processos 4]
+    python cli_exames.py exportar exames.csv [--termo pendente]
+    python cli_exames.py importar lista.csv
+    python cli_exames.py estatisticas
+    python cli_exames.py analise [--dias 28]     (precisa do NumPy)
+    python cli_exames.py migrar-sqlite
+
+Com --armazenamento json|sqlite escolhe-se onde estão os exames (por omissão, o ARMAZENAMENTO do núcleo).
+Com --json, os exames são escritos em JSON em vez de uma tabela de texto.
+Com --medicoes FICHEIRO grava no fim as medições (chamadas, durações, registos) em JSON, e com
+--perfil FICHEIRO o perfil cProfile do comando (ex.: python -m pstats FICHEIRO).
+"""
+
+import argparse
+import json
+import sys
+
+from nucleo_exames import (
+    CAMPOS_EXAME, FICHEIRO_EXAMES, FICHEIRO_SQLITE, TIPOS_EXAME,
+    ErroExames, ServicoExames,
+    criar_armazenamento, migrar_json_para_sqlite, valores_linha,
+    ativar_medicoes, gravar_medicoes, iniciar_perfil, parar_perfil,
+)
+from analise_exames import DIAS_OCUPACAO, analisar
+
+# =================== SAÍDA ===================
+
+COLUNAS_TEXTO = ["Nº", "Paciente", "Utente", "Nascimento", "Tipo", "Registo", "Data", "Hora", "Espera", "Estado"]
+
+
+def escrever_exames(exames, em_json):
+    """Escreve os exames no ecrã: em JSON ou numa tabela separada por tabs."""
+    if em_json:
+        json.dump([{campo: exame.get(campo) for campo in CAMPOS_EXAME} for exame in exames],
+                  sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    linhas = ["\t".join(COLUNAS_TEXTO)]
+    for exame in exames:
+        linhas.append("\t".join(str(valor) for valor in valores_linha(exame)))
+    sys.stdout.write("\n".join(linhas) + "\n")
+
+# =================== COMANDOS ===================
+
+def comando_listar(servico, args):
+    escrever_exames(servico.pesquisar(args.termo), args.json)
+
+
+def comando_mostrar(servico, args):
+    servico.atualizar_estados()
+    escrever_exames([servico.obter(args.num)], args.json)
+
+
+def comando_criar(servico, args):
+    exame = servico.criar(args.paciente, args.utente, args.nascimento, args.tipo, args.registo, args.num)
+    print(f"Exame #{exame['num']} registado com sucesso ({exame['data_marcada']} às {exame['hora_marcada']}).")
+
+
+def comando_atualizar(servico, args):
+    exame = servico.obter(args.num)
+    exame = servico.atualizar(
+        args.num,
+        args.paciente if args.paciente is not None else exame.get("paciente", ""),
+        args.utente if args.utente is not None else exame.get("utente", ""),
+        args.nascimento if args.nascimento is not None else exame.get("nascimento", ""),
+        args.tipo if args.tipo is not None else exame.get("tipo", ""),
+        args.registo,
+    )
+    print(f"Exame #{exame['num']} atualizado com sucesso ({exame['data_marcada']} às {exame['hora_marcada']}).")
+
+
+def comando_apagar(servico, args):
+    removidos = servico.apagar(args.nums)
+    print(f"{len(removidos)} exame(s) removido(s).")
+
+
+def comando_replanear(servico, args):
+    alterados = servico.replanear([args.tipo] if args.tipo else None, processos=args.processos)
+    print(f"{len(alterados)} exame(s) remarcado(s).")
+
+
+def comando_exportar(servico, args):
+    exames = servico.pesquisar(args.termo) if args.termo else None
+    quantos = servico.exportar_csv(args.caminho, exames)
+    print(f"{quantos} exames exportados para {args.caminho}.")
+
+
+def comando_importar(servico, args):
+    novos, rejeitados = servico.importar_ficheiro(args.caminho)
+    print(f"{len(novos)} exames importados, {len(rejeitados)} linhas rejeitadas.")
+    for posicao, motivo in rejeitados:
+        print(f"Linha {posicao}: {motivo}", file=sys.stderr)
+
+
+def comando_estatisticas(servico, args):
+    servico.atualizar_estados()
+    total, aprovados, pendentes = servico.contagens()
+    print(f"Total de exames: {total} | Aprovados: {aprovados} | Pendentes: {pendentes}")
+
+
+def comando_analise(servico, args):
+    resultado = analisar(servico, dias=args.dias)
+    if args.json:
+        json.dump(resultado, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    print(f"Hoje: {resultado['hoje']} | Exames: {resultado['total']}")
+    print("\nEspera dos pendentes (dias)")
+    print("\t".join(["Tipo", "Pendentes", "Média", "p50", "p90", "p95", "Último dia"]))
+    for tipo, espera in resultado["espera_por_tipo"].items():
+        print("\t".join(str(valor) for valor in (
+            tipo, espera["pendentes"], espera["media"], espera["p50"], espera["p90"], espera["p95"], espera["ultimo_dia"]
+        )))
+    print("\nOcupação por semana")
+    print("\t".join(["Semana", "Marcados", "Capacidade", "Ocupação"]))
+    for semana in resultado["ocupacao_por_semana"]:
+        print(f"{semana['semana']}\t{semana['marcados']}\t{semana['capacidade']}\t{semana['ocupacao']:.0%}")
+
+
+def comando_migrar_sqlite(args):
+    quantos = migrar_json_para_sqlite(FICHEIRO_EXAMES, FICHEIRO_SQLITE)
+    print(f"{quantos} exames migrados de {FICHEIRO_EXAMES} para {FICHEIRO_SQLITE}.")
+
+# =================== ARGUMENTOS ===================
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="Gestor de Exames Clínicos (linha de comandos)")
+    parser.add_argument("--armazenamento", choices=["json", "sqlite"], default=None,
+                        help="onde estão os exames (por omissão, o configurado no núcleo)")
+    parser.add_argument("--json", action="store_true", help="escrever os exames em JSON")
+    parser.add_argument("--medicoes", metavar="FICHEIRO", help="gravar as medições do comando neste JSON")
+    parser.add_argument("--perfil", metavar="FICHEIRO", help="gravar o perfil cProfile do comando")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    listar = comandos.add_parser("listar", help="lista os exames (por data e hora)")
+    listar.add_argument("--termo", default="", help="nome, tipo, nº de utente ou estado")
+    listar.set_defaults(funcao=comando_listar)
+
+    mostrar = comandos.add_parser("mostrar", help="mostra um exame")
+    mostrar.add_argument("num")
+    mostrar.set_defaults(funcao=comando_mostrar)
+
+    criar = comandos.add_parser("criar", help="regista um exame novo (marcado na primeira vaga livre)")
+    criar.add_argument("--paciente", required=True)
+    criar.add_argument("--utente", required=True)
+    criar.add_argument("--nascimento", required=True, help="dd-mm-yyyy")
+    criar.add_argument("--tipo", required=True, choices=TIPOS_EXAME)
+    criar.add_argument("--registo", default=None, help="data de registo (por omissão, hoje)")
+    criar.add_argument("--num", type=int, default=None, help="nº do exame (por omissão, o seguinte)")
+    criar.set_defaults(funcao=comando_criar)
+
+    atualizar = comandos.add_parser("atualizar", help="altera um exame (e volta a marcá-lo)")
+    atualizar.add_argument("num")
+    atualizar.add_argument("--paciente")
+    atualizar.add_argument("--utente")
+    atualizar.add_argument("--nascimento", help="dd-mm-yyyy")
+    atualizar.add_argument("--tipo", choices=TIPOS_EXAME)
+    atualizar.add_argument("--registo", default=None)
+    atualizar.set_defaults(funcao=comando_atualizar)
+
+    apagar = comandos.add_parser("apagar", help="apaga exames")
+    apagar.add_argument("nums", nargs="+")
+    apagar.set_defaults(funcao=comando_apagar)
+
+    replanear = comandos.add_parser("replanear", help="replaneia os exames futuros")
+    replanear.add_argument("--tipo", choices=TIPOS_EXAME, help="só este tipo (por omissão, todos)")
+    replanear.add_argument("--processos", type=int,
+                           help="processos para calcular os tipos em paralelo (por omissão, um por CPU)")
+    replanear.set_defaults(funcao=comando_replanear)
+
+    exportar = comandos.add_parser("exportar", help="exporta para CSV")
+    exportar.add_argument("caminho")
+    exportar.add_argument("--termo", default="", help="exportar só os exames filtrados")
+    exportar.set_defaults(funcao=comando_exportar)
+
+    importar = comandos.add_parser("importar", help="importa uma lista de exames (CSV ou JSON)")
+    importar.add_argument("caminho")
+    importar.set_defaults(funcao=comando_importar)
+
+    estatisticas = comandos.add_parser("estatisticas", help="total, aprovados e pendentes")
+    estatisticas.set_defaults(funcao=comando_estatisticas)
+
+    analise = comandos.add_parser("analise", help="espera por tipo, ocupação e antecedência (precisa do NumPy)")
+    analise.add_argument("--dias", type=int, default=DIAS_OCUPACAO, help="dias de ocupação a partir de hoje")
+    analise.set_defaults(funcao=comando_analise)
+
+    migrar = comandos.add_parser("migrar-sqlite", help=f"copia o {FICHEIRO_EXAMES} para o {FICHEIRO_SQLITE}")
+    migrar.set_defaults(funcao=None)
+
+    return parser
+
+
+def main(argv=None):
+    args = criar_parser().parse_args(argv)
+
+    if args.comando == "migrar-sqlite":
+        try:
+            comando_migrar_sqlite(args)
+        except ErroExames as e:
+            print(f"Erro: {e}", file=sys.stderr)
+            return 1
+        return 0
+
+    if args.medicoes:
+        ativar_medicoes()
+    if args.perfil:
+        iniciar_perfil()
+    try:
+        armazenamento = criar_armazenamento(args.armazenamento)   # o SQLite novo migra o JSON
+    except ErroExames as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 1
+    try:
+        servico = ServicoExames(armazenamento)
+        args.funcao(servico, args)
+        if args.perfil:
+            parar_perfil(args.perfil)
+        if args.medicoes:
+            gravar_medicoes(args.medicoes)
+    except ErroExames as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 1
+    finally:
+        armazenamento.fechar()   # espera por uma compactação do diário que esteja a decorrer
+    return 0
+
+# =================== EXECUTAR ===================
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,645 @@
+"""
+Gestor de Exames Clínicos - testes de desempenho (sem interface gráfica).
+
+Gera os exames com o gerador_exames.py (sempre com a mesma semente) e mede, para cada tamanho, os
+casos de cada conjunto (CONJUNTOS, cada um com os seus tamanhos por omissão):
+    base
+        carregar    ler o ficheiro e montar os índices (ServicoExames)
+        gravar      gravar a lista completa
+        marcar      MARCACOES exames novos, um a um (motor de agendamento e índices, sem gravar)
+        replanear   replanear todos os tipos (os exames gerados têm vagas vazias no futuro)
+        pesquisar   os TERMOS_PESQUISA, um a seguir ao outro
+        ordenar     metade dos exames por cada coluna de COLUNAS_ORDEM
+        exportar    todos os exames para CSV
+    marcacao (latência de uma marcação; cada tempo é o de um só exame)
+        marcar_um   registar um exame: vaga, índices e replaneamento do tipo (sem gravar)
+        vaga        só procurar a primeira vaga livre (primeira_marcacao_livre com o índice)
+    tabela (o trabalho de atualizar_tabela da interface, sem desenhar: a tabela é virtual nestes tamanhos)
+        tabela          depois de alterar um exame: pesquisa vazia ordenada por data, contagens
+                        do rodapé e os valores das LINHAS_TABELA linhas visíveis
+        tabela_termo    o mesmo, com um termo de pesquisa (TERMOS_PESQUISA[0])
+        tabela_coluna   o mesmo, sem alterações, mudando a coluna da ordenação (COLUNAS_ORDEM)
+    importar
+        importar        importar de uma vez metade do tamanho em linhas novas (FRACAO_INVALIDAS delas
+                        inválidas), com a marcação e o replaneamento por tipo, sem gravar
+    numero (pelo nº do exame; cada tempo de obter e de editar é o de um só exame)
+        obter           procurar um exame pelo nº (ServicoExames.obter)
+        editar          Guardar um exame que já existe (ServicoExames.guardar), sem gravar
+        apagar_mil      apagar APAGADOS exames de uma vez, com o replaneamento, sem gravar
+    memoria (registos: dicionários, como o json.load os dá, contra Exame)
+        memoria         bytes por exame (tracemalloc) das duas formas; fica em "memoria", não nos tempos
+        datas_strptime  ler a data marcada de todos os exames com datetime.strptime
+        datas_ordinal   o mesmo com o leitor de datas do núcleo (nº do dia, com as datas já lidas guardadas)
+        estados_dict    atualizar_estados com os exames em dicionários
+        estados_exame   atualizar_estados com os exames em Exame
+    processos (replaneamento de todos os tipos em paralelo, com o nº de processos de --processos)
+        replanear_pN    ServicoExames.replanear(processos=N), com o paralelo ligado mesmo abaixo de
+                        MINIMO_REPLANEAMENTO_PARALELO (N = 1: sempre no próprio processo)
+        limiar_paralelo o cálculo (replanear_fila) de todos os tipos num processo e o custo de arrancar
+                        N processos e lhes dar uma tarefa vazia; daí sai o nº de exames a replanear a
+                        partir do qual N processos compensam, com um tipo por CPU; fica em "processos"
+
+Cada caso é repetido (--repeticoes) e guarda-se o mínimo e a mediana. Cada execução acrescenta uma
+linha JSON a FICHEIRO_RESULTADOS, com a versão (commit do git), o Python e a máquina, e no fim
+é comparada com a execução anterior com os mesmos parâmetros: as regressões ficam à vista.
+
+    python desempenho_exames.py                                      # conjunto base: 1000 e 100000 exames, em JSON
+    python desempenho_exames.py --tamanhos 1000 100000 1000000 --armazenamento sqlite
+    python desempenho_exames.py --casos carregar gravar --repeticoes 5 --falhar-se-regredir
+    python desempenho_exames.py --conjuntos marcacao                 # 1000, 10000, 100000 e 500000 exames
+    python desempenho_exames.py --conjuntos tabela                   # 10000 e 100000 exames
+    python desempenho_exames.py --conjuntos importar                 # 100000 linhas para 200000 exames
+    python desempenho_exames.py --conjuntos numero                   # 1000000 exames
+    python desempenho_exames.py --conjuntos memoria                  # 100000 e 300000 exames
+    python desempenho_exames.py --conjuntos processos --processos 1 2 4 8   # 1000000 exames
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import nucleo_exames
+from nucleo_exames import (
+    FORMATO_DATA, TIPOS_EXAME, ArmazenamentoJSON, ArmazenamentoSQLite, ErroExames, Exame, ServicoExames,
+    atualizar_estados, dia_inicial_marcacao, ler_dados, numero_do_dia, primeira_marcacao_livre, valores_linha,
+)
+from gerador_exames import gerar_exames, gravar_exames_gerados
+
+# =================== CONFIGURAÇÃO ===================
+
+# conjunto -> (tamanhos por omissão, casos)
+CONJUNTOS = {
+    "base": ([1000, 100000], ["carregar", "gravar", "marcar", "replanear", "pesquisar", "ordenar", "exportar"]),
+    "marcacao": ([1000, 10000, 100000, 500000], ["marcar_um", "vaga"]),
+    "tabela": ([10000, 100000], ["tabela", "tabela_termo", "tabela_coluna"]),
+    "importar": ([200000], ["importar"]),
+    "numero": ([1000000], ["obter", "editar", "apagar_mil"]),
+    "memoria": ([100000, 300000], ["memoria", "datas_strptime", "datas_ordinal", "estados_dict", "estados_exame"]),
+    "processos": ([1000000], ["replanear_processos", "limiar_paralelo"]),
+}
+CONJUNTOS_POR_OMISSAO = ["base"]
+CASOS = [caso for _, casos in CONJUNTOS.values() for caso in casos]
+CASOS_SEM_TEMPO = {"memoria": "memoria", "limiar_paralelo": "processos"}   # caso -> chave onde fica na execução
+REPETICOES = 3
+SEMENTE = 1
+
+MARCACOES = 100
+TERMOS_PESQUISA = ["silva", "maria santos", "ecg", "pendente", "9123", "sem resultados"]
+COLUNAS_ORDEM = ["num", "paciente", "utente", "tipo", "data_registo", "data_marcada"]
+LINHAS_TABELA = 50   # linhas visíveis mais a margem, como as da tabela virtual
+FRACAO_INVALIDAS = 0.12   # linhas importadas com um utente, uma data ou um tipo inválido
+OBTIDOS = 1000      # exames procurados pelo nº em cada repetição
+EDITADOS = 5        # exames editados em cada repetição
+APAGADOS = 1000
+PROCESSOS = None    # nºs de processos do conjunto processos (None: de 1 até ao nº de CPUs, pelo menos 1 e 2)
+
+FICHEIRO_RESULTADOS = "resultados_desempenho.jsonl"
+
+# Mais lento do que a execução anterior nesta fração (mínimo contra mínimo) e em mais de
+# MINIMO_REGRESSAO segundos: é uma regressão (abaixo disso é ruído, sobretudo nos tamanhos pequenos)
+LIMIAR_REGRESSAO = 0.2
+MINIMO_REGRESSAO = 0.02
+
+# =================== ARMAZENAMENTO EM MEMÓRIA ===================
+
+class _ArmazenamentoMemoria:
+    """
+    Armazenamento que não grava nada: para medir marcar, replanear, pesquisar e ordenar sem o tempo
+    da gravação (que tem o seu próprio caso). Os números novos vêm a seguir ao maior que já foi dado.
+    """
+
+    def __init__(self):
+        self._ultimo = 0
+
+    def ler(self):
+        return []
+
+    def gravar_tudo(self, exames):
+        pass
+
+    def gravar_alteracoes(self, exames, alterados, removidos):
+        pass
+
+    def reservar_numeros(self, quantos=1, minimo=1):
+        primeiro = max(self._ultimo + 1, minimo)
+        self._ultimo = primeiro + quantos - 1
+        return primeiro
+
+# =================== CASOS ===================
+
+def _medir(funcao, repeticoes, preparar=None):
+    """Tempos (s) de repeticoes chamadas a funcao(); preparar() corre antes de cada uma, fora do tempo."""
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar is not None:
+            preparar()
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return tempos
+
+
+def _servico_em_memoria(gerados):
+    """ServicoExames (sem gravar nada) com os exames gerados; os números novos vêm a seguir ao maior."""
+    servico = ServicoExames(_ArmazenamentoMemoria(), carregar=False)
+    servico.definir_exames([Exame.de_dict(exame) for exame in gerados])
+    servico.armazenamento.reservar_numeros(0, max((e["num"] for e in gerados), default=0) + 1)
+    return servico
+
+
+def _medir_base(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    quantos = len(gerados)
+    caminho = os.path.join(pasta, f"exames_{quantos}." + ("db" if armazenamento == "sqlite" else "json"))
+    gravar_exames_gerados(gerados, caminho)
+
+    real = ArmazenamentoSQLite(caminho) if armazenamento == "sqlite" else ArmazenamentoJSON(caminho)
+    memoria = _ArmazenamentoMemoria()
+    servico = ServicoExames(memoria, carregar=False)
+    resultados = {}
+
+    def recarregar():
+        servico.definir_exames(ler_dados(real))
+
+    def marcar():
+        for i in range(MARCACOES):
+            servico.criar(f"Teste Desempenho {i}", "123456789", "01-01-1980", TIPOS_EXAME[i % len(TIPOS_EXAME)])
+
+    def pesquisar():
+        for termo in TERMOS_PESQUISA:
+            servico.pesquisar(termo)
+
+    def ordenar():
+        # metade dos exames: um resultado de pesquisa (a lista toda ordenada fica guardada no índice)
+        metade = servico.exames[::2]
+        for coluna in COLUNAS_ORDEM:
+            servico.ordenar(metade, coluna)
+
+    try:
+        carregado = []
+
+        def carregar():
+            carregado[:] = [ServicoExames(real)]
+
+        if "carregar" in casos:
+            resultados["carregar"] = _medir(carregar, repeticoes)
+        if "gravar" in casos:
+            if not carregado:
+                carregar()
+            resultados["gravar"] = _medir(carregado[0].gravar, repeticoes)
+        del carregado[:]
+
+        recarregar()
+        memoria.reservar_numeros(0, max((e["num"] for e in servico.exames), default=0) + 1)
+        if "pesquisar" in casos:
+            resultados["pesquisar"] = _medir(pesquisar, repeticoes)
+        if "ordenar" in casos:
+            resultados["ordenar"] = _medir(ordenar, repeticoes)
+        if "exportar" in casos:
+            csv = os.path.join(pasta, f"exames_{quantos}.csv")
+            resultados["exportar"] = _medir(lambda: servico.exportar_csv(csv), repeticoes)
+        if "marcar" in casos:
+            resultados["marcar"] = _medir(marcar, repeticoes)
+        if "replanear" in casos:
+            resultados["replanear"] = _medir(servico.replanear, repeticoes, preparar=recarregar)
+    finally:
+        real.fechar()
+    return resultados
+
+
+def _medir_marcacao(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    """
+    Latência de uma marcação: cada tempo é o de um só exame (MARCACOES exames por repetição, a começar
+    sempre dos exames gerados). O mínimo e a mediana são, por isso, por exame.
+    """
+    resultados = {}
+    if "marcar_um" in casos:
+        tempos = []
+        for _ in range(repeticoes):
+            servico = _servico_em_memoria(gerados)
+            for i in range(MARCACOES):
+                tipo = TIPOS_EXAME[i % len(TIPOS_EXAME)]
+                tempos += _medir(lambda: servico.criar(f"Teste Desempenho {i}", "123456789", "01-01-1980", tipo), 1)
+        resultados["marcar_um"] = tempos
+    if "vaga" in casos:
+        servico = _servico_em_memoria(gerados)
+        inicio = dia_inicial_marcacao()
+        tempos = []
+        for _ in range(repeticoes):
+            for tipo in TIPOS_EXAME:
+                tempos += _medir(lambda: primeira_marcacao_livre(servico.exames, tipo, inicio, indice=servico.indice), 1)
+        resultados["vaga"] = tempos
+    return resultados
+
+
+def _medir_tabela(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    """
+    O que atualizar_tabela faz fora da Treeview: pesquisar (com os estados em dia), contar e tirar
+    os valores das linhas visíveis. Antes de cada repetição (fora do tempo) altera-se um exame, como
+    depois de um Guardar, exceto em tabela_coluna, que é só um clique no cabeçalho.
+    """
+    servico = _servico_em_memoria(gerados)
+    exames = servico.exames
+    colunas = iter(COLUNAS_ORDEM * repeticoes)
+    alterar = iter(range(repeticoes * len(casos)))
+
+    def alterar_um():
+        exame = exames[next(alterar) * 7919 % len(exames)]
+        servico.atualizar(exame["num"], exame["paciente"] + " Alterado", exame["utente"],
+                          exame["nascimento"], exame["tipo"])
+
+    def atualizar(termo, coluna=None):
+        resultado = servico.pesquisar(termo, coluna)
+        servico.contagens()
+        for exame in resultado[:LINHAS_TABELA]:
+            valores_linha(exame)
+
+    resultados = {}
+    if "tabela" in casos:
+        resultados["tabela"] = _medir(lambda: atualizar(""), repeticoes, preparar=alterar_um)
+    if "tabela_termo" in casos:
+        resultados["tabela_termo"] = _medir(lambda: atualizar(TERMOS_PESQUISA[0]), repeticoes, preparar=alterar_um)
+    if "tabela_coluna" in casos:
+        resultados["tabela_coluna"] = _medir(lambda: atualizar("", next(colunas)), repeticoes)
+    return resultados
+
+
+def linhas_para_importar(quantas, semente):
+    """
+    quantas linhas (dicionários, como as de um CSV importado) de pacientes gerados com outra semente;
+    uma fração FRACAO_INVALIDAS delas tem um campo estragado, alternando entre utente, nascimento e tipo.
+    """
+    linhas = []
+    invalidas = round(1 / FRACAO_INVALIDAS) if FRACAO_INVALIDAS else 0
+    for i, exame in enumerate(gerar_exames(quantas, semente + 1)):
+        linha = {campo: exame[campo] for campo in ("paciente", "utente", "nascimento", "tipo", "data_registo")}
+        if invalidas and i % invalidas == 0:
+            campo = ("utente", "nascimento", "tipo")[i // invalidas % 3]
+            linha[campo] = "??"
+        linhas.append(linha)
+    return linhas
+
+
+def _medir_importar(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    """importar (ServicoExames.importar): cada repetição parte dos exames gerados, montados fora do tempo."""
+    linhas = linhas_para_importar(len(gerados) // 2, semente)
+    servico = []
+
+    def preparar():
+        servico[:] = [_servico_em_memoria(gerados)]
+
+    return {"importar": _medir(lambda: servico[0].importar(linhas), repeticoes, preparar=preparar)}
+
+
+def _medir_numero(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    """
+    obter, editar e apagar_mil, com nºs espalhados por todos os exames (sempre os mesmos para a
+    mesma semente). apagar_mil parte dos exames gerados em cada repetição (montados fora do tempo).
+    """
+    aleatorio = random.Random(semente)
+    nums = [exame["num"] for exame in gerados]
+    servico = [_servico_em_memoria(gerados)]
+    resultados = {}
+
+    if "obter" in casos:
+        tempos = []
+        for _ in range(repeticoes):
+            for num in aleatorio.sample(nums, min(OBTIDOS, len(nums))):
+                tempos += _medir(lambda: servico[0].obter(num), 1)
+        resultados["obter"] = tempos
+    if "editar" in casos:
+        tempos = []
+        for _ in range(repeticoes):
+            for num in aleatorio.sample(nums, min(EDITADOS, len(nums))):
+                exame = servico[0].obter(num)
+                dados = (exame["paciente"] + " Alterado", exame["utente"], exame["nascimento"], exame["tipo"])
+                tempos += _medir(lambda: servico[0].guardar(*dados, num=num), 1)
+        resultados["editar"] = tempos
+    if "apagar_mil" in casos:
+        apagar = aleatorio.sample(nums, min(APAGADOS, len(nums)))
+
+        def preparar():
+            servico[:] = []   # para não ter dois milhões de exames em memória ao mesmo tempo
+            servico[:] = [_servico_em_memoria(gerados)]
+
+        resultados["apagar_mil"] = _medir(lambda: servico[0].apagar(apagar), repeticoes, preparar=preparar)
+    return resultados
+
+
+def bytes_por_exame(criar, quantos):
+    """Memória (tracemalloc) que fica ocupada pelo que criar() devolve, a dividir por quantos exames."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        antes = tracemalloc.get_traced_memory()[0]
+        criados = criar()
+        depois = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del criados
+    return round((depois - antes) / quantos) if quantos else 0
+
+
+def _medir_memoria(gerados, pasta, armazenamento, casos, repeticoes, semente):
+    """
+    As duas formas são lidas do mesmo texto JSON, como de um ficheiro: conta só o que fica em memória
+    (os dicionários de onde saem os Exame já foram libertados, as strings que eles guardam não).
+    """
+    texto = json.dumps(gerados)
+    dicionarios = json.loads(texto)
+    datas = [exame["data_marcada"] for exame in gerados]
+    resultados = {}
+
+    if "memoria" in casos:
+        resultados["memoria"] = {
+            "dict_bytes_por_exame": bytes_por_exame(lambda: json.loads(texto), len(gerados)),
+            "exame_bytes_por_exame": bytes_por_exame(lambda: [Exame.de_dict(e) for e in json.loads(texto)], len(gerados)),
+        }
+    if "datas_strptime" in casos:
+        resultados["datas_strptime"] = _medir(
+            lambda: [datetime.strptime(data, FORMATO_DATA).date().toordinal() for data in datas], repeticoes
+        )
+    if "datas_ordinal" in casos:
+        resultados["datas_ordinal"] = _medir(lambda: [numero_do_dia(data) for data in datas], repeticoes)
+    if "estados_dict" in casos:
+        resultados["estados_dict"] = _medir(lambda: atualizar_estados(dicionarios), repeticoes)
+    if "estados_exame" in casos:
+        registos = [Exame.de_dict(e) for e in dicionarios]
+        resultados["estados_exame"] = _medir(lambda: atualizar_estados(registos), repeticoes)
+    return resultados
+
+
+def _medir_processos(gerados, pasta, armazenamento, casos, repeticoes, semente, processos=None):
+    if processos is None:
+        processos = PROCESSOS or list(range(1, max(2, os.cpu_count() or 1) + 1))
+    servico = [_servico_em_memoria(gerados)]
+    resultados = {}
+
+    def recarregar():
+        servico[:] = []
+        servico[:] = [_servico_em_memoria(gerados)]
+
+    if "replanear_processos" in casos:
+        minimo = nucleo_exames.MINIMO_REPLANEAMENTO_PARALELO
+        nucleo_exames.MINIMO_REPLANEAMENTO_PARALELO = 0
+        try:
+            for n in processos:
+                resultados[f"replanear_p{n}"] = _medir(
+                    lambda: servico[0].replanear(processos=n), repeticoes, preparar=recarregar
+                )
+        finally:
+            nucleo_exames.MINIMO_REPLANEAMENTO_PARALELO = minimo
+        recarregar()
+
+    if "limiar_paralelo" in casos:
+        resultados["limiar_paralelo"] = limiar_paralelo(servico[0], processos, repeticoes)
+    return resultados
+
+
+def limiar_paralelo(servico, processos, repeticoes):
+    """
+    A partir de quantos exames a replanear compensa usar n processos: quando o cálculo que se poupa
+    (calculo * (1 - 1/n), com um tipo por CPU) passa o custo de arrancar os n processos.
+    Devolve um dicionário com as medidas e o limiar de cada n > 1.
+    """
+    filas = [preparado[1] for preparado in (
+        nucleo_exames._preparar_replaneamento(tipo, servico.indice) for tipo in TIPOS_EXAME
+    ) if preparado is not None]
+    a_replanear = sum(len(fila[3]) for fila in filas)
+    calculo = min(_medir(lambda: [nucleo_exames.replanear_fila(*fila) for fila in filas], repeticoes))
+    medidas = {"a_replanear": a_replanear, "calculo_s": round(calculo, 6), "arranque_s": {}, "limiar": {}}
+
+    vazia = (1, 1, dia_inicial_marcacao().toordinal(), array("i"), array("B"))
+    contexto = multiprocessing.get_context(nucleo_exames.INICIO_PROCESSOS_REPLANEAMENTO)
+
+    def arrancar(n):
+        with ProcessPoolExecutor(n, mp_context=contexto) as executor:
+            list(executor.map(nucleo_exames._replanear_fila_no_processo, [vazia] * n))
+
+    for n in processos:
+        if n < 2:
+            continue
+        arranque = min(_medir(lambda: arrancar(n), repeticoes))
+        medidas["arranque_s"][str(n)] = round(arranque, 6)
+        if calculo > 0 and a_replanear > 0:
+            medidas["limiar"][str(n)] = round(arranque / (calculo / a_replanear * (1 - 1 / n)))
+    return medidas
+
+
+_MEDIR_CONJUNTO = {
+    "base": _medir_base,
+    "marcacao": _medir_marcacao,
+    "tabela": _medir_tabela,
+    "importar": _medir_importar,
+    "numero": _medir_numero,
+    "memoria": _medir_memoria,
+    "processos": _medir_processos,
+}
+
+
+def medir_tamanho(quantos, pasta, armazenamento, casos, repeticoes, semente, processos=None):
+    """
+    Gera quantos exames e mede os casos pedidos (os ficheiros ficam em pasta). Devolve {caso: [tempos]}
+    (replanear_processos dá um replanear_pN por cada nº de processos), exceto nos CASOS_SEM_TEMPO,
+    em que o valor é o dicionário com as medidas.
+    """
+    inicio = time.perf_counter()
+    gerados = gerar_exames(quantos, semente)
+    print(f"{quantos} exames gerados em {time.perf_counter() - inicio:.1f} s")
+
+    resultados = {}
+    for conjunto, (_, casos_conjunto) in CONJUNTOS.items():
+        pedidos = [caso for caso in casos if caso in casos_conjunto]
+        if pedidos:
+            opcoes = {"processos": processos} if conjunto == "processos" else {}
+            resultados.update(_MEDIR_CONJUNTO[conjunto](gerados, pasta, armazenamento, pedidos, repeticoes, semente,
+                                                        **opcoes))
+    return resultados
+
+
+def planear(conjuntos, tamanhos=None, casos=None):
+    """
+    {tamanho: [casos]} a medir, por ordem de tamanho: os casos dos conjuntos (só os de casos, se for dado)
+    nos tamanhos de cada conjunto (ou em tamanhos, se for dado).
+    """
+    plano = {}
+    for conjunto in conjuntos:
+        tamanhos_conjunto, casos_conjunto = CONJUNTOS[conjunto]
+        for quantos in tamanhos or tamanhos_conjunto:
+            for caso in casos_conjunto:
+                if (casos is None or caso in casos) and caso not in plano.setdefault(quantos, []):
+                    plano[quantos].append(caso)
+    return {quantos: plano[quantos] for quantos in sorted(plano) if plano[quantos]}
+
+# =================== RESULTADOS ===================
+
+def versao():
+    """Commit do git em que está o código (com "+" se houver alterações que ainda não têm commit), ou None."""
+    pasta = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=pasta, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        alterado = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=pasta,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if alterado else "")
+
+
+def resumir(tempos):
+    return {
+        "minimo_s": round(min(tempos), 9),
+        "mediana_s": round(statistics.median(tempos), 9),
+        "tempos_s": [round(t, 9) for t in tempos],
+    }
+
+
+def ler_execucoes(caminho):
+    """As execuções já gravadas em caminho (as linhas que não forem JSON são ignoradas)."""
+    execucoes = []
+    try:
+        with open(caminho, encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    execucoes.append(json.loads(linha))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return execucoes
+
+
+def execucao_anterior(execucoes, atual):
+    """
+    A última execução com o mesmo armazenamento e semente e com algum caso (no mesmo tamanho) em comum
+    com a atual (None se não houver).
+    """
+    medidos = {(tamanho, caso) for tamanho, casos in atual["resultados"].items() for caso in casos}
+    for execucao in reversed(execucoes):
+        if execucao.get("armazenamento") != atual["armazenamento"] or execucao.get("semente") != atual["semente"]:
+            continue
+        if any((tamanho, caso) in medidos for tamanho, casos in execucao.get("resultados", {}).items()
+               for caso in casos):
+            return execucao
+    return None
+
+
+def comparar(anterior, atual, limiar=LIMIAR_REGRESSAO):
+    """
+    Linhas (tamanho, caso, mínimo antes, mínimo agora, variação, regrediu) dos casos que estão nas
+    duas execuções. A variação é (agora - antes) / antes; regrediu se passar do limiar e o tempo
+    tiver aumentado mais de MINIMO_REGRESSAO segundos.
+    """
+    linhas = []
+    for tamanho, casos in atual["resultados"].items():
+        for caso, medido in casos.items():
+            antes = anterior.get("resultados", {}).get(tamanho, {}).get(caso)
+            if not antes or not antes["minimo_s"]:
+                continue
+            agora = medido["minimo_s"]
+            variacao = (agora - antes["minimo_s"]) / antes["minimo_s"]
+            regrediu = variacao > limiar and agora - antes["minimo_s"] > MINIMO_REGRESSAO
+            linhas.append((tamanho, caso, antes["minimo_s"], agora, variacao, regrediu))
+    return linhas
+
+# =================== EXECUTAR ===================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Testes de desempenho do Gestor de Exames Clínicos")
+    parser.add_argument("--conjuntos", nargs="+", choices=list(CONJUNTOS), default=None,
+                        help=f"por omissão {' '.join(CONJUNTOS_POR_OMISSAO)} (ou os conjuntos dos --casos pedidos)")
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=None,
+                        help="nº de exames de cada teste (por omissão, os de cada conjunto)")
+    parser.add_argument("--casos", nargs="+", choices=CASOS, default=None)
+    parser.add_argument("--repeticoes", type=int, default=REPETICOES)
+    parser.add_argument("--processos", type=int, nargs="+", default=PROCESSOS,
+                        help="nºs de processos do conjunto processos (por omissão, de 1 até ao nº de CPUs)")
+    parser.add_argument("--semente", type=int, default=SEMENTE)
+    parser.add_argument("--armazenamento", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--resultados", default=FICHEIRO_RESULTADOS, help="ficheiro onde acrescentar os resultados")
+    parser.add_argument("--pasta", default=None, help="onde gravar os exames gerados (por omissão, uma temporária)")
+    parser.add_argument("--falhar-se-regredir", action="store_true",
+                        help=f"terminar com erro se algum caso ficar {LIMIAR_REGRESSAO:.0%} mais lento")
+    args = parser.parse_args(argv)
+    if args.repeticoes < 1 or min(args.tamanhos or [1]) < 1 or min(args.processos or [1]) < 1:
+        parser.error("as repetições, os tamanhos e os processos têm de ser positivos")
+    conjuntos = args.conjuntos
+    if conjuntos is None:
+        conjuntos = CONJUNTOS_POR_OMISSAO if args.casos is None else [
+            conjunto for conjunto, (_, casos) in CONJUNTOS.items() if set(casos) & set(args.casos)
+        ]
+    plano = planear(conjuntos, args.tamanhos, args.casos)
+    if not plano:
+        parser.error("nenhum dos casos pedidos está nesses conjuntos")
+
+    execucao = {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "versao": versao(),
+        "python": platform.python_version(),
+        "sistema": platform.platform(),
+        "cpus": os.cpu_count(),
+        "armazenamento": args.armazenamento,
+        "semente": args.semente,
+        "repeticoes": args.repeticoes,
+        "resultados": {},
+        "memoria": {},
+        "processos": {},
+    }
+    print(f"Versão {execucao['versao']} | Python {execucao['python']} | {execucao['cpus']} CPU | "
+          f"{args.armazenamento} | semente {args.semente} | {args.repeticoes} repetições")
+
+    temporaria = tempfile.TemporaryDirectory() if args.pasta is None else None
+    pasta = args.pasta if args.pasta is not None else temporaria.name
+    try:
+        for quantos, casos in plano.items():
+            try:
+                tempos = medir_tamanho(quantos, pasta, args.armazenamento, casos, args.repeticoes, args.semente,
+                                       args.processos)
+            except ErroExames as e:
+                print(f"Erro: {e}", file=sys.stderr)
+                return 1
+            execucao["resultados"][str(quantos)] = {
+                caso: resumir(t) for caso, t in tempos.items() if caso not in CASOS_SEM_TEMPO
+            }
+            for caso, medido in execucao["resultados"][str(quantos)].items():
+                print(f"  {quantos:>8d} {caso:14s} mínimo {medido['minimo_s'] * 1000:10.3f} ms"
+                      f"   mediana {medido['mediana_s'] * 1000:10.3f} ms")
+            for caso, chave in CASOS_SEM_TEMPO.items():
+                if caso in tempos:
+                    execucao[chave][str(quantos)] = tempos[caso]
+                    medidas = " | ".join(f"{nome} {valor}" for nome, valor in tempos[caso].items())
+                    print(f"  {quantos:>8d} {caso:14s} {medidas}")
+    finally:
+        if temporaria is not None:
+            temporaria.cleanup()
+
+    anterior = execucao_anterior(ler_execucoes(args.resultados), execucao)
+    with open(args.resultados, "a", encoding="utf-8") as f:
+        f.write(json.dumps(execucao, ensure_ascii=False) + "\n")
+    print(f"Resultados acrescentados a {args.resultados}")
+
+    if anterior is None:
+        return 0
+    print(f"Comparação com {anterior.get('versao')} ({anterior.get('data')}), mínimo contra mínimo:")
+    regrediu = False
+    for tamanho, caso, antes, agora, variacao, piorou in comparar(anterior, execucao):
+        aviso = "  <- regressão" if piorou else ""
+        print(f"  {tamanho:>8s} {caso:14s} {antes * 1000:10.3f} ms -> {agora * 1000:10.3f} ms  {variacao:+7.1%}{aviso}")
+        regrediu = regrediu or piorou
+    return 1 if regrediu and args.falhar_se_regredir else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
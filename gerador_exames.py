@@ -0,0 +1,244 @@
+"""
+Gestor de Exames Clínicos - gerador de dados de teste.
+
+Gera exames realistas e reproduzíveis (a mesma semente, no mesmo dia, dá os mesmos exames):
+    - os 15 tipos de TIPOS_EXAME, nas horas de HORAS_POR_TIPO e sem passar a CAPACIDADE_DIARIA;
+      nunca há dois exames na mesma vaga
+    - pacientes com nome, nº de utente de 9 dígitos e data de nascimento válidos (mais idosos do que
+      novos); cada paciente tem em média EXAMES_POR_PACIENTE exames
+    - exames passados: em cada dia, cada vaga está ocupada com a probabilidade de ocupação do tipo
+      (os tipos mais procurados estão mais cheios)
+    - exames futuros (FRACAO_FUTUROS): marcados, pela ordem de registo, nas primeiras vagas a partir de
+      dia_inicial_marcacao(), como faz o motor de agendamento, com algumas vagas vazias pelo meio
+      (VAGAS_LIVRES_FUTURO: exames apagados entretanto, que o replaneamento volta a ocupar)
+    - data de registo: pelo menos dias_antecedencia dias antes da data marcada (a maioria poucos dias
+      antes, alguns meses antes); os números seguem a ordem de registo
+
+    python gerador_exames.py 100000 [--semente 1] [--saida exames.json]   (.db: grava em SQLite)
+
+    from gerador_exames import gerar_exames
+    exames = gerar_exames(1000, semente=1)      # lista de dicionários, como no exames.json
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import date
+
+from nucleo_exames import (
+    CAPACIDADE_DIARIA, FORMATO_DATA, HORAS_POR_TIPO, TIPOS_EXAME,
+    ArmazenamentoJSON, ArmazenamentoSQLite, ErroExames,
+    calcular_estado_exame, dia_inicial_marcacao, gravar_dados,
+)
+
+# =================== CONFIGURAÇÃO ===================
+
+# Fração dos exames que está marcada no futuro (a lista de espera)
+FRACAO_FUTUROS = 0.05
+
+# Vagas futuras que ficam vazias (exames apagados depois de marcados)
+VAGAS_LIVRES_FUTURO = 0.03
+
+# Nº médio de exames de cada paciente
+EXAMES_POR_PACIENTE = 3
+
+# Antecedência (dias entre o registo e a data marcada, além de dias_antecedencia): média e máximo
+MEDIA_ANTECEDENCIA = 10
+MAXIMA_ANTECEDENCIA = 180
+
+# Os exames futuros foram registados nestes últimos dias
+DIAS_REGISTO_FUTUROS = 60
+
+# Procura de cada tipo (1 = muito procurado): ocupação das vagas passadas e peso na lista de espera
+PROCURA_POR_TIPO = {
+    "Raio-X": 0.9,
+    "Análises": 1.0,
+    "ECG": 0.85,
+    "Ressonância": 0.8,
+    "Ecografia": 0.9,
+    "TAC": 0.75,
+    "Mamografia": 0.7,
+    "Endoscopia": 0.65,
+    "Colonoscopia": 0.6,
+    "Hemograma": 1.0,
+    "Urina (EAS)": 0.95,
+    "PCR/Microbiologia": 0.8,
+    "Prova de Esforço": 0.6,
+    "Holter": 0.55,
+    "MAPA": 0.5,
+}
+
+NOMES = [
+    "Ana", "João", "Maria", "José", "Beatriz", "Rui", "Sofia", "Pedro", "Inês", "Tiago", "Marta", "Luís",
+    "Carla", "Nuno", "Rita", "Paulo", "Catarina", "Miguel", "Joana", "Ricardo", "Helena", "Francisco",
+    "Teresa", "António", "Mariana", "Manuel", "Diana", "Carlos", "Leonor", "Jorge", "Matilde", "Filipe",
+]
+APELIDOS = [
+    "Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa", "Rodrigues", "Martins", "Jesus", "Sousa",
+    "Fernandes", "Gonçalves", "Gomes", "Lopes", "Marques", "Alves", "Almeida", "Ribeiro", "Pinto",
+    "Carvalho", "Teixeira", "Moreira", "Correia", "Mendes", "Nunes", "Soares", "Vieira", "Monteiro",
+    "Cardoso", "Rocha", "Neves", "Coelho", "Cruz", "Cunha", "Pires", "Ramos", "Reis", "Simões", "Antunes",
+]
+
+# =================== GERAÇÃO ===================
+
+class _Datas:
+    """Texto dd-mm-yyyy de cada nº de dia (as mesmas datas repetem-se muito)."""
+
+    def __init__(self):
+        self._textos = {}
+
+    def texto(self, ordinal):
+        texto = self._textos.get(ordinal)
+        if texto is None:
+            texto = self._textos[ordinal] = date.fromordinal(ordinal).strftime(FORMATO_DATA)
+        return texto
+
+
+def _vagas(tipo):
+    """Horas de um tipo que se podem ocupar num dia (as primeiras, até à capacidade diária)."""
+    horas = HORAS_POR_TIPO[tipo]
+    return horas[:int(CAPACIDADE_DIARIA.get(tipo, len(horas)))]
+
+
+def _marcacoes_passadas(aleatorio, quantos, ultimo_dia):
+    """quantos (tipo, dia, hora) de dias anteriores a ultimo_dia, do mais recente para o mais antigo."""
+    marcacoes = []
+    dia = ultimo_dia
+    while len(marcacoes) < quantos:
+        dia = dia - 1
+        for tipo in TIPOS_EXAME:
+            # a ocupação varia de dia para dia à volta da procura do tipo
+            ocupacao = min(1.0, PROCURA_POR_TIPO.get(tipo, 0.8) * aleatorio.uniform(0.85, 1.1))
+            for hora in _vagas(tipo):
+                if aleatorio.random() < ocupacao:
+                    marcacoes.append((tipo, dia, hora))
+    return marcacoes[:quantos]
+
+
+def _marcacoes_futuras(aleatorio, quantos, primeiro_dia):
+    """
+    quantos (tipo, dia, hora) a partir de primeiro_dia: cada tipo fica com uma parte proporcional
+    às suas vagas e à procura, marcada vaga a vaga, por ordem, com algumas vagas vazias pelo meio.
+    """
+    pesos = [len(_vagas(tipo)) * PROCURA_POR_TIPO.get(tipo, 0.8) for tipo in TIPOS_EXAME]
+    por_tipo = dict.fromkeys(TIPOS_EXAME, 0)
+    for tipo in aleatorio.choices(TIPOS_EXAME, weights=pesos, k=quantos):
+        por_tipo[tipo] += 1
+
+    marcacoes = []
+    for tipo in TIPOS_EXAME:
+        faltam = por_tipo[tipo]
+        dia = primeiro_dia
+        while faltam:
+            for hora in _vagas(tipo):
+                if faltam and aleatorio.random() >= VAGAS_LIVRES_FUTURO:
+                    marcacoes.append((tipo, dia, hora))
+                    faltam = faltam - 1
+            dia = dia + 1
+    return marcacoes
+
+
+def _pacientes(aleatorio, quantos, hoje):
+    """[(nome, utente, nº do dia de nascimento)] com utentes diferentes e mais idosos do que novos."""
+    utentes = aleatorio.sample(range(100000000, 1000000000), quantos)
+    pacientes = []
+    for utente in utentes:
+        nome = f"{aleatorio.choice(NOMES)} {aleatorio.choice(APELIDOS)} {aleatorio.choice(APELIDOS)}"
+        idade_dias = int(aleatorio.triangular(0, 100, 70) * 365.25)
+        pacientes.append((nome, str(utente), hoje - idade_dias))
+    return pacientes
+
+
+def gerar_exames(quantos, semente=1, fracao_futuros=FRACAO_FUTUROS):
+    """
+    Lista de quantos exames (dicionários como os do exames.json), numerados de 1 a quantos pela ordem
+    de registo. A mesma semente dá os mesmos exames (as datas são relativas ao dia de hoje).
+    """
+    aleatorio = random.Random(semente)
+    hoje = date.today().toordinal()
+    primeiro_dia = dia_inicial_marcacao().toordinal()
+    futuros = round(quantos * fracao_futuros)
+
+    marcacoes = []   # (dia do registo, ordem, tipo, dia marcado, hora)
+    for tipo, dia, hora in _marcacoes_passadas(aleatorio, quantos - futuros, primeiro_dia):
+        antecedencia = min(int(aleatorio.expovariate(1 / MEDIA_ANTECEDENCIA)), MAXIMA_ANTECEDENCIA)
+        marcacoes.append((dia - (primeiro_dia - hoje) - antecedencia, len(marcacoes), tipo, dia, hora))
+
+    # os futuros de cada tipo foram registados pela ordem das vagas (é assim que o motor os marca)
+    por_tipo = {}
+    for tipo, dia, hora in _marcacoes_futuras(aleatorio, futuros, primeiro_dia):
+        por_tipo.setdefault(tipo, []).append((dia, hora))
+    for tipo, vagas in por_tipo.items():
+        registos = sorted(aleatorio.randint(hoje - DIAS_REGISTO_FUTUROS, hoje) for _ in vagas)
+        for registo, (dia, hora) in zip(registos, vagas):
+            marcacoes.append((registo, len(marcacoes), tipo, dia, hora))
+    marcacoes.sort()
+
+    pacientes = _pacientes(aleatorio, max(1, quantos // EXAMES_POR_PACIENTE), hoje)
+    datas = _Datas()
+    hoje_data = date.today()
+    exames = []
+    for num, (registo, _, tipo, dia, hora) in enumerate(marcacoes, start=1):
+        for _ in range(5):
+            nome, utente, nascimento = aleatorio.choice(pacientes)
+            if nascimento <= registo:
+                break
+        else:
+            # registo muito antigo (só com milhões de exames): o paciente nasceu antes dele
+            nascimento = registo - int(aleatorio.uniform(0, 90) * 365.25)
+        estado, dias_espera = calcular_estado_exame(date.fromordinal(dia), hoje_data)
+        exames.append({
+            "num": num,
+            "paciente": nome,
+            "utente": utente,
+            "nascimento": datas.texto(nascimento),
+            "tipo": tipo,
+            "data_registo": datas.texto(registo),
+            "data_marcada": datas.texto(dia),
+            "hora_marcada": hora,
+            "resultado": estado,
+            "dias_espera": dias_espera,
+        })
+    return exames
+
+
+def gravar_exames_gerados(exames, caminho):
+    """Grava os exames em caminho: SQLite se acabar em .db, senão JSON (como o exames.json)."""
+    if caminho.endswith(".db"):
+        armazenamento = ArmazenamentoSQLite(caminho)
+    else:
+        armazenamento = ArmazenamentoJSON(caminho)
+    try:
+        gravar_dados(exames, armazenamento)
+    finally:
+        armazenamento.fechar()
+
+# =================== EXECUTAR ===================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera exames de teste realistas (reproduzíveis)")
+    parser.add_argument("quantos", type=int, help="nº de exames (ex.: 1000, 100000, 1000000)")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--saida", default="exames.json", help="ficheiro a gravar (.db: SQLite)")
+    parser.add_argument("--futuros", type=float, default=FRACAO_FUTUROS, help="fração de exames futuros")
+    args = parser.parse_args(argv)
+    if args.quantos < 1 or not 0 <= args.futuros <= 1:
+        parser.error("o nº de exames tem de ser positivo e a fração de futuros entre 0 e 1")
+
+    inicio = time.perf_counter()
+    exames = gerar_exames(args.quantos, args.semente, args.futuros)
+    gerado = time.perf_counter()
+    try:
+        gravar_exames_gerados(exames, args.saida)
+    except (ErroExames, OSError) as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 1
+    print(f"{len(exames)} exames gerados em {gerado - inicio:.1f} s e gravados em {args.saida} "
+          f"em {time.perf_counter() - gerado:.1f} s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
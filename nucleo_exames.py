@@ -0,0 +1,3794 @@
+"""
+Núcleo do Gestor de Exames Clínicos (sem interface gráfica).
+
+Tem tudo o que não é janela:
+    - configuração (tipos de exame, horas, capacidades)
+    - Exame: o registo compacto de cada exame (comporta-se como o dicionário do exames.json)
+    - motor de agendamento e replaneamento
+    - índices de ocupação, de pesquisa e de ordenação, e as colunas para a análise (analise_exames.py)
+    - armazenamento (JSON ou SQLite; gravação imediata ou numa thread), exportação CSV e importação
+    - ServicoExames: registar, atualizar, apagar, pesquisar, replanear, exportar e importar
+
+Não importa o tkinter: pode ser usado pela interface gráfica, pela linha de comandos
+(cli_exames.py) ou por qualquer script. Os erros são lançados como exceções (ErroExames),
+nunca mostrados em janelas; quem chama decide como os mostrar.
+"""
+
+import json
+import csv
+import multiprocessing
+import os
+import io
+import re
+import bisect
+import cProfile
+import functools
+import gc
+import heapq
+import pstats
+import sqlite3
+import threading
+import time
+from array import array
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+
+try:
+    import fcntl          # Linux / macOS
+except ImportError:
+    fcntl = None
+    import msvcrt         # Windows
+
+# =================== CONFIGURAÇÃO ===================
+
+FICHEIRO_EXAMES = "exames.json"
+FICHEIRO_SQLITE = "exames.db"
+
+# Onde guardar os exames: "json" (FICHEIRO_EXAMES) ou "sqlite" (FICHEIRO_SQLITE)
+ARMAZENAMENTO = "json"
+
+# Só para o JSON: gravar as alterações num diário (exames.json.diario) em vez de reescrever o ficheiro,
+# e juntar o diário ao JSON quando tiver este nº de registos
+DIARIO_JSON = False
+COMPACTAR_DIARIO_APOS = 500
+FORMATO_DATA = "%d-%m-%Y"
+
+# Máximo de datas convertidas guardadas em memória (só as válidas no formato exato; chega para séculos de datas)
+MAXIMO_DATAS_GUARDADAS = 100000
+
+# Tipos de exame disponíveis
+TIPOS_EXAME = [
+    "Raio-X", "Análises", "ECG", "Ressonância", "Ecografia", "TAC",
+    "Mamografia", "Endoscopia", "Colonoscopia", "Hemograma", "Urina (EAS)",
+    "PCR/Microbiologia", "Prova de Esforço", "Holter", "MAPA"
+]
+
+# Capacidade diária máxima para cada tipo de exame (usada como referência)
+CAPACIDADE_DIARIA = {
+    "Raio-X": 3,
+    "Análises": 6,
+    "ECG": 2,
+    "Ressonância": 3,
+    "Ecografia": 4,
+    "TAC": 2,
+    "Mamografia": 3,
+    "Endoscopia": 3,
+    "Colonoscopia": 4,
+    "Hemograma": 6,
+    "Urina (EAS)": 5,
+    "PCR/Microbiologia": 5,
+    "Prova de Esforço": 4,
+    "Holter": 2,
+    "MAPA": 2
+}
+
+# Horas fixas por tipo de exame (1 "vaga" = 1 hora)
+HORAS_POR_TIPO = {
+    "Raio-X": ["09:00", "11:00", "15:00"],
+    "Análises": ["08:00", "08:30", "09:00", "09:30", "10:00", "10:30"],
+    "ECG": ["10:00", "14:00"],
+    "Ressonância": ["09:00", "13:00", "16:00"],
+    "Ecografia": ["09:00", "10:30", "14:00", "15:30"],
+    "TAC": ["09:00", "15:00"],
+    "Mamografia": ["10:00", "11:30", "15:00"],
+    "Endoscopia": ["09:00", "11:00", "14:00"],
+    "Colonoscopia": ["08:30", "10:30", "14:00", "16:00"],
+    "Hemograma": ["08:00", "08:15", "08:30", "08:45", "09:00", "09:15"],
+    "Urina (EAS)": ["09:00", "09:20", "09:40", "10:00", "10:20"],
+    "PCR/Microbiologia": ["10:00", "10:30", "11:00", "11:30", "12:00"],
+    "Prova de Esforço": ["09:00", "11:00", "15:00", "16:30"],
+    "Holter": ["09:00", "15:00"],
+    "MAPA": ["08:30", "14:30"]
+}
+
+# Dias de antecedência mínima para marcação (ex.: 2 dias)
+dias_antecedencia = 2
+
+# Exportação CSV: nº de linhas escritas de cada vez (e entre cada atualização da barra de progresso)
+LINHAS_POR_BLOCO_CSV = 5000
+
+# Replaneamento de vários tipos: nº de processos (None = um por CPU; 1 = sempre no próprio processo)
+# e nº mínimo de exames a replanear para compensar arrancar os processos (medido com
+# "python desempenho_exames.py --conjuntos processos": com 2 processos só compensa a partir de ~135000)
+PROCESSOS_REPLANEAMENTO = None
+MINIMO_REPLANEAMENTO_PARALELO = 150000
+
+# Como arrancar esses processos: "spawn" (um Python novo) e não "fork", porque a interface e o servidor
+# têm outras threads (pesquisa, gravação, compactação) e um fork copiava os trincos que elas tivessem
+INICIO_PROCESSOS_REPLANEAMENTO = "spawn"
+
+# Quando gravar cada alteração (ServicoExames):
+#   "imediata"  - logo, antes de a operação terminar
+#   "agrupada"  - numa thread, quando passam ESPERA_GRAVACAO segundos sem alterações novas
+#                 (mas nunca mais de ESPERA_MAXIMA_GRAVACAO segundos depois da primeira por gravar)
+#   "intervalo" - numa thread, INTERVALO_GRAVACAO segundos depois da primeira alteração por gravar
+# Se a gravação falhar, volta a tentar-se INTERVALO_GRAVACAO segundos depois.
+MODOS_GRAVACAO = ("imediata", "agrupada", "intervalo")
+MODO_GRAVACAO = "imediata"
+ESPERA_GRAVACAO = 0.5
+ESPERA_MAXIMA_GRAVACAO = 5.0
+INTERVALO_GRAVACAO = 5.0
+
+# Medições (ver medir): começar já a medir, e limites (ms) das barras do histograma das durações
+# (a última barra conta tudo o que passa do último limite)
+MEDICOES_ATIVAS = False
+LIMITES_HISTOGRAMA_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+# =================== ERROS ===================
+
+class ErroExames(Exception):
+    """Erro base do núcleo (a mensagem já vem pronta para mostrar ao utilizador)."""
+
+
+class ErroValidacao(ErroExames):
+    """Os dados de um exame não são válidos."""
+
+
+class ExameNaoEncontrado(ErroExames):
+    """Não existe nenhum exame com o número pedido."""
+
+
+class ErroArmazenamento(ErroExames):
+    """Não foi possível ler ou gravar os exames."""
+
+
+class ConflitoVersao(ErroArmazenamento):
+    """Outra instância gravou o ficheiro de exames depois da nossa última leitura."""
+
+# =================== MEDIÇÕES ===================
+
+class Medicao:
+    """Contagens de uma função medida: chamadas, registos, tempo total e máximo e histograma das durações."""
+
+    def __init__(self):
+        self.chamadas = 0
+        self.registos = 0
+        self.total = 0.0      # segundos
+        self.maximo = 0.0
+        self.histograma = [0] * (len(LIMITES_HISTOGRAMA_MS) + 1)
+
+    def juntar(self, segundos, registos=0):
+        self.chamadas = self.chamadas + 1
+        self.registos = self.registos + registos
+        self.total = self.total + segundos
+        if segundos > self.maximo:
+            self.maximo = segundos
+        self.histograma[bisect.bisect_left(LIMITES_HISTOGRAMA_MS, segundos * 1000)] += 1
+
+    def percentil_ms(self, p):
+        """Limite (ms) da barra onde cai o percentil p (o máximo, se cair na última barra)."""
+        alvo = self.chamadas * p / 100
+        acumulado = 0
+        for limite, quantos in zip(LIMITES_HISTOGRAMA_MS, self.histograma):
+            acumulado = acumulado + quantos
+            if acumulado >= alvo:
+                return min(limite, self.maximo * 1000)
+        return self.maximo * 1000
+
+    def para_dict(self):
+        return {
+            "chamadas": self.chamadas,
+            "registos": self.registos,
+            "total_ms": round(self.total * 1000, 3),
+            "media_ms": round(self.total * 1000 / self.chamadas, 3) if self.chamadas else 0.0,
+            "p50_ms": round(self.percentil_ms(50), 3),
+            "p95_ms": round(self.percentil_ms(95), 3),
+            "maximo_ms": round(self.maximo * 1000, 3),
+            "histograma": list(self.histograma),
+        }
+
+
+class _Medicoes:
+    """As medições de todas as funções medidas (uma só instância, _MEDICOES) e o perfil cProfile."""
+
+    def __init__(self):
+        self.ativas = MEDICOES_ATIVAS
+        self.por_nome = {}
+        self.trinco = threading.Lock()   # as funções medidas também correm noutras threads
+        self.perfil = None               # cProfile.Profile enquanto o perfil está ligado
+
+
+_MEDICOES = _Medicoes()
+
+
+def medir(nome, registos=None):
+    """
+    Decorador: com as medições ligadas (ativar_medicoes), conta as chamadas e a duração da função.
+    registos(resultado, *args, **kwargs) diz quantos registos (exames, linhas) a chamada tratou.
+    Desligadas, custa só um teste por chamada.
+    """
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            if not _MEDICOES.ativas:
+                return funcao(*args, **kwargs)
+            inicio = time.perf_counter()
+            resultado = funcao(*args, **kwargs)
+            segundos = time.perf_counter() - inicio
+            quantos = registos(resultado, *args, **kwargs) if registos is not None else 0
+            with _MEDICOES.trinco:
+                medicao = _MEDICOES.por_nome.get(nome)
+                if medicao is None:
+                    medicao = _MEDICOES.por_nome[nome] = Medicao()
+                medicao.juntar(segundos, quantos)
+            return resultado
+        return medida
+    return decorador
+
+
+def ativar_medicoes(ativas=True):
+    """Liga (ou desliga) as medições; o que já foi medido fica."""
+    _MEDICOES.ativas = ativas
+
+
+def medicoes_ativas():
+    return _MEDICOES.ativas
+
+
+def limpar_medicoes():
+    with _MEDICOES.trinco:
+        _MEDICOES.por_nome = {}
+
+
+def obter_medicoes():
+    """As medições até agora, num dicionário pronto para JSON."""
+    with _MEDICOES.trinco:
+        funcoes = {nome: medicao.para_dict() for nome, medicao in sorted(_MEDICOES.por_nome.items())}
+    return {
+        "ativas": _MEDICOES.ativas,
+        "perfil": _MEDICOES.perfil is not None,
+        "limites_histograma_ms": list(LIMITES_HISTOGRAMA_MS),
+        "funcoes": funcoes,
+    }
+
+
+def gravar_medicoes(caminho):
+    """Grava as medições num ficheiro JSON (lança ErroArmazenamento se não conseguir)."""
+    try:
+        with open(caminho, "w", encoding="utf-8") as f:
+            json.dump(obter_medicoes(), f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        raise ErroArmazenamento(f"Erro ao gravar as medições: {e}") from e
+
+
+def iniciar_perfil():
+    """
+    Liga o cProfile (só vê o que corre na thread que o liga, ex.: a da interface).
+    Lança ErroExames se já estiver ligado.
+    """
+    if _MEDICOES.perfil is not None:
+        raise ErroExames("O perfil já está ligado.")
+    _MEDICOES.perfil = cProfile.Profile()
+    _MEDICOES.perfil.enable()
+
+
+def perfil_ativo():
+    return _MEDICOES.perfil is not None
+
+
+def parar_perfil(caminho=None, linhas=30):
+    """
+    Desliga o cProfile e devolve o resumo (as funções com mais tempo acumulado, em texto).
+    Com caminho, grava também o perfil completo (para abrir com pstats, snakeviz, ...).
+    """
+    perfil = _MEDICOES.perfil
+    if perfil is None:
+        raise ErroExames("O perfil não está ligado.")
+    perfil.disable()
+    _MEDICOES.perfil = None
+    if caminho is not None:
+        try:
+            perfil.dump_stats(caminho)
+        except OSError as e:
+            raise ErroArmazenamento(f"Erro ao gravar o perfil: {e}") from e
+    texto = io.StringIO()
+    pstats.Stats(perfil, stream=texto).sort_stats("cumulative").print_stats(linhas)
+    return texto.getvalue()
+
+# =================== FUNÇÕES AUXILIARES ===================
+
+def data_hoje():
+    """Devolve a data de hoje em string com a formatação desejada (dd-mm-yyyy)."""
+    hoje = date.today()
+    texto = hoje.strftime(FORMATO_DATA)
+    return texto
+
+
+def dia_inicial_marcacao():
+    """Primeiro dia possível para marcar exames (hoje + dias_antecedencia)."""
+    return date.today() + timedelta(days=dias_antecedencia) #como estamos a ir buscar as datas à biblioteca e elas seguem já um formato definido
+                                                            #time delta é para conseguirmos fazer a soma das datas 
+
+class _DiaDeHoje:
+    """
+    O dia de hoje (nº do dia, date.toordinal) guardado: o estado e os dias de espera de cada Exame
+    são calculados a partir dele quando são lidos, em vez de se perguntar a data ao relógio em cada leitura.
+    Só muda quando se chama virar() (ServicoExames.virar_dia, à meia-noite ou na atualização seguinte).
+    """
+
+    def __init__(self):
+        self.ordinal = date.today().toordinal()
+
+    def virar(self):
+        """Passa para o dia do relógio. Devolve o nº do dia de hoje."""
+        self.ordinal = date.today().toordinal()
+        return self.ordinal
+
+
+_HOJE = _DiaDeHoje()
+
+
+def dia_de_hoje():
+    """Nº do dia de hoje guardado (o mesmo de que dependem o estado e os dias de espera dos exames)."""
+    return _HOJE.ordinal
+
+
+def segundos_ate_meia_noite(agora=None):
+    """Segundos que faltam para a próxima meia-noite (para agendar a mudança de dia)."""
+    if agora is None:
+        agora = datetime.now()
+    meia_noite = datetime.combine(agora.date() + timedelta(days=1), datetime.min.time())
+    return (meia_noite - agora).total_seconds()
+
+
+@medir("ler_dados", registos=lambda exames, *args, **kwargs: len(exames))
+def ler_dados(armazenamento=None):
+    """
+    Lê os exames do armazenamento configurado (ficheiro JSON ou SQLite).
+    Se não existir devolve lista vazia; se der erro lança ErroArmazenamento.
+    """
+    if armazenamento is None:
+        armazenamento = obter_armazenamento()
+    try:
+        return armazenamento.ler()
+    except (json.JSONDecodeError, OSError, sqlite3.Error) as e:
+        raise ErroArmazenamento(f"Não foi possível ler o ficheiro de exames: {e}") from e
+
+
+@medir("gravar_dados", registos=lambda _, exames, *args, **kwargs: len(exames))
+def gravar_dados(exames, armazenamento=None):
+    """Guarda a lista completa de exames (no ficheiro JSON ou na base de dados SQLite)."""
+    if armazenamento is None:
+        armazenamento = obter_armazenamento()
+    try:
+        armazenamento.gravar_tudo(exames)
+    except (OSError, sqlite3.Error) as e:
+        raise ErroArmazenamento(f"Erro ao gravar os dados: {e}") from e
+
+
+@medir("gravar_alteracoes",
+       registos=lambda _, exames, alterados, removidos=(), *args, **kwargs: len(alterados) + len(removidos))
+def gravar_alteracoes(exames, alterados, removidos=(), armazenamento=None):
+    """
+    Guarda só o que mudou: exames novos/alterados e exames removidos.
+    No SQLite são escritas apenas essas linhas; no JSON o ficheiro é reescrito.
+    """
+    if armazenamento is None:
+        armazenamento = obter_armazenamento()
+    try:
+        armazenamento.gravar_alteracoes(exames, alterados, removidos)
+    except (OSError, sqlite3.Error) as e:
+        raise ErroArmazenamento(f"Erro ao gravar os dados: {e}") from e
+
+
+def proximo_numero(exames):
+    """
+    Devolve o próximo número de exame disponível.
+    Percorre a lista de exames um a um 
+    Procura o maior número existente e soma 1.
+    Se não houver exames, começa em 1.
+    """
+    max_num = 0
+
+    for exame in exames:
+        num_str = exame.get("num", 0)
+        try:
+            num = int(num_str)
+        except (TypeError, ValueError):
+            num = 0
+        if num > max_num:
+            max_num = num
+
+    proximo = max_num + 1
+    return proximo
+
+
+def validar_data(texto_data):
+    """Verifica se uma data está no formato dd-mm-yyyy e é válida."""
+    return _ler_data(texto_data) is not None   # mesmo strptime, mas com as datas já vistas guardadas
+
+
+# datas já convertidas, só as válidas e no formato exato dd-mm-yyyy (até MAXIMO_DATAS_GUARDADAS):
+# texto -> (date, nº do dia) e texto -> nº do dia (o mesmo nº é partilhado por todos os exames com essa data).
+# Textos inválidos ou noutro formato (importações, pedidos à API) são convertidos sempre e nunca guardados,
+# para a memória não crescer sem limite num processo que fica muito tempo a correr.
+_DATAS_LIDAS = {}
+_ORDINAIS = {}
+
+
+def _ler_data_memo(data_str):
+    lida = _DATAS_LIDAS.get(data_str)
+    if lida is None:
+        try:
+            data = datetime.strptime(data_str, FORMATO_DATA).date()
+        except ValueError:
+            return None, None
+        if data.strftime(FORMATO_DATA) != data_str:
+            return data, None
+        lida = (data, data.toordinal())
+        if len(_DATAS_LIDAS) < MAXIMO_DATAS_GUARDADAS:
+            _DATAS_LIDAS[data_str] = lida
+            _ORDINAIS[data_str] = lida[1]
+    return lida
+
+
+def _ler_data(data_str):
+    """Como datetime.strptime(...).date(), mas guarda o resultado (as mesmas datas repetem-se muito). None se for inválida."""
+    return _ler_data_memo(data_str)[0]
+
+
+def _ordinal_data(data_str):
+    """Nº do dia (date.toordinal) de uma data escrita exatamente como dd-mm-yyyy; None nos outros casos."""
+    return _ler_data_memo(data_str)[1]
+
+
+def numero_do_dia(data_str):
+    """Nº do dia (date.toordinal) de uma data dd-mm-yyyy, ou None se não for uma data válida."""
+    data = _ler_data(data_str) if type(data_str) is str else None
+    return data.toordinal() if data is not None else None
+
+
+# datas já escritas: nº do dia -> 'dd-mm-yyyy' (o strftime é o mais lento do replaneamento)
+_TEXTOS_DATA = {}
+
+
+def _texto_data(ordinal):
+    """Inverso de _ordinal_data: nº do dia -> 'dd-mm-yyyy'."""
+    texto = _TEXTOS_DATA.get(ordinal)
+    if texto is None:
+        texto = _TEXTOS_DATA[ordinal] = date.fromordinal(ordinal).strftime(FORMATO_DATA)
+    return texto
+
+
+def validar_utente(numero_utente):
+    """Verifica se o nº de utente tem só dígitos e entre 9 e 11 caracteres."""
+    if not numero_utente.isdigit():
+        return False
+
+    tamanho = len(numero_utente)
+    if tamanho < 9 or tamanho > 11:
+        return False
+
+    return True
+
+
+def contar_marcados(exames, tipo_exame, data_marcada_str, ignorar_num=None):
+    """
+    Funciona como uma dupla verificação: conta quantos exames existem de um certo tipo numa certa data.
+    Pode ignorar o número de exame se estivermos a editar um exame (para não contar como se fosse um novo). (com o ignorar_num)
+    O resultado da função é informar se ainda há capacidade de realização nesse dia. 
+    (Garantimos que não ultrapassamos o limite diário.)
+    """
+    contador = 0
+
+    for exame in exames:
+        tipo = exame.get("tipo", "")
+        data_marcada = exame.get("data_marcada", "")
+        num = exame.get("num", None)
+
+        if tipo == tipo_exame and data_marcada == data_marcada_str:
+            if ignorar_num is not None:
+                try:
+                    if int(num) != int(ignorar_num):
+                        contador = contador + 1
+                except (TypeError, ValueError):
+                    contador = contador + 1
+            else:
+                contador = contador + 1
+
+    return contador
+
+@medir("primeira_marcacao_livre")
+def primeira_marcacao_livre(exames, tipo_exame: str, inicio: date, ignorar_num=None, indice=None):
+    """
+    Motor de agendamento: percorre a funcão e procura o primeiro dia e hora disponível para o 'tipo_exame',
+    usando as HORAS_POR_TIPO como slots fixos.
+    Se todas as horas desse tipo estiverem cheias NAQUELE dia, avança para o dia seguinte.
+    Também respeita o limite diário de CAPACIDADE_DIARIA, se estiver definido.
+    Se receber um IndiceOcupacao (indice), a vaga é procurada no calendário do tipo em vez de percorrer a lista.
+    """
+    if indice is not None:
+        vaga = indice.proxima_vaga(tipo_exame, inicio, ignorar_num)
+        if vaga is not None:
+            return vaga
+
+    limite_diario = int(CAPACIDADE_DIARIA.get(tipo_exame, len(horas_para_tipo(tipo_exame))))
+    horas = horas_para_tipo(tipo_exame)
+
+    dia = inicio
+    while True:
+        data_str = dia.strftime(FORMATO_DATA)
+
+        if indice is not None:
+            ocupados_dia = indice.contar(tipo_exame, data_str, ignorar_num)
+        else:
+            ocupados_dia = contar_marcados(exames, tipo_exame, data_str, ignorar_num)
+
+        if ocupados_dia < limite_diario:
+            for h in horas:
+                if indice is not None:
+                    ocupado = indice.ocupado(tipo_exame, data_str, h, ignorar_num)
+                else:
+                    ocupado = slot_ocupado(exames, tipo_exame, data_str, h, ignorar_num)
+                if not ocupado:
+                    return dia, h
+
+        dia = dia + timedelta(days=1)
+
+def horas_para_tipo(tipo_exame: str):
+    """Devolve a lista de horas fixas para um tipo"""
+    if tipo_exame in HORAS_POR_TIPO:
+        return HORAS_POR_TIPO[tipo_exame]
+    
+    
+def calcular_estado_exame(data_marcada_date, hoje_date=None):
+    """
+    Recebe a data marcada (tipo date) e devolve:
+    - "Aprovado" e 0 dias se a data é hoje ou anterior.
+    - "Pendente" e nº de dias em espera se é futura.
+    Quem chama muitas vezes seguidas pode passar a data de hoje (hoje_date) já calculada.
+    """
+    if hoje_date is None:
+        hoje_date = date.today()
+
+    if data_marcada_date <= hoje_date:
+        return "Aprovado", 0
+    else:
+        diferenca = data_marcada_date - hoje_date
+        dias = diferenca.days #Quando subtraímos duas datas, o Python dá-nos um timedelta (usado tbm em cima) que é um intervalo de tempo. Usamos .days para ficar só com o número de dias,
+        return "Pendente", dias
+
+
+def atualizar_estados(exames):
+    """
+    Atualiza o estado (Aprovado / Pendente) e os dias_espera de todos os exames em função da data marcada.
+    Devolve os exames cujo estado mudou (para atualizar o índice de pesquisa).
+    Os Exame com data marcada válida não precisam (calculam os dois campos quando são lidos) e são saltados.
+    """
+    hoje_date = date.fromordinal(_HOJE.ordinal)
+    mudaram_estado = []
+    for exame in exames:
+        if type(exame) is Exame and exame.ordinal_marcada is not None:
+            continue
+
+        data_str = exame.get("data_marcada", "")
+        if not data_str:
+            continue
+
+        data_marcada_date = _ler_data(data_str)
+        if data_marcada_date is None:
+            # Se a data estiver mal formatada ou não estiver marcada, ignoramos este exame
+            continue
+
+        estado, dias_espera = calcular_estado_exame(data_marcada_date, hoje_date)
+        if exame.get("resultado") != estado:
+            mudaram_estado.append(exame)
+        exame["resultado"] = estado
+        exame["dias_espera"] = dias_espera
+
+    return mudaram_estado
+
+
+def filtrar_exames(exames, termo):
+    """
+    Devolve os exames em que o termo (já em minúsculas) aparece no nome, tipo, nº de utente ou estado.
+    Se o termo estiver vazio, não há filtro e devolve todos.
+    """
+    if termo == "":
+        return exames
+
+    exames_a_mostrar = []
+    for exame in exames:
+        nome = exame.get("paciente", "").lower()
+        tipo = exame.get("tipo", "").lower()
+        utente = exame.get("utente", "").lower()
+        estado = exame.get("resultado", "").lower()
+
+        if (termo in nome
+                or termo in tipo
+                or termo in utente
+                or termo in estado):
+            exames_a_mostrar.append(exame)
+    return exames_a_mostrar
+
+
+# datas e horas que não se conseguem ler ficam no fim da ordenação
+_DIA_INVALIDO = date.max.toordinal() + 1
+_HORA_INVALIDA = 24 * 60
+
+
+def chave_ordem(exame):
+    """
+    Chave de ordenação da tabela, por ordem cronológica: (nº do dia marcado, minutos da hora marcada).
+    Sem data marcada conta como hoje; datas ou horas inválidas ficam depois de todas as outras.
+    """
+    if type(exame) is Exame and exame.ordinal_marcada is not None and exame.minutos_hora is not None:
+        return (exame.ordinal_marcada, exame.minutos_hora)   # registo compacto: a chave já está feita
+
+    data_marcada = exame.get("data_marcada")
+    if data_marcada is None:
+        ordinal = date.today().toordinal()  # só calculamos a data de hoje quando faz falta
+    else:
+        ordinal = _ordinal_qualquer(data_marcada)
+    return (ordinal, _minutos_qualquer(exame.get("hora_marcada", "00:00")))
+
+
+def _ordinal_qualquer(data_str):
+    """Nº do dia de uma data dd-mm-yyyy (mesmo sem zeros à esquerda), ou _DIA_INVALIDO."""
+    data = _ler_data(data_str) if type(data_str) is str else None
+    return data.toordinal() if data is not None else _DIA_INVALIDO
+
+
+def _minutos_qualquer(hora_str):
+    """Minutos de uma hora hh:mm (mesmo sem zeros à esquerda, ex.: 9:00), ou _HORA_INVALIDA."""
+    minutos = _minutos_hora(hora_str)
+    if minutos is not None:
+        return minutos
+    try:
+        horas, minutos = str(hora_str).split(":")
+        horas, minutos = int(horas), int(minutos)
+    except ValueError:
+        return _HORA_INVALIDA
+    if 0 <= horas < 24 and 0 <= minutos < 60:
+        return horas * 60 + minutos
+    return _HORA_INVALIDA
+
+
+def valores_linha(exame):
+    """Valores de uma linha da tabela (pela ordem das colunas)."""
+    return (
+        exame.get("num", ""),
+        exame.get("paciente", ""),
+        exame.get("utente", ""),
+        exame.get("nascimento", ""),
+        exame.get("tipo", ""),
+        exame.get("data_registo", ""),
+        exame.get("data_marcada", ""),
+        exame.get("hora_marcada", ""),
+        exame.get("dias_espera", ""),
+        exame.get("resultado", "")
+    )
+
+
+@medir("replanear_pendentes_por_tipo", registos=lambda alterados, *args, **kwargs: len(alterados))
+def replanear_pendentes_por_tipo(exames, tipo_exame, indice=None):
+    """
+    Reorganiza exames FUTUROS de um determinado tipo, a partir do dia_inicial_marcacao(),
+    para que ocupem (data, hora) o mais cedo possível, respeitando:
+    - horas fixas por tipo (HORAS_POR_TIPO)
+    - limite diário de CAPACIDADE_DIARIA
+    Não mexe em exames de datas anteriores ao dia inicial.
+    Se receber o IndiceOcupacao, usa o replaneamento incremental (mesmo resultado) e mantém o índice atualizado.
+    Devolve a lista dos exames que foram alterados.
+    """
+    if indice is not None:
+        alterados = _replanear_incremental(tipo_exame, indice)
+        if alterados is not None:
+            return alterados
+
+    base_date = dia_inicial_marcacao()
+
+    # 1. Selecionar exames deste tipo com data >= base_date
+    exames_tipo = []  #criar lista vazia e percorre todos os exames
+    for exame in exames: 
+        tipo = exame.get("tipo", "")
+        if tipo == tipo_exame:
+            data_str = exame.get("data_marcada", data_hoje())
+            data = _ler_data(data_str)
+            if data is None:
+                data = base_date
+
+            if data >= base_date:
+                exames_tipo.append(exame) #adicionamos o exame à lista
+
+    # 2. Ordenar por número (ordem previsível) 
+    n = len(exames_tipo)   
+    for i in range(n - 1):  #numa lista vamos percorrer os exames e verificar o número do exame em questão (i)
+        for j in range(i + 1, n):  #de seguida vamos percorrer os exames e ver qual é o número do exame a seguir ao i (j)
+            num_i = int(exames_tipo[i].get("num", 0))
+            num_j = int(exames_tipo[j].get("num", 0))
+            if num_j < num_i:   #se j for menor que i (tipo j= 2 e i= 3), então trocamos a ordem 
+                temp = exames_tipo[i]
+                exames_tipo[i] = exames_tipo[j]
+                exames_tipo[j] = temp
+
+    # 3. Para cada exame, voltar a marcar dia+hora com base nas vagas disponíveis
+    alterados = []
+    for exame in exames_tipo: #vagas libertas, reorganizar
+        num = exame.get("num")
+        dia, hora = primeira_marcacao_livre(exames, tipo_exame, base_date, ignorar_num=num, indice=indice)
+        estado, dias_espera = calcular_estado_exame(dia)
+
+        if _marcar_exame(exame, dia, hora, estado, dias_espera):
+            alterados.append(exame)
+
+        if indice is not None:
+            indice.atualizar(exame) #o exame seguinte já tem de ver esta vaga ocupada
+
+    return alterados
+
+
+def _marcar_exame(exame, dia, hora, estado, dias_espera):
+    """Escreve a marcação no exame. Devolve True se algum dos campos mudou."""
+    minutos = _minutos_hora(hora)
+    if type(exame) is Exame and minutos is not None:
+        ordinal = dia.toordinal()
+        codigo = _CODIGOS_ESTADO.codigo(estado)
+        # o estado e os dias de espera de um Exame vêm da data marcada: só a data e a hora contam
+        mudou = exame.ordinal_marcada != ordinal or exame.minutos_hora != minutos
+        exame.marcar(ordinal, minutos, codigo, dias_espera)
+        return mudou
+
+    data_marcada_str = _texto_data(dia.toordinal())
+    mudou = (exame.get("data_marcada") != data_marcada_str
+             or exame.get("hora_marcada") != hora
+             or exame.get("resultado") != estado
+             or exame.get("dias_espera") != dias_espera)
+
+    exame["data_marcada"] = data_marcada_str
+    exame["hora_marcada"] = hora
+    exame["resultado"] = estado
+    exame["dias_espera"] = dias_espera
+    return mudou
+
+
+def _replanear_incremental(tipo_exame, indice):
+    """
+    Replaneamento com o IndiceOcupacao. Dá exatamente o mesmo resultado que o algoritmo completo
+    (cada exame, por ordem de número, fica na primeira vaga livre sem contar com ele próprio), mas:
+    - a ordem por número vem da fila do índice (já está ordenada, não há bubble sort)
+    - as vagas de cada dia vêm de um calendário do tipo (máscara de bits por dia, sem strings)
+    - os dias com vaga ficam num heap, por isso descobrir a vaga mais cedo não obriga a
+      percorrer os dias cheios nem a lista de exames; um exame que não pode andar para trás
+      volta simplesmente ao seu slot
+    Devolve a lista dos exames alterados, ou None quando não dá para garantir o mesmo resultado
+    (números repetidos ou inválidos, tipo sem calendário) e deve usar-se o algoritmo completo.
+    """
+    preparado = _preparar_replaneamento(tipo_exame, indice)
+    if preparado is None:
+        return None
+    exames_tipo, fila = preparado
+    return _aplicar_replaneamento(tipo_exame, exames_tipo, replanear_fila(*fila), indice)
+
+
+def _preparar_replaneamento(tipo_exame, indice):
+    """
+    (exames a replanear, argumentos de replanear_fila) de um tipo, ou None se for preciso o algoritmo completo.
+    Os argumentos são só números (arrays), para poderem ir para outro processo sem custar muito.
+    """
+    calendario = indice.calendario(tipo_exame)
+    if calendario is None:
+        return None
+
+    base_date = dia_inicial_marcacao()
+    base_ord = base_date.toordinal()
+    fila = indice.fila_do_tipo(tipo_exame, desde=base_ord)
+    if fila is None:
+        return None
+
+    hoje_str = data_hoje()
+    posicao_hora = {hora: i for i, hora in enumerate(calendario.horas)}
+    posicao_minutos = {_minutos_hora(hora): i for i, hora in enumerate(calendario.horas)}
+    outra_hora = len(calendario.horas)
+
+    # Exames deste tipo com data >= base_date (a fila já vem ordenada por número), com o dia e a hora
+    # que ocupam: -1 se a data não estiver escrita exatamente como dd-mm-yyyy (não ocupa vaga no calendário)
+    exames_tipo = []
+    dias = array("i")
+    horas = array("B")
+    for exame in fila:
+        if type(exame) is Exame and exame.ordinal_marcada is not None:
+            if exame.ordinal_marcada >= base_ord:
+                exames_tipo.append(exame)
+                dias.append(exame.ordinal_marcada)
+                horas.append(posicao_minutos.get(exame.minutos_hora, outra_hora))
+            continue
+        data_str = exame.get("data_marcada", hoje_str)
+        data = _ler_data(data_str)
+        if data is None or data >= base_date:
+            exames_tipo.append(exame)
+            ordinal = _ordinal_data(data_str)
+            dias.append(-1 if ordinal is None else ordinal)
+            horas.append(posicao_hora.get(exame.get("hora_marcada", ""), outra_hora))
+
+    # com números repetidos o ignorar_num ignora vários exames ao mesmo tempo
+    chaves = [_chave_num(exame.get("num")) for exame in exames_tipo]
+    for i in range(1, len(chaves)):
+        if chaves[i] == chaves[i - 1]:
+            return None
+
+    return exames_tipo, (len(calendario.horas), calendario.capacidade, base_ord, dias, horas)
+
+
+def replanear_fila(quantas_horas, capacidade, base_ord, dias, horas):
+    """
+    O replaneamento de um tipo só com números (não precisa dos exames nem do índice, por isso pode
+    correr noutro processo). dias[i] e horas[i] são o dia (ordinal, ou -1) e a hora (posição nas horas
+    do tipo; quantas_horas se não for nenhuma delas) do i-ésimo exame a replanear, por ordem de número.
+    Devolve (dias, horas) das novas marcações, pela mesma ordem.
+    """
+    # só interessam os dias a partir de base_ord: os exames que lá estão são exatamente os que se replaneiam
+    calendario = CalendarioTipo(range(quantas_horas), capacidade)
+    por_hora = {}   # (dia, hora) -> nº de exames, para saber quando uma hora fica vazia
+    for ordinal, hora in zip(dias, horas):
+        if ordinal >= base_ord:
+            calendario.entrar(ordinal, hora)
+            por_hora[ordinal, hora] = por_hora.get((ordinal, hora), 0) + 1
+
+    hora_livre = calendario.hora_livre
+
+    # Dias com vaga: os que já têm exames vão para o heap; a "lacuna" é o primeiro dia sem nenhum exame
+    dias_com_vaga = calendario.dias_com_vaga(base_ord)
+    heapq.heapify(dias_com_vaga)
+    lacuna = calendario.primeiro_dia_vazio(base_ord)
+
+    # Cada exame sai do seu slot e volta a entrar na vaga mais cedo que existir
+    novos_dias = array("i")
+    novas_horas = array("B")
+    for ordinal_antigo, hora_antiga in zip(dias, horas):
+        if ordinal_antigo >= base_ord:
+            restantes = por_hora[ordinal_antigo, hora_antiga] - 1
+            por_hora[ordinal_antigo, hora_antiga] = restantes
+            calendario.sair(ordinal_antigo, hora_antiga, restantes == 0)
+            heapq.heappush(dias_com_vaga, ordinal_antigo)
+
+        while dias_com_vaga and hora_livre(dias_com_vaga[0]) is None:
+            heapq.heappop(dias_com_vaga)  # dia que entretanto encheu
+
+        if dias_com_vaga and dias_com_vaga[0] < lacuna:
+            ordinal = dias_com_vaga[0]
+        else:
+            ordinal = lacuna
+
+        hora = hora_livre(ordinal)
+        calendario.entrar(ordinal, hora)
+        por_hora[ordinal, hora] = por_hora.get((ordinal, hora), 0) + 1
+        novos_dias.append(ordinal)
+        novas_horas.append(hora)
+
+        if ordinal == lacuna:
+            heapq.heappush(dias_com_vaga, ordinal)
+            lacuna = calendario.primeiro_dia_vazio(lacuna + 1)
+
+    return novos_dias, novas_horas
+
+
+def _aplicar_replaneamento(tipo_exame, exames_tipo, novas, indice):
+    """Escreve nos exames as marcações de replanear_fila e atualiza o índice. Devolve os exames alterados."""
+    horas_tipo = indice.calendario(tipo_exame).horas
+    minutos_tipo = [_minutos_hora(hora) for hora in horas_tipo]
+    alterados = []
+    for exame, ordinal, hora in zip(exames_tipo, *novas):
+        if (type(exame) is Exame and exame.ordinal_marcada == ordinal
+                and exame.minutos_hora == minutos_tipo[hora]):
+            continue   # ficou onde estava (o estado de um Exame vem da data)
+        dia = date.fromordinal(ordinal)
+        estado, dias_espera = calcular_estado_exame(dia)
+        if _marcar_exame(exame, dia, horas_tipo[hora], estado, dias_espera):
+            alterados.append(exame)
+            indice.atualizar(exame)   # só muda de slot quem mudou de marcação
+    return alterados
+
+
+def _replanear_fila_no_processo(fila):
+    return replanear_fila(*fila)
+
+
+@medir("replanear_tipos", registos=lambda alterados, *args, **kwargs: len(alterados))
+def replanear_tipos(exames, tipos, indice=None, processos=None):
+    """
+    Replaneia vários tipos de uma vez; devolve os exames alterados (pela ordem dos tipos).
+    Os tipos não partilham vagas, por isso o cálculo de cada um (replanear_fila) é independente:
+    com mais de um processo (por omissão PROCESSOS_REPLANEAMENTO, ou um por CPU) e pelo menos
+    MINIMO_REPLANEAMENTO_PARALELO exames a replanear, os tipos são calculados em paralelo, um por tarefa.
+    Os resultados são aplicados aqui, pela ordem dos tipos, por isso ficam iguais aos de os replanear um a um.
+    """
+    if indice is None:
+        alterados = []
+        for tipo in tipos:
+            alterados += replanear_pendentes_por_tipo(exames, tipo)
+        return alterados
+
+    preparados = {tipo: _preparar_replaneamento(tipo, indice) for tipo in tipos}
+    filas = [(tipo, preparado[1]) for tipo, preparado in preparados.items() if preparado is not None]
+
+    if processos is None:
+        processos = PROCESSOS_REPLANEAMENTO or os.cpu_count() or 1
+    processos = max(1, min(processos, len(filas)))
+    a_replanear = sum(len(fila[3]) for _, fila in filas)
+
+    if processos > 1 and a_replanear >= MINIMO_REPLANEAMENTO_PARALELO:
+        # os maiores primeiro, para nenhum processo ficar no fim com um tipo grande sozinho
+        filas.sort(key=lambda item: len(item[1][3]), reverse=True)
+        contexto = multiprocessing.get_context(INICIO_PROCESSOS_REPLANEAMENTO)
+        with ProcessPoolExecutor(processos, mp_context=contexto) as executor:
+            calculadas = dict(zip(
+                [tipo for tipo, _ in filas],
+                executor.map(_replanear_fila_no_processo, [fila for _, fila in filas]),
+            ))
+    else:
+        calculadas = {tipo: replanear_fila(*fila) for tipo, fila in filas}
+
+    alterados = []
+    for tipo, preparado in preparados.items():
+        if preparado is None:
+            alterados += replanear_pendentes_por_tipo(exames, tipo, indice=indice)
+        else:
+            alterados += _aplicar_replaneamento(tipo, preparado[0], calculadas[tipo], indice)
+    return alterados
+
+def slot_ocupado(exames, tipo_exame: str, data_str: str, hora_str: str, ignorar_num=None) -> bool:
+    """
+    Retorna True se já há um exame do mesmo tipo no mesmo slot (data+hora).
+    """
+    for e in exames: #vai percorrer a lista de exames que temos e com o e.get (semelhante ao exame[0], por exemplo) vamos buscar o tipo
+        if e.get("tipo") == tipo_exame and e.get("data_marcada") == data_str and e.get("hora_marcada") == hora_str: #a data e a hora disponivel
+            if ignorar_num is not None:
+                try:
+                    if int(e.get("num", -1)) == int(ignorar_num):
+                        continue   #o ignorar_num começa com none (não existente) 
+                except (TypeError, ValueError): #e quando abrimos um exame para editar este parâmetro assume esse número, ignorando-o 
+                    pass  #porque estamos apenas a editar algum parâmetro do exame, não a mudar o número dele
+            return True
+    return False
+
+# =================== REGISTO DE EXAME ===================
+
+# Campos de cada exame, pela ordem em que aparecem no JSON (e nas colunas da base de dados)
+CAMPOS_EXAME = [
+    "num", "paciente", "utente", "nascimento", "tipo",
+    "data_registo", "data_marcada", "hora_marcada", "resultado", "dias_espera"
+]
+
+
+class _TabelaCodigos:
+    """Textos repetidos (tipo, estado) guardados uma vez só: texto <-> código pequeno."""
+
+    def __init__(self, textos=()):
+        self.codigos = {}
+        self._textos = []
+        self._trinco = threading.Lock()
+        for texto in textos:
+            self.codigo(texto)
+
+    def codigo(self, texto):
+        codigo = self.codigos.get(texto)
+        if codigo is None:
+            with self._trinco:
+                codigo = self.codigos.get(texto)
+                if codigo is None:
+                    self._textos.append(texto)
+                    codigo = self.codigos[texto] = len(self._textos) - 1
+        return codigo
+
+    def texto(self, codigo):
+        return self._textos[codigo]
+
+
+_CODIGOS_TIPO = _TabelaCodigos(TIPOS_EXAME)
+_CODIGOS_ESTADO = _TabelaCodigos(["Pendente", "Aprovado", ""])
+
+# horas já convertidas: 'hh:mm' -> minutos desde a meia-noite (e o inverso)
+_MINUTOS_HORA = {}
+_TEXTOS_HORA = {}
+
+
+def _minutos_hora(hora_str):
+    """Minutos desde a meia-noite de uma hora escrita exatamente como hh:mm; None nos outros casos."""
+    if type(hora_str) is not str:
+        return None
+    minutos = _MINUTOS_HORA.get(hora_str)
+    if minutos is None:
+        if (len(hora_str) != 5 or hora_str[2] != ":"
+                or not (hora_str[:2] + hora_str[3:]).isdigit() or not hora_str.isascii()):
+            return None
+        horas, minutos = int(hora_str[:2]), int(hora_str[3:])
+        if horas > 23 or minutos > 59:
+            return None
+        minutos = _MINUTOS_HORA[hora_str] = horas * 60 + minutos
+        _TEXTOS_HORA[minutos] = hora_str
+    return minutos
+
+
+def _ordinal_exato(valor):
+    return _ordinal_data(valor) if type(valor) is str else None
+
+
+def _codigo_tipo(valor):
+    return _CODIGOS_TIPO.codigo(valor) if type(valor) is str else None
+
+
+def _codigo_estado(valor):
+    return _CODIGOS_ESTADO.codigo(valor) if type(valor) is str else None
+
+
+def _sem_codigo(valor):
+    return valor
+
+
+def _estado_do_dia(ordinal_marcada):
+    return "Aprovado" if ordinal_marcada <= _HOJE.ordinal else "Pendente"
+
+
+def _espera_do_dia(ordinal_marcada):
+    return ordinal_marcada - _HOJE.ordinal if ordinal_marcada > _HOJE.ordinal else 0
+
+
+# campo -> (atributo, codificar, descodificar, calcular); codificar devolve None quando o valor não tem código.
+# Com calcular, o valor lido vem da data marcada e do dia de hoje (_HOJE) sempre que há data marcada;
+# o que está guardado no atributo só conta para exames sem data marcada válida.
+_CODIFICACAO = {
+    "num": ("num", _sem_codigo, _sem_codigo, None),
+    "paciente": ("paciente", _sem_codigo, _sem_codigo, None),
+    "utente": ("utente", _sem_codigo, _sem_codigo, None),
+    "nascimento": ("ordinal_nascimento", _ordinal_exato, _texto_data, None),
+    "tipo": ("codigo_tipo", _codigo_tipo, _CODIGOS_TIPO.texto, None),
+    "data_registo": ("ordinal_registo", _ordinal_exato, _texto_data, None),
+    "data_marcada": ("ordinal_marcada", _ordinal_exato, _texto_data, None),
+    "hora_marcada": ("minutos_hora", _minutos_hora, _TEXTOS_HORA.__getitem__, None),
+    "resultado": ("codigo_estado", _codigo_estado, _CODIGOS_ESTADO.texto, _estado_do_dia),
+    "dias_espera": ("dias_espera", _sem_codigo, _sem_codigo, _espera_do_dia),
+}
+
+
+class Exame(MutableMapping):
+    """
+    Registo compacto de um exame (em vez de um dicionário com dez textos):
+    - datas como nº do dia (date.toordinal), hora em minutos desde a meia-noite
+    - tipo e estado como códigos pequenos (cada texto é guardado uma vez só)
+    - __slots__: sem dicionário por exame
+    Continua a comportar-se como o dicionário de antes (exame["tipo"], exame.get("data_marcada"),
+    exame["resultado"] = ..., in, ==, dict(exame)), por isso quem o usa não precisa de saber a diferença.
+    Valores que não têm código (datas fora do formato dd-mm-yyyy, None, campos a mais no JSON)
+    ficam tal e qual em _outros, para o JSON gravado ser igual ao lido. _outros só é None quando
+    os dez campos existem e estão todos em código (o caso normal, que tem caminhos rápidos).
+    O estado e os dias de espera não se guardam de um dia para o outro: com data marcada, são calculados
+    quando se leem, a partir do dia de hoje guardado (_HOJE), e estão sempre certos sem ser preciso
+    percorrer os exames todos.
+    Para JSON usa-se para_dict() (ou json.dump(..., default=para_json)).
+    """
+
+    __slots__ = ("num", "paciente", "utente", "ordinal_nascimento", "codigo_tipo", "ordinal_registo",
+                 "ordinal_marcada", "minutos_hora", "codigo_estado", "dias_espera", "_outros")
+
+    def __init__(self, campos=(), **outros_campos):
+        for atributo, _, _, _ in _CODIFICACAO.values():
+            setattr(self, atributo, None)
+        self._outros = {}
+        self.update(campos, **outros_campos)
+        self._rever_outros()
+
+    @classmethod
+    def de_dict(cls, dados):
+        """Exame a partir de um dicionário (ex.: um objeto do exames.json)."""
+        if type(dados) is cls:
+            return dados
+        exame = cls.__new__(cls)
+        get = dados.get
+        exame.num = get("num")
+        exame.paciente = get("paciente")
+        exame.utente = get("utente")
+        try:
+            # caso normal: todos os textos já foram vistos, são só consultas a dicionários
+            exame.ordinal_nascimento = _ORDINAIS[get("nascimento")]
+            exame.codigo_tipo = _CODIGOS_TIPO.codigos[get("tipo")]
+            exame.ordinal_registo = _ORDINAIS[get("data_registo")]
+            exame.ordinal_marcada = _ORDINAIS[get("data_marcada")]
+            exame.minutos_hora = _MINUTOS_HORA[get("hora_marcada")]
+            exame.codigo_estado = _CODIGOS_ESTADO.codigos[get("resultado")]
+        except (KeyError, TypeError):
+            exame.ordinal_nascimento = _ordinal_exato(get("nascimento"))
+            exame.codigo_tipo = _codigo_tipo(get("tipo"))
+            exame.ordinal_registo = _ordinal_exato(get("data_registo"))
+            exame.ordinal_marcada = _ordinal_exato(get("data_marcada"))
+            exame.minutos_hora = _minutos_hora(get("hora_marcada"))
+            exame.codigo_estado = _codigo_estado(get("resultado"))
+        exame.dias_espera = get("dias_espera")
+        exame._outros = None
+
+        if len(dados) != len(_CODIFICACAO) or None in (
+                exame.num, exame.paciente, exame.utente, exame.ordinal_nascimento, exame.codigo_tipo,
+                exame.ordinal_registo, exame.ordinal_marcada, exame.minutos_hora, exame.codigo_estado,
+                exame.dias_espera):
+            # o que não ficou em código (ou não é um campo conhecido) fica tal e qual
+            outros = {}
+            for campo, valor in dados.items():
+                codificacao = _CODIFICACAO.get(campo)
+                if codificacao is None or getattr(exame, codificacao[0]) is None:
+                    outros[campo] = valor
+            exame._outros = outros
+        return exame
+
+    def para_dict(self):
+        """Dicionário com os mesmos campos e valores que o exame tinha no JSON."""
+        outros = self._outros
+        if outros is None:
+            return {
+                "num": self.num,
+                "paciente": self.paciente,
+                "utente": self.utente,
+                "nascimento": _texto_data(self.ordinal_nascimento),
+                "tipo": _CODIGOS_TIPO.texto(self.codigo_tipo),
+                "data_registo": _texto_data(self.ordinal_registo),
+                "data_marcada": _texto_data(self.ordinal_marcada),
+                "hora_marcada": _TEXTOS_HORA[self.minutos_hora],
+                "resultado": _estado_do_dia(self.ordinal_marcada),
+                "dias_espera": _espera_do_dia(self.ordinal_marcada),
+            }
+        dados = {}
+        for campo, (atributo, _, descodificar, calcular) in _CODIFICACAO.items():
+            valor = getattr(self, atributo)
+            if calcular is not None and self.ordinal_marcada is not None:
+                dados[campo] = calcular(self.ordinal_marcada)
+            elif valor is not None:
+                dados[campo] = descodificar(valor)
+            elif outros is not None and campo in outros:
+                dados[campo] = outros[campo]
+        if outros is not None:
+            for campo, valor in outros.items():
+                if campo not in _CODIFICACAO:
+                    dados[campo] = valor
+        return dados
+
+    def __reduce__(self):
+        # os códigos só valem neste processo: copiar/enviar o exame (pickle, deepcopy) passa pelos textos
+        return (Exame.de_dict, (self.para_dict(),))
+
+    def __repr__(self):
+        return f"Exame({self.para_dict()!r})"
+
+    # ---------- como um dicionário ----------
+
+    def __getitem__(self, campo):
+        codificacao = _CODIFICACAO.get(campo)
+        if codificacao is not None:
+            if codificacao[3] is not None and self.ordinal_marcada is not None:
+                return codificacao[3](self.ordinal_marcada)
+            valor = getattr(self, codificacao[0])
+            if valor is not None:
+                return codificacao[2](valor)
+        if self._outros is not None and campo in self._outros:
+            return self._outros[campo]
+        raise KeyError(campo)
+
+    def get(self, campo, omissao=None):
+        codificacao = _CODIFICACAO.get(campo)
+        if codificacao is not None:
+            if codificacao[3] is not None and self.ordinal_marcada is not None:
+                return codificacao[3](self.ordinal_marcada)
+            valor = getattr(self, codificacao[0])
+            if valor is not None:
+                return codificacao[2](valor)
+        if self._outros is not None:
+            return self._outros.get(campo, omissao)
+        return omissao
+
+    def __setitem__(self, campo, valor):
+        codificacao = _CODIFICACAO.get(campo)
+        if codificacao is not None:
+            codigo = codificacao[1](valor) if valor is not None else None
+            setattr(self, codificacao[0], codigo)
+            if codigo is not None:
+                if self._outros is not None:
+                    self._outros.pop(campo, None)
+                    self._rever_outros()
+                return
+        if self._outros is None:
+            self._outros = {}
+        self._outros[campo] = valor
+
+    def __delitem__(self, campo):
+        codificacao = _CODIFICACAO.get(campo)
+        if codificacao is not None and getattr(self, codificacao[0]) is not None:
+            setattr(self, codificacao[0], None)
+            if self._outros is None:
+                self._outros = {}
+        elif self._outros is not None and campo in self._outros:
+            del self._outros[campo]
+        else:
+            raise KeyError(campo)
+
+    def __contains__(self, campo):
+        codificacao = _CODIFICACAO.get(campo)
+        if codificacao is not None and (getattr(self, codificacao[0]) is not None
+                                        or codificacao[3] is not None and self.ordinal_marcada is not None):
+            return True
+        return self._outros is not None and campo in self._outros
+
+    def __iter__(self):
+        return iter(self.para_dict())
+
+    def __len__(self):
+        return len(self.para_dict())
+
+    def keys(self):
+        return self.para_dict().keys()
+
+    def items(self):
+        return self.para_dict().items()
+
+    def values(self):
+        return self.para_dict().values()
+
+    def __eq__(self, outro):
+        if isinstance(outro, Exame):
+            outro = outro.para_dict()
+        return self.para_dict() == outro
+
+    __hash__ = None
+
+    def copy(self):
+        return Exame.de_dict(self.para_dict())
+
+    # ---------- acesso direto (sem passar pelos textos) ----------
+
+    def marcar(self, ordinal, minutos, codigo_estado, dias_espera):
+        """Escreve a marcação já em códigos (usado pelo motor de agendamento)."""
+        self.ordinal_marcada = ordinal
+        self.minutos_hora = minutos
+        self.codigo_estado = codigo_estado
+        self.dias_espera = dias_espera
+        if self._outros is not None:
+            for campo in ("data_marcada", "hora_marcada", "resultado", "dias_espera"):
+                self._outros.pop(campo, None)
+            self._rever_outros()
+
+    def _rever_outros(self):
+        """Volta a pôr _outros a None quando já não guarda nada e os dez campos estão em código."""
+        if not self._outros and None not in (
+                self.num, self.paciente, self.utente, self.ordinal_nascimento, self.codigo_tipo,
+                self.ordinal_registo, self.ordinal_marcada, self.minutos_hora, self.codigo_estado,
+                self.dias_espera):
+            self._outros = None
+
+
+def _para_registos(dicionarios):
+    """
+    Converte muitos exames lidos (dicionários) em Exame de uma vez. O coletor de lixo fica parado
+    durante a conversão: são objetos novos e sem ciclos, e senão ele corria muitas vezes a meio.
+    """
+    estava_ligado = gc.isenabled()
+    gc.disable()
+    try:
+        return [Exame.de_dict(dados) for dados in dicionarios]
+    finally:
+        if estava_ligado:
+            gc.enable()
+
+
+class _ListaParaJSON(list):
+    """
+    Lista que entrega cada Exame ao json.dump já como dicionário, um de cada vez
+    (mais rápido do que o default=para_json e sem copiar a lista toda para dicionários).
+    """
+
+    def __iter__(self):
+        for exame in list.__iter__(self):
+            yield exame.para_dict() if type(exame) is Exame else exame
+
+
+def para_json(objeto):
+    """Para usar em json.dump(..., default=para_json): converte os Exame em dicionários."""
+    if isinstance(objeto, Exame):
+        return objeto.para_dict()
+    raise TypeError(f"Object of type {type(objeto).__name__} is not JSON serializable")
+
+# =================== ÍNDICE DE OCUPAÇÃO ===================
+
+def _chave_num(num):
+    """Converte o nº de exame em inteiro (como faz o ignorar_num). Devolve None se não for possível."""
+    try:
+        return int(num)
+    except (TypeError, ValueError):
+        return None
+
+
+class CalendarioTipo:
+    """
+    Calendário das vagas de um tipo de exame, em arrays indexados pelo dia (ordinal - origem):
+    - mascaras[d]: o bit i está ligado se a hora horas[i] já tem exame nesse dia
+    - contagens[d]: nº de exames nesse dia (em todas as horas, mesmo as que não são do tipo)
+    Os dias fora dos arrays estão vazios. Só entram as datas escritas exatamente como dd-mm-yyyy
+    (são as únicas que o motor de agendamento marca). Com poucas horas por tipo, cada dia gasta
+    5 bytes: dez anos de calendário são ~18 KB por tipo.
+    O cursor guarda o primeiro dia com vaga a partir do último dia procurado (os dias entre
+    um e outro estão todos cheios), para a procura seguinte não voltar a passar por eles.
+    """
+
+    DIAS_POR_BLOCO = 366   # os arrays crescem um ano de cada vez
+
+    def __init__(self, horas, capacidade):
+        self.horas = tuple(horas)
+        self.capacidade = capacidade
+        self.bit_da_hora = {hora: 1 << i for i, hora in enumerate(self.horas)}
+        self.cheio = (1 << len(self.horas)) - 1
+        self.origem = None
+        self.mascaras = array(self._tipo_mascara(len(self.horas)))
+        self.contagens = array("I")
+        self._procurado_desde = None   # cursor: todos os dias em [_procurado_desde, _cursor) estão cheios
+        self._cursor = None
+
+    @staticmethod
+    def _tipo_mascara(quantas_horas):
+        for codigo in ("B", "H", "I", "Q"):
+            if quantas_horas <= array(codigo).itemsize * 8:
+                return codigo
+        raise ValueError("Demasiadas horas para um calendário de bits.")
+
+    @classmethod
+    def para_tipo(cls, horas, capacidade):
+        """Calendário para estas horas e capacidade, ou None se o tipo não tiver vagas que se possam marcar."""
+        if not horas or capacidade <= 0 or len(set(horas)) != len(horas) or len(horas) > 64:
+            return None
+        return cls(horas, capacidade)
+
+    def _posicao(self, ordinal):
+        """Posição do dia nos arrays, aumentando-os (para trás ou para a frente) se for preciso."""
+        if self.origem is None:
+            self.origem = ordinal
+        d = ordinal - self.origem
+        if d < 0:
+            falta = self.DIAS_POR_BLOCO - d
+            self.mascaras[0:0] = array(self.mascaras.typecode, [0]) * falta
+            self.contagens[0:0] = array("I", [0]) * falta
+            self.origem = self.origem - falta
+            d = d + falta
+        elif d >= len(self.contagens):
+            falta = max(d + 1 - len(self.contagens), self.DIAS_POR_BLOCO)
+            self.mascaras.extend(array(self.mascaras.typecode, [0]) * falta)
+            self.contagens.extend(array("I", [0]) * falta)
+        return d
+
+    def _dia(self, ordinal):
+        """(máscara, nº de exames) de um dia."""
+        if self.origem is not None:
+            d = ordinal - self.origem
+            if 0 <= d < len(self.contagens):
+                return self.mascaras[d], self.contagens[d]
+        return 0, 0
+
+    def entrar(self, ordinal, hora):
+        d = self._posicao(ordinal)
+        self.contagens[d] = self.contagens[d] + 1
+        self.mascaras[d] = self.mascaras[d] | self.bit_da_hora.get(hora, 0)
+
+    def sair(self, ordinal, hora, hora_vazia):
+        """Tira um exame do dia; hora_vazia diz se era o último exame nessa hora."""
+        d = ordinal - self.origem
+        self.contagens[d] = self.contagens[d] - 1
+        if hora_vazia:
+            self.mascaras[d] = self.mascaras[d] & ~self.bit_da_hora.get(hora, 0)
+        if self._cursor is not None and self._procurado_desde <= ordinal < self._cursor:
+            self._cursor = ordinal
+
+    def hora_livre(self, ordinal):
+        """Primeira hora livre num dia, ou None se o dia já não aceita exames."""
+        mascara, ocupados = self._dia(ordinal)
+        if ocupados >= self.capacidade:
+            return None
+        livres = ~mascara & self.cheio
+        if not livres:
+            return None
+        return self.horas[(livres & -livres).bit_length() - 1]
+
+    def proxima_vaga(self, inicio, ajustes=None):
+        """
+        (ordinal, hora) da primeira vaga a partir do dia inicio (ordinal).
+        ajustes = {ordinal: (exames a descontar, bits a desligar)} serve para não contar com exames
+        que estão a ser editados (o ignorar_num).
+        """
+        dia = inicio
+        if self._cursor is not None and self._procurado_desde <= inicio < self._cursor:
+            dia = self._cursor
+        if ajustes:
+            for ordinal in ajustes:
+                if inicio <= ordinal < dia:
+                    dia = ordinal
+
+        while True:
+            mascara, ocupados = self._dia(dia)
+            if ajustes and dia in ajustes:
+                menos, bits = ajustes[dia]
+                ocupados = ocupados - menos
+                mascara = mascara & ~bits
+            if ocupados < self.capacidade:
+                livres = ~mascara & self.cheio
+                if livres:
+                    break
+            dia = dia + 1
+
+        if not ajustes:
+            self._procurado_desde = inicio
+            self._cursor = dia
+        return dia, self.horas[(livres & -livres).bit_length() - 1]
+
+    def dias_com_vaga(self, desde):
+        """Ordinais dos dias (a partir de desde) que já têm exames mas ainda aceitam mais."""
+        dias = []
+        if self.origem is None:
+            return dias
+        mascaras, contagens, cheio, capacidade = self.mascaras, self.contagens, self.cheio, self.capacidade
+        for d in range(max(desde - self.origem, 0), len(contagens)):
+            ocupados = contagens[d]
+            if ocupados and ocupados < capacidade and mascaras[d] != cheio:
+                dias.append(self.origem + d)
+        return dias
+
+    def primeiro_dia_vazio(self, desde):
+        """Primeiro dia (a partir de desde) sem nenhum exame."""
+        dia = desde
+        while self._dia(dia)[1] > 0:
+            dia = dia + 1
+        return dia
+
+
+class IndiceOcupacao:
+    """
+    Índice em memória das vagas ocupadas, para o motor de agendamento não ter de percorrer
+    a lista inteira de exames em cada consulta (contar_marcados / slot_ocupado).
+    Guarda, para cada tipo:
+    - quantos exames há em cada dia e em cada hora desse dia (data_marcada, hora_marcada)
+    - a fila dos exames ordenada por número (usada pelo replaneamento)
+    - onde está cada exame (para o poder tirar do sítio antigo quando muda)
+    - o CalendarioTipo (vagas por dia em bits), com as horas e capacidades dadas
+      (por omissão, HORAS_POR_TIPO e CAPACIDADE_DIARIA)
+    Tem de ser avisado sempre que um exame é adicionado, alterado ou removido.
+    """
+
+    def __init__(self, exames=None, horas_por_tipo=None, capacidade_diaria=None):
+        self.horas_por_tipo = HORAS_POR_TIPO if horas_por_tipo is None else horas_por_tipo
+        self.capacidade_diaria = CAPACIDADE_DIARIA if capacidade_diaria is None else capacidade_diaria
+        self.reconstruir(exames or [])
+
+    def reconstruir(self, exames):
+        """Volta a criar o índice a partir da lista de exames (ex.: depois de ler o ficheiro)."""
+        self._agenda = {}     # tipo -> {data: {hora: nº de exames nesse slot}}
+        self._dias = {}       # tipo -> {data: nº de exames nesse dia}
+        self._fila = {}       # tipo -> lista ordenada de (num, id(exame), exame)
+        self._futuros = {}    # tipo -> a fila sem os exames marcados antes de _futuros_desde (criada no 1º replaneamento)
+        self._futuros_desde = {}  # tipo -> ordinal do dia a partir do qual _futuros foi filtrada
+        self._sem_numero = {} # tipo -> quantos exames sem nº válido (não entram na fila)
+        self._posicoes = {}   # id(exame) -> (exame, tipo, data, hora, num)
+        self._por_num = {}    # num -> lista de id(exame) com esse número
+        self._calendarios = {}  # tipo -> CalendarioTipo
+        for tipo, horas in self.horas_por_tipo.items():
+            calendario = CalendarioTipo.para_tipo(horas, int(self.capacidade_diaria.get(tipo, len(horas))))
+            if calendario is not None:
+                self._calendarios[tipo] = calendario
+
+        for exame in exames:
+            self.adicionar(exame)
+
+    def adicionar(self, exame):
+        """Regista um exame novo no índice."""
+        tipo = exame.get("tipo", "")
+        data = exame.get("data_marcada", "")
+        hora = exame.get("hora_marcada", "")
+        num = _chave_num(exame.get("num"))
+
+        self._entrar_no_slot(tipo, data, hora)
+
+        self._posicoes[id(exame)] = (exame, tipo, data, hora, num)
+        if num is not None:
+            self._por_num.setdefault(num, []).append(id(exame))
+            bisect.insort(self._fila.setdefault(tipo, []), (num, id(exame), exame))
+            if tipo in self._futuros:
+                bisect.insort(self._futuros[tipo], (num, id(exame), exame))
+        else:
+            self._sem_numero[tipo] = self._sem_numero.get(tipo, 0) + 1
+
+    def remover(self, exame):
+        """Tira um exame do índice (usando a posição que tinha quando foi registado)."""
+        posicao = self._posicoes.pop(id(exame), None)
+        if posicao is None:
+            return
+
+        _, tipo, data, hora, num = posicao
+        if data is not None:
+            self._sair_do_slot(tipo, data, hora)
+
+        if num is not None:
+            ids = self._por_num[num]
+            ids.remove(id(exame))
+            if not ids:
+                del self._por_num[num]
+
+            fila = self._fila[tipo]
+            i = bisect.bisect_left(fila, (num, id(exame)))
+            del fila[i]
+            self._sair_dos_futuros(tipo, num, exame)
+        else:
+            self._sem_numero[tipo] = self._sem_numero[tipo] - 1
+
+    def atualizar(self, exame):
+        """Volta a sincronizar um exame que foi alterado no próprio dicionário (tipo, data, hora ou nº)."""
+        posicao = self._posicoes.get(id(exame))
+        if posicao is None:
+            self.adicionar(exame)
+            return
+
+        _, tipo, data, hora, num = posicao
+        nova_data = exame.get("data_marcada", "")
+        nova_hora = exame.get("hora_marcada", "")
+
+        if tipo != exame.get("tipo", "") or num != _chave_num(exame.get("num")):
+            self.remover(exame)
+            self.adicionar(exame)
+        elif data != nova_data or hora != nova_hora:
+            # só mudou de slot: a fila por número fica igual
+            if data is not None:
+                self._sair_do_slot(tipo, data, hora)
+            self._entrar_no_slot(tipo, nova_data, nova_hora)
+            self._posicoes[id(exame)] = (exame, tipo, nova_data, nova_hora, num)
+            if num is not None:
+                self._voltar_aos_futuros(tipo, num, exame)   # pode ter sido remarcado para depois de hoje
+
+    def libertar(self, exame):
+        """
+        Tira o exame do seu slot, mas mantém-no no índice (na fila do tipo).
+        Usado pelo replaneamento: o exame deixa de ocupar a vaga até voltar a ser marcado com atualizar().
+        """
+        posicao = self._posicoes.get(id(exame))
+        if posicao is None or posicao[2] is None:
+            return
+
+        _, tipo, data, hora, num = posicao
+        self._sair_do_slot(tipo, data, hora)
+        self._posicoes[id(exame)] = (exame, tipo, None, None, num)
+
+    def _sair_dos_futuros(self, tipo, num, exame):
+        futuros = self._futuros.get(tipo)
+        if futuros is None:
+            return
+        i = bisect.bisect_left(futuros, (num, id(exame)))
+        if i < len(futuros) and futuros[i][1] == id(exame):
+            del futuros[i]
+
+    def _voltar_aos_futuros(self, tipo, num, exame):
+        futuros = self._futuros.get(tipo)
+        if futuros is None:
+            return
+        i = bisect.bisect_left(futuros, (num, id(exame)))
+        if i == len(futuros) or futuros[i][1] != id(exame):
+            futuros.insert(i, (num, id(exame), exame))
+
+    def _entrar_no_slot(self, tipo, data, hora):
+        dias_tipo = self._dias.setdefault(tipo, {})
+        dias_tipo[data] = dias_tipo.get(data, 0) + 1
+        horas_dia = self._agenda.setdefault(tipo, {}).setdefault(data, {})
+        horas_dia[hora] = horas_dia.get(hora, 0) + 1
+
+        calendario = self._calendarios.get(tipo)
+        if calendario is not None:
+            ordinal = _ordinal_data(data)
+            if ordinal is not None:
+                calendario.entrar(ordinal, hora)
+
+    def _sair_do_slot(self, tipo, data, hora):
+        dias_tipo = self._dias[tipo]
+        agenda_tipo = self._agenda[tipo]
+        horas_dia = agenda_tipo[data]
+
+        if dias_tipo[data] > 1:
+            dias_tipo[data] = dias_tipo[data] - 1
+        else:
+            del dias_tipo[data]
+            del agenda_tipo[data]
+        hora_vazia = horas_dia[hora] == 1
+        if hora_vazia:
+            del horas_dia[hora]
+        else:
+            horas_dia[hora] = horas_dia[hora] - 1
+
+        calendario = self._calendarios.get(tipo)
+        if calendario is not None:
+            ordinal = _ordinal_data(data)
+            if ordinal is not None:
+                calendario.sair(ordinal, hora, hora_vazia)
+
+    def contar(self, tipo_exame, data_marcada_str, ignorar_num=None):
+        """Mesmo resultado que contar_marcados, mas sem percorrer a lista."""
+        dias_tipo = self._dias.get(tipo_exame)
+        if not dias_tipo:
+            return 0
+        total = dias_tipo.get(data_marcada_str, 0)
+        if total == 0:
+            return 0
+        return total - self._contar_ignorados(tipo_exame, data_marcada_str, None, ignorar_num)
+
+    def ocupado(self, tipo_exame, data_str, hora_str, ignorar_num=None):
+        """Mesmo resultado que slot_ocupado, mas sem percorrer a lista."""
+        horas_dia = self._agenda.get(tipo_exame, {}).get(data_str)
+        if not horas_dia:
+            return False
+        total = horas_dia.get(hora_str, 0)
+        if total == 0:
+            return False
+        return total - self._contar_ignorados(tipo_exame, data_str, hora_str, ignorar_num) > 0
+
+    def dias_do_tipo(self, tipo_exame):
+        """Dicionário {data_marcada: nº de exames} de um tipo (só para leitura)."""
+        return self._dias.get(tipo_exame, {})
+
+    def horas_do_dia(self, tipo_exame, data_str):
+        """Dicionário {hora_marcada: nº de exames} de um tipo num dia (só para leitura)."""
+        return self._agenda.get(tipo_exame, {}).get(data_str, {})
+
+    def calendario(self, tipo_exame):
+        """CalendarioTipo de um tipo, ou None se o tipo não tiver horas ou capacidade."""
+        return self._calendarios.get(tipo_exame)
+
+    def proxima_vaga(self, tipo_exame, inicio, ignorar_num=None):
+        """
+        Mesmo resultado que primeira_marcacao_livre, lido do calendário do tipo: devolve (dia, hora),
+        ou None se o tipo não tiver calendário.
+        """
+        calendario = self._calendarios.get(tipo_exame)
+        if calendario is None:
+            return None
+
+        # os exames com o nº ignorar_num não contam: descontam-se nos dias onde estão
+        ajustes = None
+        num = _chave_num(ignorar_num) if ignorar_num is not None else None
+        for id_exame in self._por_num.get(num, ()):
+            _, tipo, data, hora, _ = self._posicoes[id_exame]
+            ordinal = _ordinal_data(data) if tipo == tipo_exame and data is not None else None
+            if ordinal is None:
+                continue
+            if ajustes is None:
+                ajustes = {}
+            menos, bits = ajustes.get(ordinal, (0, 0))
+            if self._agenda[tipo][data][hora] == self._contar_ignorados(tipo, data, hora, num):
+                bits = bits | calendario.bit_da_hora.get(hora, 0)
+            ajustes[ordinal] = (menos + 1, bits)
+
+        ordinal, hora = calendario.proxima_vaga(inicio.toordinal(), ajustes)
+        return date.fromordinal(ordinal), hora
+
+    def exames_com_num(self, num):
+        """
+        Exames cujo nº, escrito como texto, é str(num), pela ordem em que entraram no índice.
+        Devolve None se num não for um inteiro (esses números não estão no índice).
+        """
+        chave = _chave_num(num)
+        if chave is None:
+            return None
+        texto = str(num)
+        posicoes = self._posicoes
+        encontrados = []
+        for id_exame in self._por_num.get(chave, ()):
+            exame = posicoes[id_exame][0]
+            if str(exame.get("num")) == texto:   # " 12" e "12" têm a mesma chave, mas não são o mesmo nº
+                encontrados.append(exame)
+        return encontrados
+
+    def maior_num(self):
+        """Maior nº (inteiro) de exame no índice; 0 se não houver nenhum."""
+        return max(self._por_num, default=0)
+
+    def fila_do_tipo(self, tipo_exame, desde=None):
+        """
+        Exames de um tipo ordenados por número (a mesma ordem que o replaneamento usa).
+        Com desde (ordinal de um dia) pode deixar de fora exames marcados antes desse dia, que o
+        replaneamento não mexe: assim cada marcação não percorre o histórico todo do tipo.
+        Devolve None se houver exames desse tipo sem número válido, porque aí não há ordem definida.
+        """
+        if self._sem_numero.get(tipo_exame, 0) > 0:
+            return None
+        if desde is None:
+            return [exame for _, _, exame in self._fila.get(tipo_exame, [])]
+
+        futuros = self._futuros.get(tipo_exame)
+        if futuros is None or desde != self._futuros_desde[tipo_exame]:
+            if futuros is None or desde < self._futuros_desde[tipo_exame]:
+                futuros = self._fila.get(tipo_exame, [])   # 1ª vez, ou o dia andou para trás: a fila toda
+            # só saem os exames com data válida antes de desde (os outros o replaneamento ainda vê)
+            posicoes = self._posicoes
+            mantidos = []
+            for entrada in futuros:
+                data = posicoes[entrada[1]][2]
+                ordinal = None if data is None else _ordinal_data(data)
+                if ordinal is None or ordinal >= desde:
+                    mantidos.append(entrada)
+            futuros = self._futuros[tipo_exame] = mantidos
+            self._futuros_desde[tipo_exame] = desde
+        return [exame for _, _, exame in futuros]
+
+    def _contar_ignorados(self, tipo_exame, data_str, hora_str, ignorar_num):
+        """Quantos exames com o nº ignorar_num estão nesse dia (ou nesse slot, se hora_str for dada)."""
+        if ignorar_num is None:
+            return 0
+        num = _chave_num(ignorar_num)
+        if num is None:
+            return 0
+
+        quantos = 0
+        for id_exame in self._por_num.get(num, ()):
+            _, tipo, data, hora, _ = self._posicoes[id_exame]
+            if tipo == tipo_exame and data == data_str and (hora_str is None or hora == hora_str):
+                quantos = quantos + 1
+        return quantos
+
+# =================== ÍNDICE DE PESQUISA ===================
+
+def _trigramas(texto):
+    """Conjunto dos pedaços de 3 letras seguidas de um texto."""
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+class _IndiceSubtexto:
+    """
+    Índice de um campo de texto para pesquisa "contém":
+    - valor -> linhas com esse valor (serve também de pesquisa exata, ex.: nº de utente)
+    - trigrama -> valores que o contêm (só os valores diferentes, não as linhas)
+    """
+
+    def __init__(self):
+        self.linhas_por_valor = {}
+        self.valores_por_trigrama = {}
+
+    def adicionar(self, valor, linha):
+        linhas = self.linhas_por_valor.get(valor)
+        if linhas is None:
+            linhas = self.linhas_por_valor[valor] = set()
+            for trigrama in _trigramas(valor):
+                self.valores_por_trigrama.setdefault(trigrama, set()).add(valor)
+        linhas.add(linha)
+
+    def remover(self, valor, linha):
+        linhas = self.linhas_por_valor[valor]
+        linhas.discard(linha)
+        if not linhas:
+            del self.linhas_por_valor[valor]
+            for trigrama in _trigramas(valor):
+                valores = self.valores_por_trigrama[trigrama]
+                valores.discard(valor)
+                if not valores:
+                    del self.valores_por_trigrama[trigrama]
+
+    def valores_que_contem(self, termo):
+        """Valores (diferentes) em que o termo aparece."""
+        if len(termo) < 3:
+            return [v for v in self.linhas_por_valor if termo in v]
+
+        candidatos = None
+        for trigrama in sorted(_trigramas(termo), key=lambda t: len(self.valores_por_trigrama.get(t, ()))):
+            valores = self.valores_por_trigrama.get(trigrama)
+            if not valores:
+                return []
+            if candidatos is None:
+                candidatos = set(valores)
+            else:
+                candidatos &= valores
+            if not candidatos:
+                return []
+        return [v for v in candidatos if termo in v]  # os trigramas não garantem a ordem, confirmar
+
+
+class _IndiceValores:
+    """
+    Índice exato de um campo (valor -> linhas), usado para o nº de utente.
+    Para a pesquisa "contém", os valores diferentes são juntos num só texto (refeito só quando
+    aparecem ou desaparecem valores) e procurados com uma única pesquisa sobre esse texto.
+    """
+
+    def __init__(self):
+        self.linhas_por_valor = {}
+        self._texto = None     # valores separados por "\n" (None = tem de ser refeito)
+        self._inicios = []     # posição no texto onde começa cada valor
+        self._valores = []
+
+    def adicionar(self, valor, linha):
+        linhas = self.linhas_por_valor.get(valor)
+        if linhas is None:
+            linhas = self.linhas_por_valor[valor] = set()
+            self._texto = None
+        linhas.add(linha)
+
+    def remover(self, valor, linha):
+        linhas = self.linhas_por_valor[valor]
+        linhas.discard(linha)
+        if not linhas:
+            del self.linhas_por_valor[valor]
+            self._texto = None
+
+    def valores_que_contem(self, termo):
+        if self._texto is None:
+            self._valores = list(self.linhas_por_valor)
+            self._texto = "\n".join(self._valores)
+            self._inicios = []
+            posicao = 0
+            for valor in self._valores:
+                self._inicios.append(posicao)
+                posicao = posicao + len(valor) + 1
+
+        encontrados = set()
+        posicao = self._texto.find(termo)
+        while posicao != -1:
+            i = bisect.bisect_right(self._inicios, posicao) - 1
+            encontrados.add(self._valores[i])
+            posicao = self._texto.find(termo, posicao + 1)
+        return list(encontrados)
+
+
+# para cada valor de um byte, as posições dos bits a 1
+_BITS_DO_BYTE = [tuple(bit for bit in range(8) if valor >> bit & 1) for valor in range(256)]
+_BYTE_NAO_NULO = re.compile(rb"[^\x00]")
+
+
+class IndicePesquisa:
+    """
+    Índice para a caixa de pesquisa (nome, tipo, nº de utente ou estado), atualizado exame a exame.
+    Cada exame tem um nº de linha interno e:
+    - nome do paciente: índice por trigramas (pesquisa "contém")
+    - nº de utente: índice exato por valor (e pesquisa "contém" sobre os valores diferentes)
+    - tipo e estado: um bitmap por valor (1 bit por linha)
+    Dá o mesmo resultado que filtrar_exames, sem percorrer todos os exames.
+    Pode ser consultado noutra thread (pesquisa em direto): todas as operações usam o mesmo trinco.
+    """
+
+    def __init__(self, exames=None):
+        self._trinco = threading.RLock()
+        self.reconstruir(exames or [])
+
+    def reconstruir(self, exames):
+        with self._trinco:
+            self._reconstruir(exames)
+
+    def _reconstruir(self, exames):
+        self._linhas = {}        # id(exame) -> nº de linha
+        self._exames = []        # nº de linha -> exame (None se a linha estiver livre)
+        self._chaves = []        # nº de linha -> (nome, tipo, utente, estado) em minúsculas
+        self._livres = []
+        self._nomes = _IndiceSubtexto()
+        self._utentes = _IndiceValores()
+        self._por_tipo = {}      # tipo -> bytearray com 1 bit por linha
+        self._por_estado = {}    # estado -> bytearray com 1 bit por linha
+
+        for exame in exames:
+            self.adicionar(exame)
+
+    def adicionar(self, exame):
+        """Indexa um exame novo."""
+        with self._trinco:
+            chaves = self._chaves_de(exame)
+            if self._livres:
+                linha = self._livres.pop()
+                self._exames[linha] = exame
+                self._chaves[linha] = chaves
+            else:
+                linha = len(self._exames)
+                self._exames.append(exame)
+                self._chaves.append(chaves)
+            self._linhas[id(exame)] = linha
+
+            nome, tipo, utente, estado = chaves
+            self._nomes.adicionar(nome, linha)
+            self._utentes.adicionar(utente, linha)
+            self._ligar_bit(self._por_tipo, tipo, linha)
+            self._ligar_bit(self._por_estado, estado, linha)
+
+    def remover(self, exame):
+        """Tira um exame do índice (com os valores que tinha quando foi indexado)."""
+        with self._trinco:
+            linha = self._linhas.pop(id(exame), None)
+            if linha is None:
+                return
+
+            nome, tipo, utente, estado = self._chaves[linha]
+            self._nomes.remover(nome, linha)
+            self._utentes.remover(utente, linha)
+            self._por_tipo[tipo][linha >> 3] &= ~(1 << (linha & 7)) & 0xFF
+            self._por_estado[estado][linha >> 3] &= ~(1 << (linha & 7)) & 0xFF
+
+            self._exames[linha] = None
+            self._chaves[linha] = None
+            self._livres.append(linha)
+
+    def atualizar(self, exame):
+        """Volta a indexar um exame que mudou (ou indexa-o, se ainda não estiver no índice)."""
+        with self._trinco:
+            linha = self._linhas.get(id(exame))
+            if linha is not None:
+                if self._chaves[linha] == self._chaves_de(exame):
+                    return
+                self.remover(exame)
+            self.adicionar(exame)
+
+    def pesquisar(self, termo):
+        """Exames em que o termo (em minúsculas) aparece no nome, tipo, nº de utente ou estado."""
+        with self._trinco:
+            resultado = 0
+            for bitmaps in (self._por_tipo, self._por_estado):
+                for valor, bits in bitmaps.items():
+                    if termo in valor:
+                        resultado |= int.from_bytes(bits, "little")
+
+            linhas = set()
+            for indice in (self._nomes, self._utentes):
+                for valor in indice.valores_que_contem(termo):
+                    linhas.update(indice.linhas_por_valor[valor])
+            if linhas:
+                bits = bytearray(len(self._exames) // 8 + 1)
+                for linha in linhas:
+                    bits[linha >> 3] |= 1 << (linha & 7)
+                resultado |= int.from_bytes(bits, "little")
+
+            return self._exames_do_bitmap(resultado)
+
+    def _exames_do_bitmap(self, bitmap):
+        exames = []
+        if not bitmap:
+            return exames
+        dados = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+        for ocorrencia in _BYTE_NAO_NULO.finditer(dados):  # salta os bytes a zero sem os percorrer em Python
+            posicao = ocorrencia.start()
+            base = posicao * 8
+            for bit in _BITS_DO_BYTE[dados[posicao]]:
+                exames.append(self._exames[base + bit])
+        return exames
+
+    @staticmethod
+    def _chaves_de(exame):
+        return (
+            exame.get("paciente", "").lower(),
+            exame.get("tipo", "").lower(),
+            exame.get("utente", "").lower(),
+            exame.get("resultado", "").lower(),
+        )
+
+    @staticmethod
+    def _ligar_bit(bitmaps, valor, linha):
+        bits = bitmaps.get(valor)
+        if bits is None:
+            bits = bitmaps[valor] = bytearray()
+        if len(bits) <= linha >> 3:
+            bits.extend(bytes((linha >> 3) + 1 - len(bits) + 1024))  # crescer aos bocados
+        bits[linha >> 3] |= 1 << (linha & 7)
+
+# =================== ÍNDICE DE ORDENAÇÃO ===================
+
+class ListaOrdenada:
+    """
+    Lista sempre ordenada, guardada em blocos (listas ordenadas pequenas, com o último valor
+    de cada bloco à parte para a bisseção). Inserir e remover custam O(log n) para encontrar
+    o bloco e O(TAMANHO_BLOCO) para mexer nele, em vez de O(n) numa lista única.
+    Os valores têm de ser comparáveis e diferentes entre si.
+    """
+
+    TAMANHO_BLOCO = 1000
+
+    def __init__(self, valores=()):
+        ordenados = sorted(valores)
+        self._blocos = [ordenados[i:i + self.TAMANHO_BLOCO]
+                        for i in range(0, len(ordenados), self.TAMANHO_BLOCO)]
+        self._ultimos = [bloco[-1] for bloco in self._blocos]
+        self._tamanho = len(ordenados)
+
+    def __len__(self):
+        return self._tamanho
+
+    def __iter__(self):
+        for bloco in self._blocos:
+            yield from bloco
+
+    def entre(self, minimo, maximo):
+        """Valores v com minimo <= v < maximo, por ordem."""
+        valores = []
+        i = bisect.bisect_left(self._ultimos, minimo)
+        j = bisect.bisect_left(self._blocos[i], minimo) if i < len(self._blocos) else 0
+        while i < len(self._blocos):
+            bloco = self._blocos[i]
+            fim = bisect.bisect_left(bloco, maximo)
+            valores.extend(bloco[j:fim])
+            if fim < len(bloco):
+                break
+            i, j = i + 1, 0
+        return valores
+
+    def adicionar(self, valor):
+        if not self._blocos:
+            self._blocos.append([valor])
+            self._ultimos.append(valor)
+            self._tamanho = 1
+            return
+
+        i = bisect.bisect_left(self._ultimos, valor)
+        if i == len(self._blocos):
+            i = i - 1                      # maior do que todos: vai para o fim do último bloco
+            self._blocos[i].append(valor)
+            self._ultimos[i] = valor
+        else:
+            bisect.insort(self._blocos[i], valor)
+        self._tamanho = self._tamanho + 1
+
+        bloco = self._blocos[i]
+        if len(bloco) > 2 * self.TAMANHO_BLOCO:
+            metade = len(bloco) // 2
+            self._blocos[i:i + 1] = [bloco[:metade], bloco[metade:]]
+            self._ultimos[i:i + 1] = [bloco[metade - 1], bloco[-1]]
+
+    def remover(self, valor):
+        """Tira o valor da lista (ValueError se não estiver lá)."""
+        i = bisect.bisect_left(self._ultimos, valor)
+        if i < len(self._blocos):
+            bloco = self._blocos[i]
+            j = bisect.bisect_left(bloco, valor)
+            if j < len(bloco) and bloco[j] == valor:
+                del bloco[j]
+                self._tamanho = self._tamanho - 1
+                if not bloco:
+                    del self._blocos[i]
+                    del self._ultimos[i]
+                else:
+                    self._ultimos[i] = bloco[-1]
+                return
+        raise ValueError("O valor não está na lista.")
+
+
+def _chave_numero(num):
+    numero = _chave_num(num)
+    return (0, numero, "") if numero is not None else (1, 0, str(num))
+
+
+def _chave_texto(valor):
+    return "" if valor is None else str(valor).lower()
+
+
+def _chave_data(data_str):
+    return (_ordinal_qualquer(data_str), "" if data_str is None else str(data_str))
+
+
+def _chave_hora(exame):
+    ordinal, minutos = chave_ordem(exame)
+    return (minutos, ordinal)
+
+
+# Chave de ordenação de cada coluna da tabela (clique no cabeçalho).
+# Os dias de espera ordenam-se pela data marcada: dá a mesma ordem e não muda de um dia para o outro.
+_CHAVES_COLUNA = {
+    "num": lambda exame: _chave_numero(exame.get("num")),
+    "paciente": lambda exame: _chave_texto(exame.get("paciente")),
+    "utente": lambda exame: _chave_texto(exame.get("utente")),
+    "nascimento": lambda exame: _chave_data(exame.get("nascimento")),
+    "tipo": lambda exame: _chave_texto(exame.get("tipo")),
+    "data_registo": lambda exame: _chave_data(exame.get("data_registo")),
+    "data_marcada": chave_ordem,
+    "hora_marcada": _chave_hora,
+    "dias_espera": chave_ordem,
+    "resultado": lambda exame: _chave_texto(exame.get("resultado")),
+}
+
+
+class IndiceOrdem:
+    """
+    Ordem da tabela, mantida exame a exame em vez de ordenar a lista toda em cada atualização:
+    - ordem cronológica (chave_ordem, e o nº do exame para desempatar) numa ListaOrdenada
+    - para as outras colunas, as chaves de cada exame ficam guardadas depois da 1ª ordenação
+      e só são recalculadas para os exames que mudam
+    Tem de ser avisado sempre que um exame é adicionado, alterado ou removido.
+    Pode ser consultado noutra thread (pesquisa em direto): todas as operações usam o mesmo trinco.
+    """
+
+    def __init__(self, exames=None):
+        self._trinco = threading.RLock()
+        self.reconstruir(exames or [])
+
+    def reconstruir(self, exames):
+        with self._trinco:
+            self._elementos = {}    # id(exame) -> (dia, minutos, nº, id, exame), o valor na ListaOrdenada
+            self._por_coluna = {}   # coluna -> {id(exame): chave}
+            self._tudo_por_coluna = {}  # coluna -> (versão, todos os exames por essa coluna, ascendente)
+            self._versao = 0        # muda sempre que um exame entra, sai ou muda
+            for exame in exames:
+                self._elementos[id(exame)] = self._elemento(exame)
+            self._ordem = ListaOrdenada(self._elementos.values())
+
+    def adicionar(self, exame):
+        self.atualizar(exame)
+
+    def remover(self, exame):
+        with self._trinco:
+            elemento = self._elementos.pop(id(exame), None)
+            if elemento is None:
+                return
+            self._ordem.remover(elemento)
+            for chaves in self._por_coluna.values():
+                chaves.pop(id(exame), None)
+            self._versao = self._versao + 1
+
+    def atualizar(self, exame):
+        """Volta a pôr no sítio um exame que mudou (ou junta-o, se ainda não estiver no índice)."""
+        with self._trinco:
+            for chaves in self._por_coluna.values():
+                chaves.pop(id(exame), None)
+            self._versao = self._versao + 1
+            elemento = self._elemento(exame)
+            antigo = self._elementos.get(id(exame))
+            if antigo == elemento:
+                return
+            if antigo is not None:
+                self._ordem.remover(antigo)
+            self._ordem.adicionar(elemento)
+            self._elementos[id(exame)] = elemento
+
+    def ordenar(self, exames, coluna=None, decrescente=False):
+        """
+        Devolve os exames ordenados por data e hora (coluna None) ou pela coluna indicada.
+        Os exames têm de estar no índice; exames é a lista toda ou um subconjunto (resultado da pesquisa).
+        """
+        with self._trinco:
+            if coluna == "data_marcada":
+                coluna = None
+            tudo = len(exames) == len(self._elementos)
+
+            if tudo and coluna is not None:
+                # a lista toda já foi ordenada por esta coluna e nada mudou: basta copiar (ou inverter)
+                guardada = self._tudo_por_coluna.get(coluna)
+                if guardada is not None and guardada[0] == self._versao:
+                    return guardada[1][::-1] if decrescente else list(guardada[1])
+
+            if len(exames) * 4 >= len(self._elementos):
+                # muitos exames: percorrer a ordem já feita é mais rápido do que ordenar
+                ids = None if tudo else {id(exame) for exame in exames}
+                ordenados = [elemento[4] for elemento in self._ordem if ids is None or elemento[3] in ids]
+            else:
+                elementos = self._elementos
+                ordenados = sorted(exames, key=lambda exame: elementos.get(id(exame)) or self._elemento(exame))
+
+            if coluna is not None:
+                chaves = self._chaves_da_coluna(coluna, ordenados)
+                # sort estável: dentro da mesma chave fica a ordem cronológica
+                ordenados.sort(key=lambda exame: chaves[id(exame)])
+                if tudo:
+                    self._tudo_por_coluna[coluna] = (self._versao, ordenados)
+                    ordenados = list(ordenados)
+            if decrescente:
+                ordenados.reverse()
+            return ordenados
+
+    def exames_entre_dias(self, primeiro, ultimo):
+        """Exames marcados do dia primeiro ao dia ultimo (nº do dia, ambos incluídos), por data e hora."""
+        with self._trinco:
+            return [elemento[4] for elemento in self._ordem.entre((primeiro,), (ultimo + 1,))]
+
+    def _chaves_da_coluna(self, coluna, exames):
+        chaves = self._por_coluna.setdefault(coluna, {})
+        calcular = _CHAVES_COLUNA[coluna]
+        for exame in exames:
+            if id(exame) not in chaves:
+                chaves[id(exame)] = calcular(exame)
+        return chaves
+
+    @staticmethod
+    def _elemento(exame):
+        dia, minutos = chave_ordem(exame)
+        numero = _chave_num(exame.get("num"))
+        return (dia, minutos, numero if numero is not None else -1, id(exame), exame)
+
+# =================== COLUNAS PARA ANÁLISE ===================
+
+class ColunasExames:
+    """
+    Os campos numéricos dos exames em colunas (array), uma linha por exame, para as estatísticas
+    (analise_exames.py lê-as com NumPy de uma vez, sem passar exame a exame):
+    - tipos: código do tipo (o de _CODIGOS_TIPO; -1 nas linhas livres)
+    - marcadas e registos: nº do dia da data marcada e da data de registo (-1 se não houver data válida)
+    Como os outros índices, tem de ser avisado sempre que um exame é adicionado, alterado ou removido.
+    Pode ser copiado noutra thread: todas as operações usam o mesmo trinco.
+    """
+
+    def __init__(self, exames=None):
+        self._trinco = threading.RLock()
+        self.reconstruir(exames or [])
+
+    def reconstruir(self, exames):
+        with self._trinco:
+            self._linhas = {id(exame): linha for linha, exame in enumerate(exames)}   # id(exame) -> nº de linha
+            self._livres = []
+            if len(self._linhas) == len(exames) and all(type(exame) is Exame for exame in exames):
+                # caso normal: de uma vez, coluna a coluna (é o que custa na primeira análise)
+                self.tipos = array("i", [-1 if e.codigo_tipo is None else e.codigo_tipo for e in exames])
+                self.marcadas = array("i", [-1 if e.ordinal_marcada is None else e.ordinal_marcada for e in exames])
+                self.registos = array("i", [-1 if e.ordinal_registo is None else e.ordinal_registo for e in exames])
+                return
+            self._linhas = {}
+            self.tipos = array("i")
+            self.marcadas = array("i")
+            self.registos = array("i")
+            for exame in exames:
+                self.atualizar(exame)
+
+    def atualizar(self, exame):
+        """Escreve (ou volta a escrever) a linha de um exame."""
+        tipo, marcada, registo = self._valores(exame)
+        with self._trinco:
+            linha = self._linhas.get(id(exame))
+            if linha is None:
+                if self._livres:
+                    linha = self._livres.pop()
+                else:
+                    linha = len(self.tipos)
+                    self.tipos.append(-1)
+                    self.marcadas.append(-1)
+                    self.registos.append(-1)
+                self._linhas[id(exame)] = linha
+            self.tipos[linha] = tipo
+            self.marcadas[linha] = marcada
+            self.registos[linha] = registo
+
+    def remover(self, exame):
+        with self._trinco:
+            linha = self._linhas.pop(id(exame), None)
+            if linha is None:
+                return
+            self.tipos[linha] = -1
+            self.marcadas[linha] = -1
+            self.registos[linha] = -1
+            self._livres.append(linha)
+
+    def copiar(self):
+        """Cópia das três colunas (tipos, marcadas, registos), tiradas ao mesmo tempo."""
+        with self._trinco:
+            return self.tipos[:], self.marcadas[:], self.registos[:]
+
+    @staticmethod
+    def nomes_dos_tipos():
+        """Texto de cada código de tipo (a posição na lista é o código)."""
+        return [_CODIGOS_TIPO.texto(codigo) for codigo in range(len(_CODIGOS_TIPO.codigos))]
+
+    @staticmethod
+    def _valores(exame):
+        if type(exame) is Exame:
+            tipo, marcada, registo = exame.codigo_tipo, exame.ordinal_marcada, exame.ordinal_registo
+        else:
+            tipo = _codigo_tipo(exame.get("tipo"))
+            marcada = _ordinal_exato(exame.get("data_marcada"))
+            registo = _ordinal_exato(exame.get("data_registo"))
+        return (-1 if tipo is None else tipo,
+                -1 if marcada is None else marcada,
+                -1 if registo is None else registo)
+
+# =================== ARMAZENAMENTO ===================
+
+class _TrincoFicheiro:
+    """
+    Trinco de ficheiro do sistema operativo (fcntl.flock em Linux/macOS, msvcrt.locking em Windows),
+    para várias instâncias da aplicação não lerem/escreverem o exames.json ao mesmo tempo.
+    É só um aviso entre instâncias desta aplicação (não impede outros programas de mexer no ficheiro).
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._ficheiro = None
+
+    def __enter__(self):
+        self._ficheiro = open(self.caminho, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._ficheiro.fileno(), fcntl.LOCK_EX)
+        else:
+            self._ficheiro.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._ficheiro.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass   # LK_LOCK desiste ao fim de 10 s: continuar à espera
+        return self
+
+    def __exit__(self, *erro):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._ficheiro.fileno(), fcntl.LOCK_UN)
+            else:
+                self._ficheiro.seek(0)
+                msvcrt.locking(self._ficheiro.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._ficheiro.close()
+            self._ficheiro = None
+
+
+class ArmazenamentoJSON:
+    """
+    Guarda os exames no ficheiro JSON (o formato original).
+    Todas as escritas do ficheiro são atómicas: escreve-se um ficheiro temporário, faz-se fsync
+    e só depois se troca pelo ficheiro verdadeiro (um crash a meio nunca deixa o JSON cortado).
+
+    Com diario=True, gravar_alteracoes não reescreve o ficheiro: acrescenta as alterações
+    (uma por linha) a um diário ao lado do exames.json. Quando o diário passa de
+    COMPACTAR_DIARIO_APOS registos, uma thread junta-o ao JSON (compactação).
+    Ao ler, aplica-se o diário por cima do JSON.
+    O diário identifica os exames pelo nº: se o JSON tiver nºs repetidos (ficheiros antigos),
+    não se compacta e as alterações voltam a reescrever o ficheiro todo, para não se perder nenhum exame.
+
+    Várias instâncias da aplicação podem usar o mesmo exames.json:
+    - cada leitura/escrita é feita com o ficheiro trancado (exames.json.lock, trinco do sistema operativo)
+    - o exames.json.versao tem um nº que aumenta a cada escrita; cada instância lembra-se da versão que leu
+      e só grava se a versão ainda for essa (senão lança ConflitoVersao, e quem chama junta as alterações)
+    - os números dos exames novos vêm do exames.json.sequencia (reservar_numeros), com o seu próprio trinco
+    """
+
+    def __init__(self, caminho=FICHEIRO_EXAMES, diario=False):
+        self.caminho = caminho
+        self.diario = diario
+        self.caminho_diario = caminho + ".diario"
+        self.caminho_compactar = caminho + ".diario.compactar"
+        self.caminho_versao = caminho + ".versao"
+        self.caminho_trinco = caminho + ".lock"
+        self.caminho_sequencia = caminho + ".sequencia"
+        self.caminho_trinco_sequencia = caminho + ".sequencia.lock"
+        self.versao = None   # versão do ficheiro que esta instância leu (ou escreveu) por último
+
+        self._trinco = threading.Lock()              # escrita no diário
+        self._trinco_compactacao = threading.Lock()  # passos curtos da compactação vs. leitura
+        self._a_compactar = threading.Lock()         # uma compactação de cada vez
+        self._trinco_sequencia = threading.Lock()    # reserva de números
+        self._registos_diario = None                 # contados na primeira escrita
+        self._nums_repetidos = False                 # o JSON lido/gravado por último tem nºs repetidos
+        self._compactacao = None
+
+    def ler(self):
+        with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco):
+            self.versao = self._ler_versao()
+            return self._ler_tudo()
+
+    def _ler_tudo(self):
+        exames = self._ler_json()
+
+        diarios = [c for c in (self.caminho_compactar, self.caminho_diario) if os.path.exists(c)]
+        if diarios or self.diario:
+            exames, posicoes = _posicoes_por_num(exames)
+            self._nums_repetidos = _ha_repetidos(posicoes)
+            for caminho in diarios:
+                with open(caminho, "r", encoding="utf-8") as f:
+                    self._reproduzir_diario(f, exames, posicoes)
+            exames = [exame for exame in exames if exame is not None]
+        return _para_registos(exames)
+
+    def gravar_tudo(self, exames):
+        """
+        Grava a lista completa no JSON. Com diário, o diário deixa de ser preciso e é apagado
+        (a lista já inclui tudo o que lá estava; se houver um crash antes de o apagar,
+        voltar a aplicá-lo não muda nada).
+        Lança ConflitoVersao se outra instância tiver gravado depois da nossa última leitura.
+        """
+        with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco), self._trinco:
+            self._avancar_versao()
+            self._escrever_tudo(exames)
+
+    def fundir_e_gravar(self, fundir):
+        """
+        Para resolver um ConflitoVersao: com o ficheiro trancado do princípio ao fim, lê os exames atuais,
+        chama fundir(exames_do_ficheiro) e grava a lista que fundir devolver.
+        Como nenhuma outra instância pode gravar pelo meio, esta gravação nunca dá conflito.
+        """
+        with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco), self._trinco:
+            self.versao = self._ler_versao()
+            exames = fundir(self._ler_tudo())
+            self._avancar_versao()
+            self._escrever_tudo(exames)
+
+    def _escrever_tudo(self, exames):
+        _escrever_json_atomico(self.caminho, exames)
+        if self.diario:
+            self._nums_repetidos = _ha_repetidos(_posicoes_por_num(exames)[1])
+        for caminho in (self.caminho_compactar, self.caminho_diario):
+            if os.path.exists(caminho):
+                os.remove(caminho)
+        self._registos_diario = 0
+
+    def gravar_alteracoes(self, exames, alterados, removidos):
+        if not self.diario or (self._nums_repetidos and exames is not None):
+            self.gravar_tudo(exames)
+            return
+
+        linhas = []
+        for exame in alterados:
+            linhas.append(json.dumps({"op": "gravar", "exame": exame}, ensure_ascii=False, default=para_json))
+        for exame in removidos:
+            linhas.append(json.dumps({"op": "apagar", "num": exame.get("num")}, ensure_ascii=False))
+        if not linhas:
+            return
+
+        with _TrincoFicheiro(self.caminho_trinco), self._trinco:
+            self._avancar_versao()
+            if self._registos_diario is None:
+                self._registos_diario = self._contar_registos(self.caminho_diario)
+            self._acrescentar_ao_diario(linhas)
+            self._registos_diario = self._registos_diario + len(linhas)
+            precisa_compactar = self._registos_diario >= COMPACTAR_DIARIO_APOS
+
+        if precisa_compactar and not self._nums_repetidos and (
+                self._compactacao is None or not self._compactacao.is_alive()):
+            self._compactacao = threading.Thread(target=self.compactar, daemon=True)
+            self._compactacao.start()
+
+    def compactar(self):
+        """
+        Junta o diário ao JSON:
+        1) o diário atual passa a .diario.compactar (as novas alterações vão para um diário novo)
+        2) JSON + .diario.compactar são gravados num JSON temporário
+        3) o temporário passa a ser o JSON e o .diario.compactar é apagado
+        Só 1) e 3) (e a cópia dos dois ficheiros para memória) são feitos com o ficheiro trancado:
+        durante 2), a parte demorada, as alterações continuam a ser acrescentadas ao diário novo.
+        Se entretanto outra escrita tiver reescrito o JSON (gravar_tudo, ou outra compactação),
+        o resultado de 2) já não vale e é deitado fora (o que havia para juntar já lá está).
+        Se houver um crash entre a troca e apagar o .diario.compactar, ele é aplicado outra vez
+        ao ler, o que não muda nada. Os dados não mudam, por isso a versão também não.
+        Se o JSON tiver nºs repetidos não se compacta (juntar pelo nº perdia exames): o diário fica
+        e continua a ser aplicado ao ler.
+        """
+        with self._a_compactar:
+            with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco):
+                with self._trinco:
+                    if not os.path.exists(self.caminho_compactar):
+                        if not os.path.exists(self.caminho_diario):
+                            return
+                        os.replace(self.caminho_diario, self.caminho_compactar)
+                        self._registos_diario = 0
+                estado_json = _estado_ficheiro(self.caminho)
+                texto_json = _ler_texto(self.caminho)
+                texto_diario = _ler_texto(self.caminho_compactar)
+
+            exames, posicoes = _posicoes_por_num(json.loads(texto_json) if texto_json is not None else [])
+            if _ha_repetidos(posicoes):
+                self._nums_repetidos = True
+                return
+            self._reproduzir_diario(io.StringIO(texto_diario or ""), exames, posicoes)
+            # nome só desta instância: outra pode estar a compactar ao mesmo tempo
+            temporario = f"{self.caminho}.compactar.{os.getpid()}.{id(self)}.tmp"
+            try:
+                _escrever_json_temporario(temporario, [exame for exame in exames if exame is not None])
+                with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco):
+                    if _estado_ficheiro(self.caminho) == estado_json and os.path.exists(self.caminho_compactar):
+                        os.replace(temporario, self.caminho)
+                        os.remove(self.caminho_compactar)
+                        _sincronizar_pasta(self.caminho)
+            finally:
+                if os.path.exists(temporario):
+                    os.remove(temporario)
+
+    def reservar_numeros(self, quantos=1, minimo=1):
+        """
+        Reserva quantos números de exame seguidos e devolve o primeiro (nunca abaixo de minimo).
+        A sequência só anda para a frente: um nº dado nunca volta a ser dado, nem depois de o exame ser apagado.
+        Com quantos=0 não reserva nada, só garante que a sequência já passou de minimo - 1.
+        Se o exames.json.sequencia faltar (ou estiver estragado), é refeito a partir do maior nº gravado.
+        """
+        with self._trinco_sequencia, _TrincoFicheiro(self.caminho_trinco_sequencia):
+            ultimo = _ler_numero(self.caminho_sequencia)
+            if ultimo is None:
+                ultimo = self._maior_num_gravado()
+            primeiro = max(ultimo + 1, minimo)
+            _escrever_numero_atomico(self.caminho_sequencia, primeiro + quantos - 1)
+        return primeiro
+
+    def ultimo_numero(self):
+        """Último nº dado pela sequência (None se ainda não houver sequência). Não tranca nada."""
+        return _ler_numero(self.caminho_sequencia)
+
+    def _maior_num_gravado(self):
+        """Maior nº de exame gravado (JSON e diário), para refazer a sequência."""
+        # a ordem dos trincos é sempre sequência -> exames (a junção de alterações não reserva números)
+        with self._trinco_compactacao, _TrincoFicheiro(self.caminho_trinco):
+            exames = self._ler_tudo()
+        return max([_chave_num(exame.get("num")) or 0 for exame in exames], default=0)
+
+    def fechar(self):
+        if self._compactacao is not None:
+            self._compactacao.join()
+
+    def _ler_versao(self):
+        return _ler_numero(self.caminho_versao) or 0
+
+    def _avancar_versao(self):
+        """
+        Confirma que ninguém gravou desde a nossa leitura (compare-and-swap) e passa à versão seguinte.
+        A versão é gravada antes dos dados: um crash pelo meio só provoca uma junção a mais, nunca se perdem dados.
+        """
+        atual = self._ler_versao()
+        if self.versao is not None and atual != self.versao:
+            raise ConflitoVersao("O ficheiro de exames foi alterado por outra instância.")
+        _escrever_numero_atomico(self.caminho_versao, atual + 1)
+        self.versao = atual + 1
+
+    def _ler_json(self):
+        if not os.path.exists(self.caminho):
+            return []
+        with open(self.caminho, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _acrescentar_ao_diario(self, linhas):
+        with open(self.caminho_diario, "a+b") as f:
+            texto = "\n".join(linhas) + "\n"
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    texto = "\n" + texto  # a última escrita ficou cortada (crash): começar numa linha nova
+            f.write(texto.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _contar_registos(caminho):
+        if not os.path.exists(caminho):
+            return 0
+        with open(caminho, "rb") as f:
+            return sum(1 for _ in f)
+
+    @staticmethod
+    def _reproduzir_diario(linhas, exames, posicoes):
+        """
+        Aplica as linhas do diário à lista de exames (posicoes vem de _posicoes_por_num; os apagados
+        ficam a None). Linhas cortadas por um crash são ignoradas. Com nºs repetidos, gravar substitui
+        o primeiro exame com esse nº (o que a aplicação mostra) e apagar apaga todos, como na aplicação.
+        """
+        for linha in linhas:
+            linha = linha.strip()
+            if not linha:
+                continue
+            try:
+                registo = json.loads(linha)
+            except ValueError:
+                continue
+
+            if registo.get("op") == "gravar":
+                exame = registo["exame"]
+                lugares = posicoes.get(exame.get("num"))
+                if lugares:
+                    exames[lugares[0]] = exame
+                else:
+                    posicoes[exame.get("num")] = [len(exames)]
+                    exames.append(exame)
+            elif registo.get("op") == "apagar":
+                for posicao in posicoes.pop(registo.get("num"), ()):
+                    exames[posicao] = None
+
+
+def _posicoes_por_num(exames):
+    """(cópia da lista, {num: [posições na lista]}) para aplicar o diário sem juntar exames com o mesmo nº."""
+    exames = list(exames)
+    posicoes = {}
+    for posicao, exame in enumerate(exames):
+        posicoes.setdefault(exame.get("num"), []).append(posicao)
+    return exames, posicoes
+
+
+def _ha_repetidos(posicoes):
+    return any(len(lugares) > 1 for lugares in posicoes.values())
+
+
+def _ler_numero(caminho):
+    """Número guardado num ficheiro de texto (versão, sequência); None se o ficheiro não existir ou estiver estragado."""
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _escrever_numero_atomico(caminho, numero):
+    """Escreve o número num ficheiro temporário, faz fsync e troca-o pelo ficheiro final."""
+    temporario = caminho + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        f.write(str(numero))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+
+
+def _escrever_json_atomico(caminho, exames):
+    """Escreve o JSON num ficheiro temporário, faz fsync e troca-o pelo ficheiro final."""
+    temporario = caminho + ".tmp"
+    _escrever_json_temporario(temporario, exames)
+    os.replace(temporario, caminho)
+    _sincronizar_pasta(caminho)
+
+
+def _escrever_json_temporario(temporario, exames):
+    """Escreve o JSON no ficheiro temporário e faz fsync (quem chama troca-o depois pelo ficheiro final)."""
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(_ListaParaJSON(exames), f, ensure_ascii=False, indent=2) #Permite que seja escrito com caracteres especiais e uma indentenção especial
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _ler_texto(caminho):
+    """Conteúdo de um ficheiro de texto (None se não existir)."""
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _estado_ficheiro(caminho):
+    """
+    (inode, tamanho, data de modificação) do ficheiro, ou None se não existir: muda sempre que o
+    ficheiro é trocado por outro (as escritas do JSON são todas feitas com os.replace).
+    """
+    try:
+        estado = os.stat(caminho)
+    except FileNotFoundError:
+        return None
+    return estado.st_ino, estado.st_size, estado.st_mtime_ns
+
+
+def _sincronizar_pasta(caminho):
+    """fsync da pasta, para a troca de nomes ficar gravada no disco (não existe em Windows)."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(caminho)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class ArmazenamentoSQLite:
+    """
+    Guarda os exames numa base de dados SQLite (um exame por linha).
+    - modo WAL: gravar não bloqueia quem está a ler
+    - índices por num (chave primária), utente, tipo e (tipo, data_marcada, hora_marcada)
+    - gravar_alteracoes só escreve as linhas que mudaram (upsert) e apaga as removidas
+    - os números dos exames novos vêm da tabela sequencias (reservar_numeros)
+    - pode ser usado de várias threads (ex.: a gravação em segundo plano), uma operação de cada vez
+    """
+
+    def __init__(self, caminho=FICHEIRO_SQLITE):
+        self.caminho = caminho
+        self.ligacao = sqlite3.connect(caminho, check_same_thread=False)
+        self._trinco = threading.RLock()
+        self.ligacao.execute("PRAGMA journal_mode=WAL")
+        self.ligacao.execute("PRAGMA synchronous=NORMAL")
+        with self.ligacao:
+            self.ligacao.execute(
+                "CREATE TABLE IF NOT EXISTS exames ("
+                " num INTEGER PRIMARY KEY,"
+                " paciente TEXT, utente TEXT, nascimento TEXT, tipo TEXT,"
+                " data_registo TEXT, data_marcada TEXT, hora_marcada TEXT,"
+                " resultado TEXT, dias_espera INTEGER)"
+            )
+            self.ligacao.execute("CREATE INDEX IF NOT EXISTS idx_exames_utente ON exames (utente)")
+            self.ligacao.execute("CREATE INDEX IF NOT EXISTS idx_exames_tipo ON exames (tipo)")
+            self.ligacao.execute(
+                "CREATE INDEX IF NOT EXISTS idx_exames_slot ON exames (tipo, data_marcada, hora_marcada)"
+            )
+            self.ligacao.execute(
+                "CREATE TABLE IF NOT EXISTS sequencias (nome TEXT PRIMARY KEY, valor INTEGER NOT NULL)"
+            )
+
+        colunas = ", ".join(CAMPOS_EXAME)
+        marcadores = ", ".join("?" for _ in CAMPOS_EXAME)
+        atualizacoes = ", ".join(f"{c} = excluded.{c}" for c in CAMPOS_EXAME if c != "num")
+        self._sql_ler = f"SELECT {colunas} FROM exames ORDER BY num"
+        self._sql_upsert = (
+            f"INSERT INTO exames ({colunas}) VALUES ({marcadores}) "
+            f"ON CONFLICT (num) DO UPDATE SET {atualizacoes}"
+        )
+
+    def ler(self):
+        with self._trinco:
+            cursor = self.ligacao.execute(self._sql_ler)
+            return _para_registos(dict(zip(CAMPOS_EXAME, linha)) for linha in cursor)
+
+    def gravar_tudo(self, exames):
+        """
+        Deixa a tabela igual à lista: grava todos os exames e apaga os que já não existem.
+        Devolve o nº de exames que ficaram na tabela. Se algum nº não puder ser a chave da tabela
+        (repetido ou não inteiro), lança ErroArmazenamento com esses nºs e não grava nada.
+        """
+        self.verificar_numeros(exames)
+        with self._trinco, self.ligacao:
+            self.ligacao.executemany(self._sql_upsert, (self._linha(e) for e in exames))
+            self.ligacao.execute("CREATE TEMP TABLE IF NOT EXISTS nums_atuais (num INTEGER PRIMARY KEY)")
+            self.ligacao.execute("DELETE FROM nums_atuais")
+            self.ligacao.executemany(
+                "INSERT OR IGNORE INTO nums_atuais (num) VALUES (?)", ((e.get("num"),) for e in exames)
+            )
+            self.ligacao.execute("DELETE FROM exames WHERE num NOT IN (SELECT num FROM nums_atuais)")
+            return self.ligacao.execute("SELECT COUNT(*) FROM exames").fetchone()[0]
+
+    @staticmethod
+    def verificar_numeros(exames):
+        """
+        Lança ErroArmazenamento se algum exame tiver um nº que não pode ser a chave da tabela: repetido
+        (a segunda linha substituía a primeira) ou que não seja um inteiro (o SQLite recusava-o, ou dava-lhe
+        outro nº, no caso de não ter nº). A mensagem diz quais são.
+        """
+        vistos = set()
+        repetidos = {}
+        invalidos = []
+        for exame in exames:
+            num = exame.get("num")
+            if type(num) is int:
+                chave = num
+            elif type(num) is str and num.strip().isascii() and num.strip().isdigit():
+                chave = int(num)
+            else:
+                invalidos.append(num)
+                continue
+            if chave in vistos:
+                repetidos[chave] = None
+            vistos.add(chave)
+
+        if not repetidos and not invalidos:
+            return
+        problemas = []
+        if repetidos:
+            problemas.append("nºs repetidos: " + _lista_curta(list(repetidos)))
+        if invalidos:
+            problemas.append("nºs que não são inteiros: " + _lista_curta([repr(num) for num in invalidos]))
+        raise ErroArmazenamento(
+            "Não é possível gravar os exames na base de dados SQLite (" + "; ".join(problemas) + "). "
+            "Corrija esses nºs no ficheiro de exames."
+        )
+
+    def gravar_alteracoes(self, exames, alterados, removidos):
+        """Grava só os exames alterados/novos e apaga os removidos (custo proporcional às alterações)."""
+        with self._trinco, self.ligacao:
+            self.ligacao.executemany(self._sql_upsert, (self._linha(e) for e in alterados))
+            self.ligacao.executemany("DELETE FROM exames WHERE num = ?", ((e.get("num"),) for e in removidos))
+
+    def reservar_numeros(self, quantos=1, minimo=1):
+        """
+        Reserva quantos números de exame seguidos e devolve o primeiro (como no ArmazenamentoJSON).
+        A transação começa com BEGIN IMMEDIATE: outra instância que esteja a reservar espera por esta.
+        A sequência nunca fica abaixo do maior nº da tabela (refaz-se sozinha se faltar ou ficar para trás).
+        """
+        with self._trinco:
+            self.ligacao.execute("BEGIN IMMEDIATE")
+            try:
+                linha = self.ligacao.execute("SELECT valor FROM sequencias WHERE nome = 'exames'").fetchone()
+                maior_gravado = self.ligacao.execute("SELECT COALESCE(MAX(num), 0) FROM exames").fetchone()[0]
+                ultimo = max(linha[0] if linha else 0, maior_gravado)
+                primeiro = max(ultimo + 1, minimo)
+                self.ligacao.execute(
+                    "INSERT INTO sequencias (nome, valor) VALUES ('exames', ?) "
+                    "ON CONFLICT (nome) DO UPDATE SET valor = excluded.valor",
+                    (primeiro + quantos - 1,),
+                )
+            except BaseException:
+                self.ligacao.rollback()
+                raise
+            self.ligacao.commit()
+            return primeiro
+
+    def ultimo_numero(self):
+        """Último nº dado pela sequência (None se ainda não houver sequência)."""
+        with self._trinco:
+            linha = self.ligacao.execute("SELECT valor FROM sequencias WHERE nome = 'exames'").fetchone()
+        return linha[0] if linha else None
+
+    def fechar(self):
+        with self._trinco:
+            self.ligacao.close()
+
+    @staticmethod
+    def _linha(exame):
+        return tuple(exame.get(campo) for campo in CAMPOS_EXAME)
+
+
+def _lista_curta(valores, maximo=10):
+    """Os primeiros valores separados por vírgulas (e quantos faltam, se forem mais do que maximo)."""
+    texto = ", ".join(str(valor) for valor in valores[:maximo])
+    if len(valores) > maximo:
+        texto = texto + f" e mais {len(valores) - maximo}"
+    return texto
+
+
+def criar_armazenamento(tipo=None):
+    """
+    Cria o armazenamento indicado (ou o de ARMAZENAMENTO): "json" ou "sqlite".
+    Na primeira vez que se usa o SQLite, se ainda houver um exames.json, os dados são migrados.
+    """
+    if tipo is None:
+        tipo = ARMAZENAMENTO
+
+    if tipo == "json":
+        return ArmazenamentoJSON(FICHEIRO_EXAMES, diario=DIARIO_JSON)
+    if tipo == "sqlite":
+        base_nova = not os.path.exists(FICHEIRO_SQLITE)
+        armazenamento = ArmazenamentoSQLite(FICHEIRO_SQLITE)
+        if base_nova and os.path.exists(FICHEIRO_EXAMES):
+            try:
+                migrar_json_para_sqlite(FICHEIRO_EXAMES, armazenamento)
+            except ErroArmazenamento:
+                # a base de dados fica por criar: da próxima vez volta a tentar-se a migração
+                armazenamento.fechar()
+                for sufixo in ("", "-wal", "-shm"):
+                    try:
+                        os.remove(FICHEIRO_SQLITE + sufixo)
+                    except FileNotFoundError:
+                        pass
+                raise
+        return armazenamento
+    raise ValueError(f"Tipo de armazenamento desconhecido: {tipo}")
+
+
+def obter_armazenamento():
+    """Devolve o armazenamento em uso (criado na primeira chamada)."""
+    global _armazenamento
+    if _armazenamento is None:
+        _armazenamento = criar_armazenamento()
+    return _armazenamento
+
+
+_armazenamento = None
+
+
+def migrar_json_para_sqlite(ficheiro_json=FICHEIRO_EXAMES, destino=FICHEIRO_SQLITE):
+    """
+    Copia todos os exames de um ficheiro JSON para uma base de dados SQLite (caminho ou ArmazenamentoSQLite).
+    Devolve o nº de exames que ficaram na base de dados. O ficheiro JSON não é alterado.
+    Com nºs repetidos ou que não sejam inteiros lança ErroArmazenamento (com esses nºs) antes de gravar
+    o que quer que seja: na tabela cada nº é a chave de uma linha, e senão perdiam-se exames.
+    """
+    origem = ArmazenamentoJSON(ficheiro_json)
+    exames = origem.ler()
+    ultimo = origem.ultimo_numero() or 0   # os números já dados (e apagados) também não voltam a ser dados
+    ArmazenamentoSQLite.verificar_numeros(exames)
+
+    armazenamento = destino if isinstance(destino, ArmazenamentoSQLite) else ArmazenamentoSQLite(destino)
+    try:
+        migrados = armazenamento.gravar_tudo(exames)
+        armazenamento.reservar_numeros(0, ultimo + 1)
+    except sqlite3.Error as e:
+        raise ErroArmazenamento(f"Erro ao migrar os exames para SQLite: {e}") from e
+    finally:
+        if armazenamento is not destino:
+            armazenamento.fechar()
+    return migrados
+
+# =================== EXPORTAÇÃO ===================
+
+# Colunas do CSV exportado, pela ordem em que aparecem no ficheiro
+COLUNAS_CSV = [
+    "num", "paciente", "utente", "nascimento", "tipo",
+    "data_registo", "data_marcada", "hora_marcada",
+    "dias_espera", "resultado"
+]
+
+
+class ExportacaoCancelada(Exception):
+    """O utilizador cancelou a exportação a meio."""
+
+
+def _chave_exportacao(exame):
+    numero = _chave_num(exame.get("num", 0))
+    return numero if numero is not None else 0
+
+
+def exportar_csv_em_blocos(exames, caminho, progresso=None, cancelar=None):
+    """
+    Escreve os exames no CSV (separador ";") por ordem de nº, LINHAS_POR_BLOCO_CSV linhas de cada vez.
+    - progresso(feitos, total) é chamado depois de cada bloco
+    - cancelar é um threading.Event; se for ligado, pára e lança ExportacaoCancelada
+    O ficheiro é escrito num temporário e só no fim substitui o destino (cancelar não deixa um CSV a meio).
+    Devolve o nº de exames exportados.
+    """
+    exames_ordenados = sorted(exames, key=_chave_exportacao)
+    total = len(exames_ordenados)
+    temporario = caminho + ".tmp"
+
+    try:
+        with open(temporario, "w", newline="", encoding="utf-8", buffering=1024 * 1024) as f:
+            escritor = csv.writer(f, delimiter=";")
+            escritor.writerow(COLUNAS_CSV)
+
+            for inicio in range(0, total, LINHAS_POR_BLOCO_CSV):
+                if cancelar is not None and cancelar.is_set():
+                    raise ExportacaoCancelada()
+                bloco = exames_ordenados[inicio:inicio + LINHAS_POR_BLOCO_CSV]
+                escritor.writerows([exame.get(coluna, "") for coluna in COLUNAS_CSV] for exame in bloco)
+                if progresso is not None:
+                    progresso(inicio + len(bloco), total)
+
+        os.replace(temporario, caminho)
+    except BaseException:
+        try:
+            os.remove(temporario)
+        except OSError:
+            pass
+        raise
+
+    return total
+
+# =================== IMPORTAÇÃO ===================
+
+def ler_ficheiro_importacao(caminho):
+    """
+    Lê as linhas a importar de um ficheiro CSV (separador ";" ou ",", com cabeçalho)
+    ou JSON (lista de objetos). Devolve uma lista de dicionários.
+    Os nomes das colunas são os do exames.json: paciente, utente, nascimento, tipo (e data_registo, opcional).
+    """
+    if caminho.lower().endswith(".json"):
+        with open(caminho, "r", encoding="utf-8") as f:
+            dados = json.load(f)
+        if not isinstance(dados, list):
+            raise ValueError("O ficheiro JSON tem de conter uma lista de exames.")
+        return dados
+
+    with open(caminho, "r", newline="", encoding="utf-8-sig") as f:
+        cabecalho = f.readline()
+        separador = ";" if cabecalho.count(";") >= cabecalho.count(",") else ","
+        f.seek(0)
+        return list(csv.DictReader(f, delimiter=separador))
+
+
+def _validar_linha_importacao(linha):
+    """Devolve o motivo pelo qual a linha não pode ser importada, ou None se estiver válida."""
+    if not isinstance(linha, dict):
+        return "linha mal formada"
+    if str(linha.get("paciente") or "").strip() == "":
+        return "nome do paciente em falta"
+    if not validar_utente(str(linha.get("utente") or "").strip()):
+        return "nº de utente inválido"
+    if not validar_data(str(linha.get("nascimento") or "").strip()):
+        return "data de nascimento inválida"
+    if str(linha.get("tipo") or "").strip() not in HORAS_POR_TIPO:
+        return "tipo de exame desconhecido"
+    data_registo = str(linha.get("data_registo") or "").strip()
+    if data_registo != "" and not validar_data(data_registo):
+        return "data de registo inválida"
+    return None
+
+
+def importar_exames(exames, linhas, indice=None, reservar_numeros=None):
+    """
+    Importa de uma vez uma lista de linhas (dicionários) para a lista de exames.
+    - valida cada linha (validar_utente, validar_data, tipo conhecido); as inválidas são rejeitadas
+    - dá os números de exame de uma só vez: um bloco reservado com reservar_numeros(quantos), se for dado
+      (a sequência do armazenamento), senão a seguir ao maior que já existe
+    - marca cada tipo de uma vez: o dia de procura só avança (as vagas anteriores já estão cheias)
+      e no fim há um único replaneamento por tipo
+    Não grava nada: quem chama grava uma vez no fim (os alterados).
+    Devolve (novos, alterados, rejeitados), em que rejeitados é uma lista de (nº da linha, motivo).
+    """
+    if indice is None:
+        indice = IndiceOcupacao(exames)
+
+    rejeitados = []
+    validas = []
+    for posicao, linha in enumerate(linhas, start=1):
+        motivo = _validar_linha_importacao(linha)
+        if motivo is None:
+            validas.append(linha)
+        else:
+            rejeitados.append((posicao, motivo))
+
+    if reservar_numeros is None:
+        numero = proximo_numero(exames)
+    elif validas:
+        numero = reservar_numeros(len(validas))
+    hoje_str = data_hoje()
+    inicio_marcacao = dia_inicial_marcacao()
+    procurar_desde = {}   # tipo -> dia a partir do qual ainda pode haver vagas
+
+    novos = []
+    for linha in validas:
+        tipo = str(linha.get("tipo")).strip()
+        dia, hora = primeira_marcacao_livre(exames, tipo, procurar_desde.get(tipo, inicio_marcacao), indice=indice)
+        procurar_desde[tipo] = dia
+        estado, dias_espera = calcular_estado_exame(dia)
+
+        novo_exame = Exame.de_dict({
+            "num": numero,
+            "paciente": str(linha.get("paciente")).strip(),
+            "utente": str(linha.get("utente")).strip(),
+            "nascimento": str(linha.get("nascimento")).strip(),
+            "tipo": tipo,
+            "data_registo": str(linha.get("data_registo") or "").strip() or hoje_str,
+            "data_marcada": _texto_data(dia.toordinal()),
+            "hora_marcada": hora,
+            "resultado": estado,
+            "dias_espera": dias_espera
+        })
+        numero = numero + 1
+
+        exames.append(novo_exame)
+        indice.adicionar(novo_exame)
+        novos.append(novo_exame)
+
+    alterados = list(novos)
+    ja_alterados = {id(exame) for exame in novos}
+    for exame in replanear_tipos(exames, list(procurar_desde), indice=indice):
+        if id(exame) not in ja_alterados:
+            ja_alterados.add(id(exame))
+            alterados.append(exame)
+
+    return novos, alterados, rejeitados
+
+# =================== GRAVAÇÃO EM SEGUNDO PLANO ===================
+
+def _copia_para_gravar(exame):
+    """Dicionário com o exame como está agora (para ser gravado noutra thread)."""
+    return exame.para_dict() if type(exame) is Exame else dict(exame)
+
+
+class GravacaoDiferida:
+    """
+    Junta as alterações por gravar e grava-as de uma só vez numa thread (modos "agrupada" e "intervalo"
+    de MODO_GRAVACAO): uma rajada de alterações seguidas dá uma só gravação.
+
+    gravar(alterados, removidos) é quem grava de facto; nunca corre em duas threads ao mesmo tempo.
+    Recebe cópias (dicionários) e não os próprios exames: marcar() copia-os na thread de quem os alterou,
+    por isso a gravação nunca apanha um exame a meio de ser alterado. Um exame alterado várias vezes é
+    gravado uma só vez, com a última cópia.
+
+    Se gravar() lançar ConflitoVersao, as alterações ficam por gravar e a thread pára (conflito = True)
+    até o dono dos exames juntar as versões (substituir). Com outro erro, fica a mensagem em erro e volta
+    a tentar-se INTERVALO_GRAVACAO segundos depois.
+    """
+
+    def __init__(self, gravar, modo="agrupada", espera=ESPERA_GRAVACAO, espera_maxima=ESPERA_MAXIMA_GRAVACAO,
+                 intervalo=INTERVALO_GRAVACAO):
+        if modo not in ("agrupada", "intervalo"):
+            raise ValueError(f"Modo de gravação diferida desconhecido: {modo}")
+        self._gravar = gravar
+        self.modo = modo
+        self.espera = espera
+        self.espera_maxima = espera_maxima
+        self.intervalo = intervalo
+        self._condicao = threading.Condition()
+        self._alterados = {}      # id(exame) -> (exame, cópia para gravar)
+        self._removidos = {}
+        self._primeira = None     # time.monotonic() da primeira alteração por gravar
+        self._ultima = None       # e da última
+        self._nao_antes = 0.0     # depois de um erro, não se volta a tentar antes disto
+        self._a_gravar = False
+        self._parar = False
+        self.conflito = False
+        self.erro = None          # mensagem do erro da última gravação (None se correu bem)
+        self.gravado_em = None    # datetime da última gravação que correu bem
+        self._thread = threading.Thread(target=self._correr, name="gravacao", daemon=True)
+        self._thread.start()
+
+    def marcar(self, alterados, removidos=()):
+        """
+        Junta estas alterações às que estão por gravar (não espera pela gravação). Os exames são copiados
+        já, como estão agora: chama-se na thread que os altera, logo a seguir a alterá-los.
+        """
+        alterados = [(exame, _copia_para_gravar(exame)) for exame in alterados]
+        removidos = [(exame, _copia_para_gravar(exame)) for exame in removidos]
+        with self._condicao:
+            for exame, copia in alterados:
+                self._alterados[id(exame)] = (exame, copia)
+            for exame, copia in removidos:
+                self._alterados.pop(id(exame), None)
+                self._removidos[id(exame)] = (exame, copia)
+            if self._alterados or self._removidos:
+                agora = time.monotonic()
+                if self._primeira is None:
+                    self._primeira = agora
+                self._ultima = agora
+                self._condicao.notify_all()
+
+    def estado(self):
+        """(nº de exames por gravar, se está a gravar, datetime da última gravação, mensagem do último erro)."""
+        with self._condicao:
+            return len(self._alterados) + len(self._removidos), self._a_gravar, self.gravado_em, self.erro
+
+    def esvaziar(self):
+        """
+        Grava já, na thread de quem chama, o que estiver por gravar (depois de esperar pela gravação que
+        esteja a decorrer). Lança o erro da gravação, se falhar (ConflitoVersao incluído).
+        """
+        with self._condicao:
+            while self._a_gravar:
+                self._condicao.wait()
+            if not (self._alterados or self._removidos):
+                return
+            erro = self._gravar_pendentes()
+        if erro is not None:
+            raise erro
+
+    def substituir(self, gravar):
+        """
+        Corre gravar() (ex.: gravar a lista completa, ou juntar com outra instância e gravar) em vez de
+        gravar o que está por gravar, que fica coberto por ela: se correr bem, nada fica por gravar;
+        se falhar, fica tudo como estava. Espera pela gravação que esteja a decorrer.
+        """
+        with self._condicao:
+            while self._a_gravar:
+                self._condicao.wait()
+            self._a_gravar = True
+        erro = None
+        try:
+            gravar()
+        except Exception as e:
+            erro = e
+            raise
+        finally:
+            with self._condicao:
+                self._a_gravar = False
+                if erro is None:
+                    self._alterados, self._removidos = {}, {}
+                    self._primeira = self._ultima = None
+                    self.conflito = False
+                    self.erro = None
+                    self.gravado_em = datetime.now()
+                else:
+                    self.erro = str(erro)
+                self._condicao.notify_all()
+
+    def fechar(self):
+        """Grava o que estiver por gravar e pára a thread (se a gravação falhar, lança o erro e não pára)."""
+        self.esvaziar()
+        with self._condicao:
+            self._parar = True
+            self._condicao.notify_all()
+        self._thread.join()
+
+    def _prazo(self):
+        """Quando gravar (em time.monotonic()), ou None se não houver nada por gravar ou houver um conflito."""
+        if self._primeira is None or self.conflito:
+            return None
+        if self.modo == "intervalo":
+            prazo = self._primeira + self.intervalo
+        else:
+            prazo = min(self._ultima + self.espera, self._primeira + self.espera_maxima)
+        return max(prazo, self._nao_antes)
+
+    def _correr(self):
+        with self._condicao:
+            while not self._parar:
+                prazo = None if self._a_gravar else self._prazo()
+                if prazo is None:
+                    self._condicao.wait()
+                    continue
+                falta = prazo - time.monotonic()
+                if falta > 0:
+                    self._condicao.wait(falta)
+                else:
+                    self._gravar_pendentes()
+
+    def _gravar_pendentes(self):
+        """
+        Grava o que está por gravar e devolve o erro (None se correu bem). Chama-se com a condição
+        trancada; é largada durante a gravação, para se poderem marcar alterações entretanto.
+        """
+        alterados = list(self._alterados.values())
+        removidos = list(self._removidos.values())
+        self._alterados, self._removidos = {}, {}
+        self._primeira = self._ultima = None
+        self._a_gravar = True
+        self._condicao.release()
+        erro = None
+        try:
+            self._gravar([copia for _, copia in alterados], [copia for _, copia in removidos])
+        except Exception as e:    # a thread não pode morrer: as alterações voltam a ficar por gravar
+            erro = e
+        finally:
+            self._condicao.acquire()
+            self._a_gravar = False
+            self._condicao.notify_all()
+
+        if erro is None:
+            self.erro = None
+            self.gravado_em = datetime.now()
+            return None
+
+        # voltam a ficar por gravar (sem desfazer o que foi marcado entretanto)
+        for par in alterados:
+            if id(par[0]) not in self._removidos:
+                self._alterados.setdefault(id(par[0]), par)
+        for par in removidos:
+            self._removidos[id(par[0])] = par
+        agora = time.monotonic()
+        if self._primeira is None:
+            self._primeira = self._ultima = agora
+        if isinstance(erro, ConflitoVersao):
+            self.conflito = True
+        else:
+            self.erro = str(erro)
+            self._nao_antes = agora + self.intervalo
+        return erro
+
+# =================== SERVIÇO ===================
+
+# Campos que contam para juntar alterações de duas instâncias (estado e dias de espera
+# são recalculados a partir da data, não são alterações de ninguém)
+CAMPOS_FUSAO = [campo for campo in CAMPOS_EXAME if campo not in ("resultado", "dias_espera")]
+
+
+class ServicoExames:
+    """
+    As operações do gestor de exames, sem interface: registar, atualizar, apagar, pesquisar,
+    replanear, exportar e importar. Mantém a lista de exames e os índices (ocupação, pesquisa e ordem)
+    sempre de acordo e grava cada alteração no armazenamento.
+    Os erros são lançados como exceções: ErroValidacao, ExameNaoEncontrado e ErroArmazenamento.
+    Se a gravação falhar, a alteração fica feita em memória (pode gravar-se tudo depois com gravar()).
+
+    Com modo_gravacao "agrupada" ou "intervalo" (ver MODO_GRAVACAO), as alterações são gravadas numa thread
+    (GravacaoDiferida) e as operações não esperam por isso; antes de sair chama-se fechar().
+
+    Com um armazenamento com versões (o JSON), guarda-se como estava cada exame na última leitura/gravação
+    (a "base"). Se outra instância tiver gravado entretanto (ConflitoVersao), juntam-se as alterações
+    das duas por nº de exame, replaneiam-se só os tipos afetados e grava-se o resultado.
+    """
+
+    def __init__(self, armazenamento=None, carregar=True, modo_gravacao=None):
+        if modo_gravacao is None:
+            modo_gravacao = MODO_GRAVACAO
+        if modo_gravacao not in MODOS_GRAVACAO:
+            raise ValueError(f"Modo de gravação desconhecido: {modo_gravacao}")
+        self.armazenamento = armazenamento if armazenamento is not None else obter_armazenamento()
+        self.exames = []
+        self.indice = IndiceOcupacao()
+        self.indice_pesquisa = IndicePesquisa()
+        self.indice_ordem = IndiceOrdem()
+        self._colunas = None   # ColunasExames, criadas na primeira vez que são pedidas (colunas())
+        self._com_versoes = hasattr(self.armazenamento, "fundir_e_gravar")
+        self._com_sequencia = hasattr(self.armazenamento, "reservar_numeros")
+        self._numero_reservado = None   # nº já reservado para o próximo exame (proximo_numero)
+        self._maior_num = 0             # maior nº em memória ou reservado: a sequência nunca fica atrás dele
+        self._base = {}      # num -> assinatura do exame na última leitura/gravação (só com versões)
+        self._dia_indexado = _HOJE.ordinal   # dia de hoje quando os estados foram indexados
+        self._gravacao = None                # GravacaoDiferida (None com gravação imediata)
+        if modo_gravacao != "imediata":
+            self._gravacao = GravacaoDiferida(self._gravar_em_segundo_plano, modo_gravacao)
+        if carregar:
+            self.recarregar()
+
+    # ---------- DADOS ----------
+
+    def recarregar(self):
+        """
+        Volta a ler os exames do armazenamento (lança ErroArmazenamento e não mexe nos dados se falhar).
+        Com gravação diferida, grava primeiro o que estiver por gravar.
+        """
+        self.gravar_pendentes()
+        self.definir_exames(ler_dados(self.armazenamento))
+
+    def definir_exames(self, exames):
+        """Passa a usar esta lista de exames (reconstrói os índices)."""
+        self.exames = exames
+        self._dia_indexado = _HOJE.virar()
+        atualizar_estados(exames)    # só mexe nos que não são Exame ou não têm data marcada válida
+        self.indice.reconstruir(exames)
+        self._maior_num = self.indice.maior_num()
+        self.indice_pesquisa.reconstruir(exames)
+        self.indice_ordem.reconstruir(exames)
+        self._colunas = None
+        self._base = self._assinaturas(exames) if self._com_versoes else {}
+
+    def gravar(self):
+        """Grava a lista completa de exames (e, com ela, o que estivesse por gravar)."""
+        if self._gravacao is not None:
+            self._gravacao.substituir(self._gravar_tudo)
+        else:
+            self._gravar_tudo()
+
+    def fechar(self):
+        """
+        Com gravação diferida: grava o que estiver por gravar e pára a thread da gravação (chamar antes
+        de sair). Se a gravação falhar lança ErroArmazenamento e continua tudo como estava.
+        """
+        if self._gravacao is not None:
+            self.gravar_pendentes()
+            self._gravacao.fechar()
+
+    def gravar_pendentes(self):
+        """
+        Com gravação diferida: grava já o que estiver por gravar (juntando as versões se outra instância
+        tiver gravado entretanto). Lança ErroArmazenamento se falhar.
+        """
+        if self._gravacao is None:
+            return
+        try:
+            self._gravacao.esvaziar()
+        except ConflitoVersao:
+            self._gravacao.substituir(self._fundir_e_gravar)
+
+    def estado_gravacao(self):
+        """
+        (nº de exames por gravar, se está a gravar, datetime da última gravação, mensagem do último erro).
+        Com gravação imediata é sempre (0, False, None, None).
+        """
+        if self._gravacao is None:
+            return 0, False, None, None
+        return self._gravacao.estado()
+
+    def verificar_gravacao(self):
+        """
+        Com gravação diferida, se a thread parou por um conflito (outra instância gravou entretanto),
+        junta as versões e grava, nesta thread (a dona dos exames). Chamar de tempos a tempos: a interface
+        fá-lo ao mostrar o estado da gravação. Lança ErroArmazenamento se falhar.
+        """
+        if self._gravacao is not None and self._gravacao.conflito:
+            self._gravacao.substituir(self._fundir_e_gravar)
+
+    def _gravar_tudo(self):
+        try:
+            gravar_dados(self.exames, self.armazenamento)
+        except ConflitoVersao:
+            self._fundir_e_gravar()
+            return
+        if self._com_versoes:
+            self._base = self._assinaturas(self.exames)
+
+    def obter(self, num):
+        """Devolve o exame com este número (lança ExameNaoEncontrado se não existir)."""
+        encontrados = self._exames_com_num(num)
+        if not encontrados:
+            raise ExameNaoEncontrado("Exame não encontrado.")
+        return encontrados[0]
+
+    def _exames_com_num(self, num):
+        """Exames com este número, pelo índice de ocupação; só se percorre a lista se o nº não for inteiro."""
+        encontrados = self.indice.exames_com_num(num)
+        if encontrados is None:
+            num_str = str(num)
+            encontrados = [exame for exame in self.exames if str(exame.get("num")) == num_str]
+        return encontrados
+
+    def existe(self, num):
+        try:
+            self.obter(num)
+            return True
+        except ExameNaoEncontrado:
+            return False
+
+    def proximo_numero(self):
+        """
+        O nº que o próximo exame criado vai ter (botão Novo). Fica reservado para esta instância,
+        por isso outra instância que crie exames entretanto não o pode usar.
+        """
+        if self._numero_reservado is None:
+            self._numero_reservado = self._reservar_numeros()
+        return self._numero_reservado
+
+    def _reservar_numeros(self, quantos=1, minimo=1):
+        """Primeiro de quantos números novos seguidos, da sequência do armazenamento."""
+        minimo = max(minimo, self._maior_num + 1)
+        if self._com_sequencia:
+            try:
+                primeiro = self.armazenamento.reservar_numeros(quantos, minimo)
+            except (OSError, sqlite3.Error) as e:
+                raise ErroArmazenamento(f"Erro ao reservar números de exame: {e}") from e
+        else:
+            primeiro = max(proximo_numero(self.exames), minimo)   # armazenamento sem sequência: a seguir ao maior
+        self._maior_num = max(self._maior_num, primeiro + quantos - 1)
+        return primeiro
+
+    def colunas(self):
+        """
+        ColunasExames com os exames todos (para as estatísticas). São criadas da primeira vez
+        e depois mantidas a par das alterações, como os índices.
+        """
+        if self._colunas is None:
+            self._colunas = ColunasExames(self.exames)
+        return self._colunas
+
+    def contagens(self):
+        """(total, aprovados, pendentes)"""
+        aprovados = 0
+        pendentes = 0
+        for exame in self.exames:
+            estado = exame.get("resultado", "")
+            if estado == "Pendente":
+                pendentes = pendentes + 1
+            elif estado == "Aprovado":
+                aprovados = aprovados + 1
+        return len(self.exames), aprovados, pendentes
+
+    # ---------- REGISTAR / ATUALIZAR / APAGAR ----------
+
+    @staticmethod
+    def validar(paciente, utente, nascimento, tipo):
+        """Lança ErroValidacao (com a mensagem para o utilizador) se os dados não forem válidos."""
+        if paciente == "":
+            raise ErroValidacao("Indique o nome do paciente.")
+        if not validar_utente(utente):
+            raise ErroValidacao("Nº de utente inválido. Deve ter 9 a 11 dígitos.")
+        if not validar_data(nascimento):
+            raise ErroValidacao("Data de nascimento inválida. Use o formato dd-mm-yyyy.")
+        if tipo not in HORAS_POR_TIPO:
+            raise ErroValidacao("Tipo de exame desconhecido.")
+
+    def guardar(self, paciente, utente, nascimento, tipo, data_registo=None, num=None):
+        """
+        Como o botão Guardar: se já existir um exame com este número atualiza-o, senão regista um novo.
+        Devolve (exame, novo), em que novo diz se o exame foi criado.
+        """
+        if num is not None and str(num).strip() != "" and self.existe(num):
+            return self.atualizar(num, paciente, utente, nascimento, tipo, data_registo), False
+        if num is not None and str(num).strip() == "":
+            num = None
+        return self.criar(paciente, utente, nascimento, tipo, data_registo, num), True
+
+    def criar(self, paciente, utente, nascimento, tipo, data_registo=None, num=None):
+        """Regista um exame novo, marca-o na primeira vaga livre e replaneia o tipo. Devolve o exame."""
+        paciente, utente, nascimento, tipo = paciente.strip(), utente.strip(), nascimento.strip(), tipo.strip()
+        self.validar(paciente, utente, nascimento, tipo)
+        if num is None:
+            numero = self.proximo_numero()
+        else:
+            try:
+                numero = int(num)
+            except (TypeError, ValueError):
+                raise ErroValidacao("Nº de exame inválido. Deve ser um número inteiro positivo.") from None
+            if numero < 1:
+                raise ErroValidacao("Nº de exame inválido. Deve ser um número inteiro positivo.")
+            if self.existe(numero):
+                raise ErroValidacao(f"Já existe um exame com o nº {numero}.")
+        if numero == self._numero_reservado:
+            self._numero_reservado = None
+        else:
+            self._reservar_numeros(0, numero + 1)   # um nº escolhido à mão: a sequência passa à frente dele
+
+        dia, hora = primeira_marcacao_livre(self.exames, tipo, dia_inicial_marcacao(), indice=self.indice)
+        estado, dias_espera = calcular_estado_exame(dia)
+
+        novo_exame = Exame.de_dict({
+            "num": numero,
+            "paciente": paciente,
+            "utente": utente,
+            "nascimento": nascimento,
+            "tipo": tipo,
+            "data_registo": data_registo if data_registo else data_hoje(),
+            "data_marcada": _texto_data(dia.toordinal()),
+            "hora_marcada": hora,
+            "resultado": estado,
+            "dias_espera": dias_espera
+        })
+
+        self.exames.append(novo_exame)
+        self.indice.adicionar(novo_exame)
+
+        alterados = [novo_exame]
+        alterados += replanear_pendentes_por_tipo(self.exames, tipo, indice=self.indice)
+
+        self._gravar_alteracoes(alterados)
+        return novo_exame
+
+    def atualizar(self, num, paciente, utente, nascimento, tipo, data_registo=None):
+        """Altera os dados de um exame, volta a marcá-lo e replaneia o(s) tipo(s). Devolve o exame."""
+        exame = self.obter(num)
+        paciente, utente, nascimento, tipo = paciente.strip(), utente.strip(), nascimento.strip(), tipo.strip()
+        self.validar(paciente, utente, nascimento, tipo)
+
+        numero = exame.get("num")
+        tipo_antigo = exame.get("tipo", "")
+
+        dia, hora = primeira_marcacao_livre(
+            self.exames, tipo, dia_inicial_marcacao(), ignorar_num=numero, indice=self.indice
+        )
+        estado, dias_espera = calcular_estado_exame(dia)
+
+        exame["paciente"] = paciente
+        exame["utente"] = utente
+        exame["nascimento"] = nascimento
+        exame["tipo"] = tipo
+        if data_registo is not None:
+            exame["data_registo"] = data_registo
+        exame["data_marcada"] = _texto_data(dia.toordinal())
+        exame["hora_marcada"] = hora
+        exame["resultado"] = estado
+        exame["dias_espera"] = dias_espera
+        self.indice.atualizar(exame)
+
+        alterados = [exame]
+        if tipo_antigo != "" and tipo_antigo != tipo:
+            alterados += replanear_pendentes_por_tipo(self.exames, tipo_antigo, indice=self.indice)
+
+        alterados += replanear_pendentes_por_tipo(self.exames, tipo, indice=self.indice)
+
+        self._gravar_alteracoes(alterados)
+        return exame
+
+    def apagar(self, nums):
+        """
+        Apaga os exames com estes números e replaneia os tipos afetados.
+        Devolve os exames removidos (lança ExameNaoEncontrado se nenhum existir).
+        """
+        removidos = []
+        for num_str in dict.fromkeys(str(num) for num in nums):
+            removidos += self._exames_com_num(num_str)
+
+        if not removidos:
+            raise ExameNaoEncontrado("Não foi possível encontrar os exames selecionados.")
+
+        ids_removidos = {id(exame) for exame in removidos}
+        for exame in removidos:
+            self.indice.remover(exame)
+        # a mesma lista: quem a tem (ex.: a pesquisa em direto) vê a alteração
+        self.exames[:] = [exame for exame in self.exames if id(exame) not in ids_removidos]
+
+        tipos_unicos = []
+        for exame in removidos:
+            tipo = exame.get("tipo", "")
+            if tipo != "" and tipo not in tipos_unicos:
+                tipos_unicos.append(tipo)
+
+        alterados = replanear_tipos(self.exames, tipos_unicos, indice=self.indice)
+        self._gravar_alteracoes(alterados, removidos)
+        return removidos
+
+    # ---------- AGENDAMENTO ----------
+
+    def replanear(self, tipos=None, processos=None):
+        """
+        Replaneia os exames futuros dos tipos indicados (ou de todos). Devolve os exames alterados.
+        Com muitos exames, os tipos são calculados em paralelo (ver replanear_tipos).
+        """
+        if tipos is None:
+            tipos = TIPOS_EXAME
+        alterados = replanear_tipos(self.exames, tipos, indice=self.indice, processos=processos)
+        self._gravar_alteracoes(alterados)
+        return alterados
+
+    def atualizar_estados(self):
+        """
+        Põe os estados em dia (chamado antes de cada listagem). O estado e os dias de espera são
+        calculados quando se leem, por isso só há trabalho se o dia mudou desde a última vez (virar_dia).
+        Devolve os exames que mudaram de estado.
+        """
+        return self.virar_dia()
+
+    def virar_dia(self):
+        """
+        Mudança de dia (agendada para a meia-noite, mas pode ser chamada a qualquer momento):
+        passa o dia de hoje guardado para o do relógio e reindexa só os exames que mudaram de estado,
+        os marcados entre o dia anterior e o novo (dados pelo índice de ordenação, sem percorrer a lista).
+        Devolve esses exames.
+        """
+        anterior = self._dia_indexado
+        hoje = _HOJE.virar()
+        if hoje == anterior:
+            return []
+        self._dia_indexado = hoje
+        # para a frente: os de (anterior, hoje] passam a Aprovado; se o relógio recuar, o contrário
+        mudaram = [exame for exame in self.indice_ordem.exames_entre_dias(min(anterior, hoje) + 1, max(anterior, hoje))
+                   if type(exame) is Exame and exame.ordinal_marcada is not None]
+        # exames que não calculam o estado sozinhos (dicionários, datas fora do formato): uma passagem por dia
+        mudaram += atualizar_estados(self.exames)
+        for exame in mudaram:
+            self._reindexar(exame)
+        return mudaram
+
+    # ---------- PESQUISA ----------
+
+    def filtrar(self, termo, coluna=None, decrescente=False):
+        """
+        Exames em que o termo aparece (nome, tipo, nº de utente ou estado), por data e hora
+        (ou pela coluna indicada, ex.: "paciente").
+        Não mexe nos exames, por isso pode ser chamado noutra thread.
+        """
+        termo = termo.strip().lower()
+        if termo == "":
+            exames = self.exames
+        else:
+            exames = self.indice_pesquisa.pesquisar(termo)
+        return self.indice_ordem.ordenar(exames, coluna, decrescente)
+
+    def pesquisar(self, termo="", coluna=None, decrescente=False):
+        """Atualiza os estados e devolve os exames que correspondem ao termo, por data e hora (ou pela coluna)."""
+        self.atualizar_estados()
+        return self.filtrar(termo, coluna, decrescente)
+
+    def ordenar(self, exames, coluna=None, decrescente=False):
+        """Volta a ordenar um resultado (ex.: clique no cabeçalho de uma coluna), com as chaves já guardadas."""
+        return self.indice_ordem.ordenar(exames, coluna, decrescente)
+
+    # ---------- EXPORTAR / IMPORTAR ----------
+
+    @medir("exportar_csv", registos=lambda exportados, *args, **kwargs: exportados)
+    def exportar_csv(self, caminho, exames=None, progresso=None, cancelar=None):
+        """Exporta para CSV (todos os exames ou só os indicados). Devolve o nº de exames exportados."""
+        if exames is None:
+            exames = self.exames
+        try:
+            return exportar_csv_em_blocos(list(exames), caminho, progresso, cancelar)
+        except OSError as e:
+            raise ErroArmazenamento(f"Erro ao exportar CSV: {e}") from e
+
+    def importar(self, linhas):
+        """Importa uma lista de linhas de uma vez. Devolve (novos, rejeitados)."""
+        novos, alterados, rejeitados = importar_exames(
+            self.exames, linhas, indice=self.indice, reservar_numeros=self._reservar_numeros
+        )
+        if novos:
+            self._gravar_alteracoes(alterados)
+        return novos, rejeitados
+
+    def importar_ficheiro(self, caminho):
+        """Importa um ficheiro CSV ou JSON. Devolve (novos, rejeitados)."""
+        try:
+            linhas = ler_ficheiro_importacao(caminho)
+        except (OSError, ValueError, csv.Error) as e:
+            raise ErroArmazenamento(f"Erro ao ler o ficheiro a importar: {e}") from e
+        return self.importar(linhas)
+
+    # ---------- INTERNO ----------
+
+    def _gravar_alteracoes(self, alterados, removidos=()):
+        """Passa as alterações para os índices de pesquisa e de ordenação e grava-as."""
+        for exame in removidos:
+            self._desindexar(exame)
+        for exame in alterados:
+            self._reindexar(exame)
+        if self._gravacao is not None:
+            self._gravacao.marcar(alterados, removidos)
+            self.verificar_gravacao()
+            return
+        try:
+            self._escrever(self.exames, alterados, removidos)
+        except ConflitoVersao:
+            self._fundir_e_gravar()
+
+    def _gravar_em_segundo_plano(self, alterados, removidos):
+        # corre na thread da gravação, com cópias dos exames (GravacaoDiferida.marcar), e a base passa a
+        # ter as assinaturas dessas cópias. Só um armazenamento que reescreve tudo (JSON sem diário) lê a
+        # lista, e numa cópia dela: um exame que esteja a ser alterado volta a ser gravado na vez seguinte
+        self._escrever(list(self.exames), alterados, removidos)
+
+    def _escrever(self, exames, alterados, removidos):
+        """Grava as alterações e passa-as para a base (lança ErroArmazenamento, ou ConflitoVersao)."""
+        gravar_alteracoes(exames, alterados, removidos, self.armazenamento)
+        if self._com_versoes:
+            for exame in removidos:
+                self._base.pop(exame.get("num"), None)
+            for exame in alterados:
+                self._base[exame.get("num")] = self._assinatura(exame)
+
+    def _reindexar(self, exame):
+        """O exame é novo ou mudou: atualiza-o nos índices de pesquisa e de ordenação (e nas colunas)."""
+        self.indice_pesquisa.atualizar(exame)
+        self.indice_ordem.atualizar(exame)
+        if self._colunas is not None:
+            self._colunas.atualizar(exame)
+
+    def _desindexar(self, exame):
+        self.indice_pesquisa.remover(exame)
+        self.indice_ordem.remover(exame)
+        if self._colunas is not None:
+            self._colunas.remover(exame)
+
+    # ---------- VÁRIAS INSTÂNCIAS ----------
+
+    def _fundir_e_gravar(self):
+        """
+        Outra instância gravou depois de nós: com o ficheiro trancado, lê o que lá está, junta com as nossas
+        alterações, replaneia só os tipos afetados e grava o resultado.
+        """
+        def fundir(deles):
+            for tipo in self._fundir(deles):
+                for exame in replanear_pendentes_por_tipo(self.exames, tipo, indice=self.indice):
+                    self._reindexar(exame)
+            return self.exames
+
+        try:
+            self.armazenamento.fundir_e_gravar(fundir)
+        except (json.JSONDecodeError, OSError) as e:
+            raise ErroArmazenamento(f"Erro ao gravar os dados: {e}") from e
+        self._base = self._assinaturas(self.exames)
+        # os exames renumerados (ou trazidos) na junção podem ter números acima da sequência: ela passa à frente
+        self._maior_num = max(self._maior_num, self.indice.maior_num())
+        if self._com_sequencia:
+            self._reservar_numeros(0, self._maior_num + 1)
+
+    def _fundir(self, deles):
+        """
+        Junta (por nº de exame) os exames do ficheiro com os nossos, tendo a base como referência:
+        - só um dos lados mudou o exame: fica essa versão
+        - os dois mudaram: campo a campo, fica o valor do lado que o mudou (nos campos mudados pelos dois, o nosso)
+        - um dos lados apagou: fica apagado
+        - os dois criaram exames com o mesmo nº: o nosso passa para um nº novo
+        Muda self.exames e os índices no sítio. Devolve os tipos cuja agenda mudou.
+        """
+        base = self._base
+        deles_por_num = {}
+        for exame in deles:
+            if exame.get("num") is not None:
+                deles_por_num[exame.get("num")] = exame
+        tipos_afetados = set()
+
+        # os dois lados criaram o mesmo nº: o nosso exame fica com um nº novo
+        # (e acima dos que a sequência já deu: podem estar reservados por outra instância que ainda não gravou)
+        ja_dados = (self.armazenamento.ultimo_numero() or 0) if self._com_sequencia else 0
+        maior = max([_chave_num(e.get("num")) or 0 for e in self.exames] +
+                    [_chave_num(num) or 0 for num in deles_por_num] + [ja_dados])
+        for exame in self.exames:
+            num = exame.get("num")
+            if num is not None and num not in base and num in deles_por_num:
+                if self._assinatura(deles_por_num[num]) != self._assinatura(exame):
+                    maior = maior + 1
+                    exame["num"] = maior
+                    self.indice.atualizar(exame)
+                    self._reindexar(exame)
+                    tipos_afetados.add(exame.get("tipo", ""))
+
+        nossos = {}
+        for exame in self.exames:
+            if exame.get("num") is not None:
+                nossos.setdefault(exame.get("num"), exame)
+
+        # exames que existem do lado deles
+        for num, exame_deles in deles_por_num.items():
+            assinatura_deles = self._assinatura(exame_deles)
+            assinatura_base = base.get(num)
+            nosso = nossos.get(num)
+
+            if nosso is None:
+                if assinatura_base is None:
+                    novo = exame_deles.copy()      # criado por eles
+                    self.exames.append(novo)
+                    self.indice.adicionar(novo)
+                    self._reindexar(novo)
+                    tipos_afetados.add(novo.get("tipo", ""))
+                continue                           # senão: apagado por nós
+
+            if assinatura_deles == assinatura_base or assinatura_deles == self._assinatura(nosso):
+                continue                           # eles não mudaram nada (ou mudaram para o mesmo)
+
+            tipos_afetados.add(nosso.get("tipo", ""))   # o tipo antigo e (mais abaixo) o novo
+            assinatura_nossa = self._assinatura(nosso)
+            for posicao, campo in enumerate(CAMPOS_FUSAO):
+                if assinatura_nossa[posicao] == assinatura_base[posicao]:
+                    nosso[campo] = exame_deles.get(campo)
+            if assinatura_nossa == assinatura_base:
+                nosso["resultado"] = exame_deles.get("resultado")
+                nosso["dias_espera"] = exame_deles.get("dias_espera")
+            self.indice.atualizar(nosso)
+            self._reindexar(nosso)
+            tipos_afetados.add(nosso.get("tipo", ""))
+
+        # exames que eles apagaram (existiam na base e já não estão no ficheiro)
+        apagados = [exame for exame in self.exames
+                    if exame.get("num") in base and exame.get("num") not in deles_por_num]
+        if apagados:
+            ids_apagados = {id(exame) for exame in apagados}
+            for exame in apagados:
+                self.indice.remover(exame)
+                self._desindexar(exame)
+                tipos_afetados.add(exame.get("tipo", ""))
+            self.exames[:] = [exame for exame in self.exames if id(exame) not in ids_apagados]
+
+        tipos_afetados.discard("")
+        return tipos_afetados
+
+    @staticmethod
+    def _assinatura(exame):
+        return tuple(exame.get(campo) for campo in CAMPOS_FUSAO)
+
+    @classmethod
+    def _assinaturas(cls, exames):
+        return {exame.get("num"): cls._assinatura(exame) for exame in exames if exame.get("num") is not None}
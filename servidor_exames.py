@@ -0,0 +1,489 @@
+"""
+Gestor de Exames Clínicos - servidor HTTP/JSON local.
+
+Vários postos de atendimento marcam exames na mesma agenda: em vez de cada posto ler e reescrever
+o exames.json (e apagar as marcações dos outros), há um único servidor que é dono dos dados e do
+motor de agendamento, e os postos falam com ele por HTTP.
+
+    python servidor_exames.py [--host 127.0.0.1] [--porta 8765] [--armazenamento sqlite|json]
+
+Pedidos (corpo e respostas em JSON):
+    GET    /exames[?termo=...]      lista de exames (por data e hora)
+    GET    /exames/<num>            um exame
+    POST   /exames                  regista um exame {paciente, utente, nascimento, tipo[, data_registo]}
+    PUT    /exames/<num>            altera um exame (só os campos enviados)
+    DELETE /exames/<num>            apaga um exame
+    POST   /replanear               replaneia {"tipo": ...} (ou todos os tipos, sem corpo)
+    GET    /estatisticas            total, aprovados e pendentes
+    GET    /analise[?dias=28]       espera por tipo, ocupação e antecedência (precisa do NumPy)
+    GET    /medicoes                chamadas, durações e registos das operações medidas
+                                    (só conta com o servidor arrancado com --medicoes)
+
+Concorrência (asyncio, uma só thread para os dados):
+    - as marcações são feitas em série por tipo de exame (um asyncio.Lock por tipo): duas marcações
+      do mesmo tipo nunca ficam com a mesma vaga, e marcações de tipos diferentes não esperam umas pelas outras
+    - a gravação corre numa thread própria (sempre a mesma, pela ordem das alterações);
+      a resposta só é enviada depois de a alteração estar gravada
+    - as leituras usam uma cópia (snapshot) dos exames, feita depois da última alteração
+      e partilhada por todas as leituras até à alteração seguinte
+    - à meia-noite um temporizador do ciclo de eventos muda o dia (estados e dias de espera)
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from nucleo_exames import (
+    CAMPOS_EXAME, FICHEIRO_EXAMES, TIPOS_EXAME, ArmazenamentoJSON,
+    ErroExames, ErroValidacao, ExameNaoEncontrado, ErroArmazenamento, ServicoExames,
+    criar_armazenamento, ler_dados, gravar_alteracoes, proximo_numero, segundos_ate_meia_noite,
+    ativar_medicoes, obter_medicoes,
+)
+from analise_exames import DIAS_OCUPACAO, analisar
+
+# =================== CONFIGURAÇÃO ===================
+
+HOST = "127.0.0.1"
+PORTA = 8765
+
+# Tamanho máximo do corpo de um pedido (bytes)
+MAXIMO_CORPO = 1024 * 1024
+
+# Números de exame reservados de cada vez na sequência do armazenamento
+NUMEROS_POR_RESERVA = 100
+
+ESTADOS_HTTP = {
+    200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+# =================== GRAVAÇÃO ===================
+
+class _AlteracoesPorGravar:
+    """
+    Armazenamento dado ao ServicoExames dentro do servidor: não grava logo, guarda uma cópia
+    das alterações (as linhas podem mudar a seguir) para o servidor as gravar na thread de gravação.
+    Os números dos exames novos vêm de blocos de NUMEROS_POR_RESERVA reservados no armazenamento
+    verdadeiro. O bloco seguinte é pedido à thread de gravação com await (garantir_numeros), antes
+    de se marcar: o ciclo de eventos nunca fica à espera de uma gravação para dar um número.
+    """
+
+    def __init__(self, gravador):
+        self.pendentes = []
+        self._gravador = gravador
+        self._bloco = (1, 0)   # (próximo nº, último nº) do bloco reservado
+        self._trinco_reserva = asyncio.Lock()
+
+    def ler(self):
+        return []
+
+    def gravar_tudo(self, exames):
+        raise ErroArmazenamento("O servidor só grava alterações.")
+
+    def gravar_alteracoes(self, exames, alterados, removidos):
+        self.pendentes.append(([dict(e) for e in alterados], [dict(e) for e in removidos]))
+
+    def reservar_numeros(self, quantos=1, minimo=1):
+        proximo, ultimo = self._bloco
+        proximo = max(proximo, minimo)
+        if proximo + quantos - 1 > ultimo:
+            # só acontece se não se chamou garantir_numeros antes (espera pela thread de gravação)
+            tamanho = max(quantos, NUMEROS_POR_RESERVA)
+            proximo = self._gravador.reservar_numeros(tamanho, minimo)
+            ultimo = proximo + tamanho - 1
+        self._bloco = (proximo + quantos, ultimo)
+        return proximo
+
+    def comecar_em(self, numero):
+        """Os blocos reservados nunca começam abaixo deste nº (o seguinte ao maior exame lido)."""
+        self._bloco = (max(self._bloco[0], numero), self._bloco[1])
+
+    async def garantir_numeros(self):
+        """Se o bloco reservado acabou, reserva o seguinte na thread de gravação (sem parar o ciclo de eventos)."""
+        while self._bloco[0] > self._bloco[1]:
+            async with self._trinco_reserva:   # marcações de tipos diferentes esperam pelo mesmo bloco
+                if self._bloco[0] > self._bloco[1]:
+                    proximo = await self._gravador.reservar_numeros_async(NUMEROS_POR_RESERVA, self._bloco[0])
+                    self._bloco = (proximo, proximo + NUMEROS_POR_RESERVA - 1)
+
+    def retirar(self):
+        pendentes = self.pendentes
+        self.pendentes = []
+        return pendentes
+
+    def devolver(self, pendentes):
+        """Volta a pôr à frente alterações que não se conseguiram gravar (tentam-se na gravação seguinte)."""
+        self.pendentes = pendentes + self.pendentes
+
+    def fechar(self):
+        pass
+
+
+class _Gravador:
+    """
+    Dono do armazenamento verdadeiro: tudo (criar, ler, gravar, fechar) corre na mesma thread,
+    uma operação de cada vez, pela ordem em que foi pedido (o SQLite exige a mesma thread).
+    """
+
+    def __init__(self, tipo_armazenamento):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gravador")
+        self._tipo = tipo_armazenamento
+        self._armazenamento = None
+
+    async def executar(self, funcao, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, funcao, *args)
+
+    def abrir_e_ler(self):
+        if self._tipo == "json":
+            # cada alteração vai para o diário (não se reescreve o ficheiro todo a cada marcação)
+            self._armazenamento = ArmazenamentoJSON(FICHEIRO_EXAMES, diario=True)
+        else:
+            self._armazenamento = criar_armazenamento(self._tipo)
+        return ler_dados(self._armazenamento)
+
+    def gravar(self, pendentes):
+        for alterados, removidos in pendentes:
+            gravar_alteracoes(None, alterados, removidos, self._armazenamento)
+
+    async def reservar_numeros_async(self, quantos, minimo):
+        """Reserva na sequência do armazenamento, na thread de gravação, sem parar o ciclo de eventos."""
+        return await self.executar(self._armazenamento.reservar_numeros, quantos, minimo)
+
+    def reservar_numeros(self, quantos, minimo):
+        """Reserva na sequência do armazenamento, na thread de gravação (espera pelo resultado)."""
+        return self._executor.submit(self._armazenamento.reservar_numeros, quantos, minimo).result()
+
+    def fechar(self):
+        if self._armazenamento is not None:
+            self._armazenamento.fechar()
+
+    def terminar(self):
+        self._executor.shutdown(wait=True)
+
+# =================== SERVIDOR ===================
+
+class ErroPedido(Exception):
+    """Pedido HTTP inválido (responde-se com o código indicado)."""
+
+    def __init__(self, estado, mensagem):
+        super().__init__(mensagem)
+        self.estado = estado
+
+
+class ServidorExames:
+    """Servidor HTTP/1.1 (com keep-alive) sobre asyncio, por cima de um ServicoExames."""
+
+    def __init__(self, tipo_armazenamento="sqlite"):
+        self._gravador = _Gravador(tipo_armazenamento)
+        self._por_gravar = _AlteracoesPorGravar(self._gravador)
+        self.servico = ServicoExames(self._por_gravar, carregar=False)
+        self._trincos = {tipo: asyncio.Lock() for tipo in TIPOS_EXAME}
+        self._trinco_outros = asyncio.Lock()   # tipos desconhecidos (a validação recusa-os lá dentro)
+        self._versao = 0            # aumenta a cada alteração
+        self._snapshot = None       # (versão, JSON da lista completa)
+        self._servidor = None
+        self._mudanca_dia = None    # temporizador da próxima meia-noite
+
+    async def iniciar(self, host=HOST, porta=PORTA):
+        self.servico.definir_exames(await self._gravador.executar(self._gravador.abrir_e_ler))
+        self._por_gravar.comecar_em(proximo_numero(self.servico.exames))
+        self.servico.atualizar_estados()
+        self._agendar_mudanca_dia()
+        self._servidor = await asyncio.start_server(self._atender, host, porta)
+        return self._servidor.sockets[0].getsockname()[1]
+
+    async def parar(self):
+        if self._mudanca_dia is not None:
+            self._mudanca_dia.cancel()
+        if self._servidor is not None:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+        try:
+            await self._gravar()   # alterações que ficaram por gravar depois de um erro
+        except ErroExames as e:
+            print(f"Erro ao gravar as últimas alterações: {e}", file=sys.stderr)
+        await self._gravador.executar(self._gravador.fechar)
+        self._gravador.terminar()
+
+    def _agendar_mudanca_dia(self):
+        # um segundo depois da meia-noite, para o relógio já estar no dia novo
+        self._mudanca_dia = asyncio.get_running_loop().call_later(segundos_ate_meia_noite() + 1, self._mudar_dia)
+
+    def _mudar_dia(self):
+        """Meia-noite: os exames de hoje passam a Aprovado e o snapshot deixa de valer (os dias de espera mudaram)."""
+        self.servico.virar_dia()
+        self._versao = self._versao + 1
+        self._agendar_mudanca_dia()
+
+    # ---------- LIGAÇÕES ----------
+
+    async def _atender(self, leitor, escritor):
+        """Atende os pedidos de uma ligação, um a seguir ao outro, até o cliente fechar."""
+        try:
+            while True:
+                try:
+                    pedido = await self._ler_pedido(leitor)
+                except ErroPedido as e:
+                    await self._responder(escritor, e.estado, {"erro": str(e)}, manter=False)
+                    break
+                if pedido is None:
+                    break
+
+                metodo, caminho, corpo, manter = pedido
+                estado, resposta = await self._tratar(metodo, caminho, corpo)
+                await self._responder(escritor, estado, resposta, manter)
+                if not manter:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            escritor.close()
+
+    async def _ler_pedido(self, leitor):
+        linha = await leitor.readline()
+        if not linha:
+            return None
+        partes = linha.decode("latin-1").split()
+        if len(partes) != 3:
+            raise ErroPedido(400, "Pedido mal formado.")
+        metodo, caminho, versao = partes
+
+        cabecalhos = {}
+        while True:
+            linha = await leitor.readline()
+            if linha in (b"\r\n", b"\n", b""):
+                break
+            nome, _, valor = linha.decode("latin-1").partition(":")
+            cabecalhos[nome.strip().lower()] = valor.strip()
+
+        try:
+            tamanho = int(cabecalhos.get("content-length", "0"))
+        except ValueError:
+            raise ErroPedido(400, "Content-Length inválido.")
+        if tamanho > MAXIMO_CORPO:
+            raise ErroPedido(413, "Pedido demasiado grande.")
+        corpo = await leitor.readexactly(tamanho) if tamanho > 0 else b""
+
+        ligacao = cabecalhos.get("connection", "").lower()
+        manter = ligacao != "close" if versao == "HTTP/1.1" else ligacao == "keep-alive"
+        return metodo, caminho, corpo, manter
+
+    async def _responder(self, escritor, estado, resposta, manter):
+        corpo = resposta if isinstance(resposta, bytes) else json.dumps(resposta, ensure_ascii=False).encode("utf-8")
+        cabecalho = (
+            f"HTTP/1.1 {estado} {ESTADOS_HTTP.get(estado, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(corpo)}\r\n"
+            f"Connection: {'keep-alive' if manter else 'close'}\r\n\r\n"
+        )
+        escritor.write(cabecalho.encode("latin-1") + corpo)
+        await escritor.drain()
+
+    # ---------- PEDIDOS ----------
+
+    async def _tratar(self, metodo, caminho, corpo):
+        """Encaminha o pedido. Devolve (estado HTTP, resposta)."""
+        url = urlsplit(caminho)
+        partes = [p for p in url.path.split("/") if p]
+        try:
+            if partes == ["exames"] and metodo == "GET":
+                termo = parse_qs(url.query).get("termo", [""])[0]
+                return 200, await self._listar(termo)
+            if partes == ["exames"] and metodo == "POST":
+                return 201, await self._criar(self._ler_json(corpo))
+            if len(partes) == 2 and partes[0] == "exames":
+                num = partes[1]
+                if metodo == "GET":
+                    return 200, self._copia(self.servico.obter(num))
+                if metodo == "PUT":
+                    return 200, await self._atualizar(num, self._ler_json(corpo))
+                if metodo == "DELETE":
+                    return 200, await self._apagar(num)
+            if partes == ["replanear"] and metodo == "POST":
+                dados = self._ler_json(corpo) if corpo else {}
+                return 200, await self._replanear(dados.get("tipo"))
+            if partes == ["estatisticas"] and metodo == "GET":
+                total, aprovados, pendentes = self.servico.contagens()
+                return 200, {"total": total, "aprovados": aprovados, "pendentes": pendentes}
+            if partes == ["analise"] and metodo == "GET":
+                try:
+                    dias = int(parse_qs(url.query).get("dias", [DIAS_OCUPACAO])[0])
+                except ValueError:
+                    raise ErroPedido(400, "Nº de dias inválido.")
+                if not 0 < dias <= 3660:
+                    raise ErroPedido(400, "Nº de dias inválido.")
+                return 200, analisar(self.servico, dias=dias)
+            if partes == ["medicoes"] and metodo == "GET":
+                return 200, obter_medicoes()
+            if partes and partes[0] in ("exames", "replanear", "estatisticas", "analise", "medicoes"):
+                return 405, {"erro": "Método não permitido."}
+            return 404, {"erro": "Caminho desconhecido."}
+        except ErroPedido as e:
+            return e.estado, {"erro": str(e)}
+        except ErroValidacao as e:
+            return 400, {"erro": str(e)}
+        except ExameNaoEncontrado as e:
+            return 404, {"erro": str(e)}
+        except ErroExames as e:
+            return 500, {"erro": str(e)}
+
+    async def _listar(self, termo):
+        """
+        Lista completa: vem do snapshot (já em JSON, pronto a enviar).
+        Com termo: o índice de pesquisa dá logo os poucos exames que interessam, e copiam-se só esses.
+        """
+        if termo.strip() == "":
+            return await self._obter_snapshot()
+        return [self._copia(e) for e in self.servico.filtrar(termo)]
+
+    async def _obter_snapshot(self):
+        """JSON da lista completa na versão atual (feito uma vez por versão e partilhado pelas leituras)."""
+        if self._snapshot is not None and self._snapshot[0] == self._versao:
+            return self._snapshot[1]
+
+        versao = self._versao
+        exames = [self._copia(e) for e in self.servico.filtrar("")]
+        # a conversão para JSON (a parte cara) corre fora do ciclo de eventos, sobre a cópia
+        texto = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: json.dumps(exames, ensure_ascii=False).encode("utf-8")
+        )
+        if self._snapshot is None or self._snapshot[0] < versao:
+            self._snapshot = (versao, texto)
+        return texto
+
+    async def _criar(self, dados):
+        tipo = str(dados.get("tipo", ""))
+        if "num" in dados:
+            # o nº é sempre o seguinte da sequência: um nº escolhido podia ser o de outro exame
+            raise ErroPedido(400, "O nº do exame é dado pelo servidor (não se envia no POST).")
+        async with self._trinco_de(tipo):
+            await self._por_gravar.garantir_numeros()   # depois disto não há await até o exame ter nº
+            exame = self.servico.criar(
+                str(dados.get("paciente", "")), str(dados.get("utente", "")),
+                str(dados.get("nascimento", "")), tipo, dados.get("data_registo")
+            )
+            resposta = self._copia(exame)
+            await self._gravar()
+        return resposta
+
+    async def _atualizar(self, num, dados):
+        exame = self.servico.obter(num)
+        tipos = {exame.get("tipo", ""), str(dados.get("tipo", exame.get("tipo", "")))}
+        async with self._trincos_de(tipos):
+            exame = self.servico.obter(num)   # pode ter mudado enquanto se esperava
+            exame = self.servico.atualizar(
+                num,
+                str(dados.get("paciente", exame.get("paciente", ""))),
+                str(dados.get("utente", exame.get("utente", ""))),
+                str(dados.get("nascimento", exame.get("nascimento", ""))),
+                str(dados.get("tipo", exame.get("tipo", ""))),
+                dados.get("data_registo"),
+            )
+            resposta = self._copia(exame)
+            await self._gravar()
+        return resposta
+
+    async def _apagar(self, num):
+        tipo = self.servico.obter(num).get("tipo", "")
+        async with self._trinco_de(tipo):
+            removidos = self.servico.apagar([num])
+            await self._gravar()
+        return {"removidos": [e.get("num") for e in removidos]}
+
+    async def _replanear(self, tipo):
+        tipos = [tipo] if tipo else list(TIPOS_EXAME)
+        async with self._trincos_de(tipos):
+            alterados = self.servico.replanear(tipos)
+            await self._gravar()
+        return {"alterados": len(alterados)}
+
+    # ---------- AUXILIARES ----------
+
+    async def _gravar(self):
+        """
+        Grava as alterações feitas até agora (na thread de gravação) e espera que fiquem gravadas.
+        Se a gravação falhar, as alterações voltam para a fila (já estão nos exames em memória, que é o
+        que as leituras mostram) e são gravadas outra vez com a alteração seguinte; o erro segue para o cliente.
+        """
+        self._versao = self._versao + 1
+        pendentes = self._por_gravar.retirar()
+        if pendentes:
+            try:
+                await self._gravador.executar(self._gravador.gravar, pendentes)
+            except BaseException:
+                self._por_gravar.devolver(pendentes)
+                raise
+
+    def _trinco_de(self, tipo):
+        return self._trincos.get(tipo, self._trinco_outros)
+
+    def _trincos_de(self, tipos):
+        trincos = []
+        for tipo in sorted(set(tipos)):
+            trinco = self._trinco_de(tipo)
+            if trinco not in trincos:
+                trincos.append(trinco)
+        return _VariosTrincos(trincos)
+
+    @staticmethod
+    def _copia(exame):
+        return {campo: exame.get(campo) for campo in CAMPOS_EXAME}
+
+    @staticmethod
+    def _ler_json(corpo):
+        try:
+            dados = json.loads(corpo.decode("utf-8"))
+        except ValueError:
+            raise ErroPedido(400, "O corpo do pedido não é JSON válido.")
+        if not isinstance(dados, dict):
+            raise ErroPedido(400, "O corpo do pedido tem de ser um objeto JSON.")
+        return dados
+
+
+class _VariosTrincos:
+    """Vários asyncio.Lock de uma vez, sempre pela mesma ordem (para não haver bloqueios mútuos)."""
+
+    def __init__(self, trincos):
+        self._trincos = trincos
+
+    async def __aenter__(self):
+        for trinco in self._trincos:
+            await trinco.acquire()
+
+    async def __aexit__(self, *erro):
+        for trinco in reversed(self._trincos):
+            trinco.release()
+
+# =================== EXECUTAR ===================
+
+async def servir(host, porta, tipo_armazenamento):
+    servidor = ServidorExames(tipo_armazenamento)
+    porta = await servidor.iniciar(host, porta)
+    print(f"A servir em http://{host}:{porta} (Ctrl+C para parar)", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await servidor.parar()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor HTTP/JSON do Gestor de Exames Clínicos")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--porta", type=int, default=PORTA)
+    parser.add_argument("--armazenamento", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--medicoes", action="store_true", help="medir as operações (GET /medicoes)")
+    args = parser.parse_args(argv)
+    if args.medicoes:
+        ativar_medicoes()
+    try:
+        asyncio.run(servir(args.host, args.porta, args.armazenamento))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+Gestor de Exames Clínicos - simulador de capacidade ("e se...?").
+
+Antes de mudar as HORAS_POR_TIPO ou a CAPACIDADE_DIARIA, mostra o que acontece à espera:
+cada cenário (horas e capacidades alternativas) volta a marcar uma sequência de pedidos de exame
+com o motor de agendamento real (primeira_marcacao_livre, sobre um IndiceOcupacao com as horas e
+capacidades do cenário), a partir de uma cópia das marcações que já existem. No fim mostra a
+distribuição dos dias de espera (média, percentis, máximo e por semanas) de cada cenário.
+
+Os pedidos podem ser:
+    - históricos: os exames registados nos últimos N dias, pela ordem de registo
+    - sintéticos: chegadas aleatórias (processo de Poisson) com o ritmo por tipo dos últimos N dias,
+      ou com --por-dia pedidos por dia repartidos pelos tipos
+
+Os cenários correm em paralelo, um por processo (ProcessPoolExecutor).
+
+    python simulador_exames.py --cenarios cenarios.json [--chegadas historicas|sinteticas] [--dias 90]
+    python simulador_exames.py --cenario '{"nome": "ECG +1", "horas_por_tipo": {"ECG": ["10:00", "12:00", "14:00"]},
+                                           "capacidade_diaria": {"ECG": 3}}'
+
+Cada cenário é um objeto JSON com "nome" e, opcionalmente, "horas_por_tipo" e "capacidade_diaria"
+(só os tipos que mudam; os outros ficam como na configuração atual). O cenário "atual" entra sempre.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+from nucleo_exames import (
+    CAPACIDADE_DIARIA, FORMATO_DATA, HORAS_POR_TIPO, TIPOS_EXAME,
+    ErroExames, ErroValidacao, IndiceOcupacao,
+    criar_armazenamento, dia_de_hoje, dias_antecedencia, ler_dados, numero_do_dia, primeira_marcacao_livre,
+)
+
+# =================== CONFIGURAÇÃO ===================
+
+# Dias de pedidos simulados por omissão (e dias de histórico usados para o ritmo das chegadas sintéticas)
+DIAS_SIMULADOS = 90
+
+# Distribuição da espera por semanas: uma barra por semana até este nº (a última inclui as que passam dele)
+SEMANAS_HISTOGRAMA = 12
+
+PERCENTIS = (50, 90, 95, 99)
+
+# =================== CENÁRIOS ===================
+
+def preparar_cenario(cenario):
+    """
+    Cenário completo a partir do que muda (as horas e capacidades que não vêm no cenário ficam as atuais).
+    Lança ErroValidacao se algum tipo ficar sem horas ou sem capacidade (não havia onde marcar).
+    """
+    if not isinstance(cenario, dict):
+        raise ErroValidacao("Cada cenário tem de ser um objeto JSON.")
+    horas = dict(HORAS_POR_TIPO)
+    horas.update(cenario.get("horas_por_tipo") or {})
+    capacidades = dict(CAPACIDADE_DIARIA)
+    capacidades.update(cenario.get("capacidade_diaria") or {})
+    nome = str(cenario.get("nome", "sem nome"))
+
+    for tipo in TIPOS_EXAME:
+        horas_tipo = horas.get(tipo) or []
+        if not horas_tipo or len(set(horas_tipo)) != len(horas_tipo):
+            raise ErroValidacao(f"Cenário {nome}: o tipo {tipo} tem de ter horas, sem repetições.")
+        try:
+            capacidade = int(capacidades.get(tipo, len(horas_tipo)))
+        except (TypeError, ValueError):
+            raise ErroValidacao(f"Cenário {nome}: capacidade inválida para {tipo}.")
+        if capacidade < 1:
+            raise ErroValidacao(f"Cenário {nome}: o tipo {tipo} tem de ter capacidade diária de pelo menos 1.")
+        capacidades[tipo] = capacidade
+    return {"nome": nome, "horas_por_tipo": horas, "capacidade_diaria": capacidades}
+
+
+def cenario_atual():
+    return preparar_cenario({"nome": "atual"})
+
+# =================== PEDIDOS (CHEGADAS) ===================
+
+def chegadas_historicas(exames, inicio, dias):
+    """
+    Pedidos reais: (nº do dia de registo, tipo) dos exames registados nos dias [inicio, inicio + dias),
+    pela ordem de registo (e de nº). Devolve também esses exames, para ficarem fora da cópia da agenda.
+    """
+    registados = []
+    for exame in exames:
+        registo = numero_do_dia(exame.get("data_registo"))
+        tipo = exame.get("tipo")
+        if registo is not None and inicio <= registo < inicio + dias and tipo in HORAS_POR_TIPO:
+            registados.append((registo, _ordem_num(exame.get("num")), tipo, exame))
+    registados.sort(key=lambda pedido: pedido[:2])
+    return [(registo, tipo) for registo, _, tipo, _ in registados], [exame for *_, exame in registados]
+
+
+def ritmo_historico(exames, fim, dias):
+    """Pedidos por dia de cada tipo, em média, nos dias [fim - dias, fim)."""
+    contagens = dict.fromkeys(TIPOS_EXAME, 0)
+    for exame in exames:
+        tipo = exame.get("tipo")
+        registo = numero_do_dia(exame.get("data_registo"))
+        if tipo in contagens and registo is not None and fim - dias <= registo < fim:
+            contagens[tipo] = contagens[tipo] + 1
+    return {tipo: quantos / dias for tipo, quantos in contagens.items()}
+
+
+def chegadas_sinteticas(ritmos, inicio, dias, semente=1):
+    """
+    Pedidos aleatórios nos dias [inicio, inicio + dias): para cada tipo, um processo de Poisson
+    com ritmos[tipo] pedidos por dia. Devolve [(nº do dia de registo, tipo)] por ordem de chegada.
+    """
+    aleatorio = random.Random(semente)
+    chegadas = []
+    for tipo, ritmo in ritmos.items():
+        if ritmo <= 0:
+            continue
+        instante = aleatorio.expovariate(ritmo)
+        while instante < dias:
+            chegadas.append((instante, tipo))
+            instante = instante + aleatorio.expovariate(ritmo)
+    chegadas.sort()
+    return [(inicio + int(instante), tipo) for instante, tipo in chegadas]
+
+
+def _ordem_num(num):
+    try:
+        return (0, int(num))
+    except (TypeError, ValueError):
+        return (1, 0)
+
+# =================== SIMULAÇÃO ===================
+
+def agenda_base(exames, desde, excluir=()):
+    """
+    Cópia leve das marcações que contam para a simulação (as do dia desde em diante):
+    só o que o IndiceOcupacao precisa (nº, tipo, data e hora). Os exames em excluir ficam de fora.
+    """
+    ids_excluidos = {id(exame) for exame in excluir}
+    base = []
+    for exame in exames:
+        if id(exame) in ids_excluidos:
+            continue
+        ordinal = numero_do_dia(exame.get("data_marcada"))
+        if ordinal is not None and ordinal >= desde:
+            base.append({
+                "num": exame.get("num"), "tipo": exame.get("tipo"),
+                "data_marcada": exame.get("data_marcada"), "hora_marcada": exame.get("hora_marcada"),
+            })
+    return base
+
+
+def simular(cenario, base, chegadas):
+    """
+    Marca as chegadas, uma a uma e pela ordem, com o motor de agendamento real e as horas e capacidades
+    do cenário, por cima de uma cópia da agenda base. Devolve o resumo da espera (resumir_esperas).
+    """
+    agenda = [dict(exame) for exame in base]
+    indice = IndiceOcupacao(agenda, cenario["horas_por_tipo"], cenario["capacidade_diaria"])
+    num = max((_ordem_num(exame["num"])[1] for exame in agenda), default=0)
+
+    esperas = {}
+    for registo, tipo in chegadas:
+        dia_registo = date.fromordinal(registo)
+        dia, hora = primeira_marcacao_livre(
+            agenda, tipo, dia_registo + timedelta(days=dias_antecedencia), indice=indice
+        )
+        num = num + 1
+        exame = {"num": num, "tipo": tipo, "data_marcada": dia.strftime(FORMATO_DATA), "hora_marcada": hora}
+        agenda.append(exame)
+        indice.adicionar(exame)
+        esperas.setdefault(tipo, []).append((dia - dia_registo).days)
+    return resumir_esperas(cenario["nome"], esperas)
+
+
+def resumir_esperas(nome, esperas):
+    """
+    {"nome", "geral": {...}, "por_tipo": {tipo: {...}}}, cada um com
+    pedidos, media, p50/p90/p95/p99 (pela ordem), maximo e semanas (nº de pedidos por semana de espera).
+    """
+    todas = [dias for lista in esperas.values() for dias in lista]
+    return {
+        "nome": nome,
+        "geral": _distribuicao(todas),
+        "por_tipo": {tipo: _distribuicao(esperas[tipo]) for tipo in TIPOS_EXAME if tipo in esperas},
+    }
+
+
+def _distribuicao(dias):
+    if not dias:
+        return {"pedidos": 0}
+    ordenados = sorted(dias)
+    semanas = [0] * (SEMANAS_HISTOGRAMA + 1)
+    for valor in ordenados:
+        semanas[min(valor // 7, SEMANAS_HISTOGRAMA)] += 1
+    resumo = {"pedidos": len(ordenados), "media": round(sum(ordenados) / len(ordenados), 1)}
+    for p in PERCENTIS:
+        resumo[f"p{p}"] = ordenados[max(math.ceil(len(ordenados) * p / 100), 1) - 1]
+    resumo["maximo"] = ordenados[-1]
+    resumo["semanas"] = semanas
+    return resumo
+
+# =================== VÁRIOS CENÁRIOS EM PARALELO ===================
+
+# em cada processo: a agenda base e as chegadas, recebidas uma vez só (no arranque do processo)
+_DADOS_DO_PROCESSO = None
+
+
+def _iniciar_processo(base, chegadas):
+    global _DADOS_DO_PROCESSO
+    _DADOS_DO_PROCESSO = (base, chegadas)
+
+
+def _simular_no_processo(cenario):
+    base, chegadas = _DADOS_DO_PROCESSO
+    return simular(cenario, base, chegadas)
+
+
+def simular_cenarios(cenarios, base, chegadas, processos=None):
+    """
+    Corre cada cenário (já preparado) sobre a mesma agenda base e as mesmas chegadas.
+    Com processos > 1 (por omissão, um por CPU, até ao nº de cenários), cada cenário corre num processo;
+    a agenda e as chegadas vão para cada processo uma vez só. Devolve os resumos pela ordem dos cenários.
+    """
+    if processos is None:
+        processos = os.cpu_count() or 1
+    processos = max(1, min(processos, len(cenarios)))
+    if processos == 1:
+        return [simular(cenario, base, chegadas) for cenario in cenarios]
+    with ProcessPoolExecutor(processos, initializer=_iniciar_processo, initargs=(base, chegadas)) as executor:
+        return list(executor.map(_simular_no_processo, cenarios))
+
+# =================== SAÍDA ===================
+
+def escrever_resultados(resultados, em_json):
+    if em_json:
+        json.dump(resultados, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    colunas = ["pedidos", "media"] + [f"p{p}" for p in PERCENTIS] + ["maximo"]
+    print("\t".join(["Cenário", "Tipo"] + colunas))
+    for resultado in resultados:
+        linhas = [("(todos)", resultado["geral"])] + list(resultado["por_tipo"].items())
+        for tipo, resumo in linhas:
+            print("\t".join([resultado["nome"], tipo] + [str(resumo.get(coluna, "")) for coluna in colunas]))
+
+# =================== EXECUTAR ===================
+
+def ler_cenarios(args):
+    cenarios = []
+    if args.cenarios:
+        with open(args.cenarios, "r", encoding="utf-8") as f:
+            cenarios.extend(json.load(f))
+    for texto in args.cenario:
+        cenarios.append(json.loads(texto))
+    return [cenario_atual()] + [preparar_cenario(cenario) for cenario in cenarios]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulador de capacidade do Gestor de Exames Clínicos")
+    parser.add_argument("--armazenamento", choices=["json", "sqlite"], default=None,
+                        help="onde estão os exames (por omissão, o configurado no núcleo)")
+    parser.add_argument("--cenarios", help="ficheiro JSON com a lista de cenários")
+    parser.add_argument("--cenario", action="append", default=[], help="um cenário em JSON (pode repetir-se)")
+    parser.add_argument("--chegadas", choices=["historicas", "sinteticas"], default="sinteticas")
+    parser.add_argument("--dias", type=int, default=DIAS_SIMULADOS,
+                        help="dias de pedidos (históricos: os últimos N; sintéticos: os próximos N)")
+    parser.add_argument("--por-dia", type=float, default=None,
+                        help="sintéticas: pedidos por dia (repartidos pelos tipos); por omissão, o ritmo do histórico")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--processos", type=int, default=None, help="por omissão, um por CPU")
+    parser.add_argument("--json", action="store_true", help="escrever os resultados em JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.dias < 1:
+            raise ErroValidacao("O nº de dias tem de ser pelo menos 1.")
+        cenarios = ler_cenarios(args)
+        armazenamento = criar_armazenamento(args.armazenamento)
+        try:
+            exames = ler_dados(armazenamento)
+        finally:
+            armazenamento.fechar()
+
+        hoje = dia_de_hoje()
+        if args.chegadas == "historicas":
+            inicio = hoje - args.dias
+            chegadas, simulados = chegadas_historicas(exames, inicio, args.dias)
+        else:
+            inicio = hoje
+            if args.por_dia is not None:
+                ritmos = dict.fromkeys(TIPOS_EXAME, args.por_dia / len(TIPOS_EXAME))
+            else:
+                ritmos = ritmo_historico(exames, hoje, args.dias)
+            chegadas, simulados = chegadas_sinteticas(ritmos, inicio, args.dias, args.semente), []
+        base = agenda_base(exames, inicio + dias_antecedencia, excluir=simulados)
+        del exames
+
+        resultados = simular_cenarios(cenarios, base, chegadas, args.processos)
+    except (ErroExames, OSError, ValueError) as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 1
+
+    escrever_resultados(resultados, args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+"""
+Gestor de Exames Clínicos - testes do armazenamento (JSON e SQLite).
+
+    python -m unittest test_armazenamento        (ou: python -m pytest test_armazenamento.py)
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import nucleo_exames
+from nucleo_exames import (
+    ArmazenamentoJSON, ArmazenamentoSQLite, ConflitoVersao, ErroArmazenamento, Exame,
+    GravacaoDiferida, ServicoExames, criar_armazenamento, migrar_json_para_sqlite,
+)
+
+# =================== AUXILIARES ===================
+
+def exame(num, tipo="ECG", data_marcada="01-01-2020"):
+    return {
+        "num": num,
+        "paciente": f"Paciente {num}",
+        "utente": "123456789",
+        "nascimento": "01-01-1980",
+        "tipo": tipo,
+        "data_registo": "01-12-2019",
+        "data_marcada": data_marcada,
+        "hora_marcada": "09:00",
+        "resultado": "Aprovado",
+        "dias_espera": 0,
+    }
+
+
+class _ComPasta(unittest.TestCase):
+    """Cada teste trabalha numa pasta temporária, apagada no fim."""
+
+    def setUp(self):
+        self.pasta = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+    def caminho(self, nome):
+        return os.path.join(self.pasta, nome)
+
+    def escrever_json(self, nome, exames):
+        caminho = self.caminho(nome)
+        with open(caminho, "w", encoding="utf-8") as f:
+            json.dump(exames, f)
+        return caminho
+
+    def linhas_sqlite(self, caminho):
+        armazenamento = ArmazenamentoSQLite(caminho)
+        try:
+            return [e["num"] for e in armazenamento.ler()]
+        finally:
+            armazenamento.fechar()
+
+# =================== DIÁRIO DO JSON ===================
+
+class _Crash(Exception):
+    """O processo "morre" neste ponto (o que já está no disco fica como está)."""
+
+
+class TesteDiarioJSON(_ComPasta):
+
+    def setUp(self):
+        super().setUp()
+        self.json = self.caminho("exames.json")
+        armazenamento = ArmazenamentoJSON(self.json, diario=True)
+        armazenamento.gravar_tudo([exame(1), exame(2), exame(3)])
+        armazenamento.gravar_alteracoes(None, [dict(exame(2), paciente="Alterado"), exame(4)], [exame(3)])
+        self.armazenamento = armazenamento
+        self.esperado = [exame(1), dict(exame(2), paciente="Alterado"), exame(4)]
+
+    def tearDown(self):
+        self.armazenamento.fechar()
+        super().tearDown()
+
+    def ler(self):
+        """Os exames como os leria outra instância (ou a mesma, depois de reiniciar)."""
+        return [registo.para_dict() for registo in ArmazenamentoJSON(self.json, diario=True).ler()]
+
+    def test_le_o_json_e_o_diario(self):
+        self.assertEqual(self.ler(), self.esperado)
+        self.armazenamento.compactar()
+        self.assertFalse(os.path.exists(self.json + ".diario"))
+        self.assertEqual(self.ler(), self.esperado)
+
+    def test_crash_a_meio_da_compactacao(self):
+        def escrever_meio_json(temporario, exames):
+            with open(temporario, "w", encoding="utf-8") as f:
+                f.write('[{"num": 1, "paciente": "Pac')
+            raise _Crash()
+
+        with open(self.json, encoding="utf-8") as f:
+            antes = f.read()
+        with mock.patch.object(nucleo_exames, "_escrever_json_temporario", escrever_meio_json):
+            with self.assertRaises(_Crash):
+                self.armazenamento.compactar()
+        with open(self.json, encoding="utf-8") as f:
+            self.assertEqual(f.read(), antes)   # o JSON não foi tocado
+        self.assertTrue(os.path.exists(self.json + ".diario.compactar"))
+
+        # as alterações seguintes vão para um diário novo, aplicado depois do que ficou por compactar
+        self.armazenamento.gravar_alteracoes(None, [dict(exame(1), paciente="Depois do crash")], [])
+        self.esperado[0] = dict(exame(1), paciente="Depois do crash")
+        self.assertEqual(self.ler(), self.esperado)
+
+        self.armazenamento.compactar()   # acaba a compactação que ficou a meio
+        self.assertFalse(os.path.exists(self.json + ".diario.compactar"))
+        self.assertEqual(self.ler(), self.esperado)
+        self.armazenamento.compactar()
+        self.assertFalse(os.path.exists(self.json + ".diario"))
+        self.assertEqual(self.ler(), self.esperado)
+
+    def test_crash_depois_de_trocar_o_json(self):
+        # o JSON novo já tem o diário, mas o .diario.compactar não chegou a ser apagado: aplicá-lo outra vez
+        # não muda nada
+        remover = os.remove
+
+        def morrer_ao_apagar(caminho):
+            if caminho.endswith(".diario.compactar"):
+                raise _Crash()
+            remover(caminho)
+
+        with mock.patch.object(nucleo_exames.os, "remove", morrer_ao_apagar):
+            with self.assertRaises(_Crash):
+                self.armazenamento.compactar()
+        self.assertTrue(os.path.exists(self.json + ".diario.compactar"))
+        self.assertEqual(self.ler(), self.esperado)
+
+    def test_nums_repetidos_sobrevivem_ao_diario(self):
+        repetidos = [exame(1), exame(1, "TAC"), exame(2), exame(3)]
+        self.armazenamento.gravar_tudo(repetidos)
+        self.armazenamento.gravar_alteracoes(None, [dict(exame(2), paciente="Alterado")], [exame(3)])
+        self.assertEqual(self.ler(), [exame(1), exame(1, "TAC"), dict(exame(2), paciente="Alterado")])
+
+        # não se compacta (juntar pelo nº perdia um dos nº 1): o diário fica e continua a ser aplicado
+        self.armazenamento.compactar()
+        self.assertEqual(self.ler(), [exame(1), exame(1, "TAC"), dict(exame(2), paciente="Alterado")])
+
+# =================== VÁRIAS INSTÂNCIAS ===================
+
+class TesteVariasInstancias(_ComPasta):
+    """Duas instâncias com o mesmo exames.json: quem grava depois da outra recebe ConflitoVersao e junta."""
+
+    def setUp(self):
+        super().setUp()
+        self.json = self.caminho("exames.json")
+        ArmazenamentoJSON(self.json).gravar_tudo([exame(1), exame(2)])
+
+    def nums_pacientes(self):
+        return [(e["num"], e["paciente"]) for e in ArmazenamentoJSON(self.json, diario=True).ler()]
+
+    def _conflito(self, diario):
+        a = ArmazenamentoJSON(self.json, diario=diario)
+        b = ArmazenamentoJSON(self.json, diario=diario)
+        a.ler()
+        b.ler()
+        alterado_a = dict(exame(1), paciente="A")
+        alterado_b = dict(exame(2), paciente="B")
+        a.gravar_alteracoes([alterado_a, exame(2)], [alterado_a], [])
+        with self.assertRaises(ConflitoVersao):
+            b.gravar_alteracoes([exame(1), alterado_b], [alterado_b], [])
+        with self.assertRaises(ConflitoVersao):
+            b.gravar_tudo([exame(1), alterado_b])
+        self.assertEqual(self.nums_pacientes(), [(1, "A"), (2, "Paciente 2")])   # a escrita de b não entrou
+
+        b.ler()   # depois de ler outra vez já pode gravar
+        b.gravar_alteracoes([alterado_a, alterado_b], [alterado_b], [])
+        self.assertEqual(self.nums_pacientes(), [(1, "A"), (2, "B")])
+
+    def test_conflito_sem_diario(self):
+        self._conflito(diario=False)
+
+    def test_conflito_com_diario(self):
+        self._conflito(diario=True)
+
+    def test_servicos_juntam_as_alteracoes(self):
+        a = ServicoExames(ArmazenamentoJSON(self.json), modo_gravacao="imediata")
+        b = ServicoExames(ArmazenamentoJSON(self.json), modo_gravacao="imediata")
+        a.atualizar(1, "Alterado em A", "123456789", "01-01-1980", "ECG")
+        b.atualizar(2, "Alterado em B", "123456789", "01-01-1980", "ECG")   # conflito: junta com o de A
+        novo_a = a.criar("Novo em A", "123456789", "01-01-1980", "TAC")     # conflito outra vez
+        novo_b = b.criar("Novo em B", "123456789", "01-01-1980", "TAC")
+        self.assertNotEqual(novo_a["num"], novo_b["num"])
+
+        gravados = dict(self.nums_pacientes())
+        self.assertEqual(gravados[1], "Alterado em A")
+        self.assertEqual(gravados[2], "Alterado em B")
+        self.assertEqual(gravados[novo_a["num"]], "Novo em A")
+        self.assertEqual(gravados[novo_b["num"]], "Novo em B")
+        self.assertEqual(len(gravados), 4)
+
+# =================== NÚMEROS DOS EXAMES ===================
+
+class TesteNumerosNaoReutilizados(_ComPasta):
+    """Um nº dado a um exame não volta a ser usado, mesmo depois de apagar o exame com o maior nº."""
+
+    def _abrir(self, armazenamento):
+        servico = ServicoExames(armazenamento, modo_gravacao="imediata")
+        self.addCleanup(servico.fechar)
+        self.addCleanup(armazenamento.fechar)
+        return servico
+
+    def criar(self, servico):
+        return servico.criar("Paciente", "123456789", "01-01-1980", "ECG")["num"]
+
+    def _verificar(self, abrir):
+        servico = self._abrir(abrir())
+        self.assertEqual([self.criar(servico) for _ in range(3)], [1, 2, 3])
+        servico.apagar([3])
+        self.assertEqual(self.criar(servico), 4)
+        servico.apagar([4])
+
+        servico = self._abrir(abrir())   # outra instância, já sem o 3 e o 4 gravados
+        self.assertEqual(sorted(e["num"] for e in servico.exames), [1, 2])
+        self.assertEqual(self.criar(servico), 5)
+        servico.apagar([1, 2, 5])
+
+        servico = self._abrir(abrir())   # sem nenhum exame gravado
+        self.assertEqual(self.criar(servico), 6)
+
+    def test_json(self):
+        self._verificar(lambda: ArmazenamentoJSON(self.caminho("exames.json")))
+
+    def test_json_com_diario(self):
+        self._verificar(lambda: ArmazenamentoJSON(self.caminho("exames.json"), diario=True))
+
+    def test_sqlite(self):
+        self._verificar(lambda: ArmazenamentoSQLite(self.caminho("exames.db")))
+
+# =================== MIGRAÇÃO PARA SQLITE ===================
+
+class TesteMigracaoSQLite(_ComPasta):
+
+    def test_devolve_as_linhas_gravadas(self):
+        origem = self.escrever_json("exames.json", [exame(1), exame(2), exame("3")])
+        destino = self.caminho("exames.db")
+        self.assertEqual(migrar_json_para_sqlite(origem, destino), 3)
+        self.assertEqual(self.linhas_sqlite(destino), [1, 2, 3])
+
+    def test_nums_repetidos(self):
+        origem = self.escrever_json("exames.json", [exame(1), exame(1, "TAC"), exame(2), exame(2), exame(3)])
+        destino = self.caminho("exames.db")
+        with self.assertRaises(ErroArmazenamento) as erro:
+            migrar_json_para_sqlite(origem, destino)
+        self.assertIn("repetidos: 1, 2", str(erro.exception))
+        self.assertEqual(self.linhas_sqlite(destino), [])   # não grava nada
+
+    def test_nums_que_nao_sao_inteiros(self):
+        origem = self.escrever_json("exames.json", [exame(1), exame("A7"), exame(2.5), exame(None)])
+        destino = self.caminho("exames.db")
+        with self.assertRaises(ErroArmazenamento) as erro:
+            migrar_json_para_sqlite(origem, destino)
+        self.assertIn("'A7'", str(erro.exception))
+        self.assertIn("2.5", str(erro.exception))
+        self.assertIn("None", str(erro.exception))
+        self.assertEqual(self.linhas_sqlite(destino), [])
+
+    def test_gravar_tudo_nao_perde_exames(self):
+        armazenamento = ArmazenamentoSQLite(self.caminho("exames.db"))
+        try:
+            self.assertEqual(armazenamento.gravar_tudo([exame(1), exame(2)]), 2)
+            with self.assertRaises(ErroArmazenamento):
+                armazenamento.gravar_tudo([exame(1), exame(1), exame(3)])
+            self.assertEqual([e["num"] for e in armazenamento.ler()], [1, 2])
+        finally:
+            armazenamento.fechar()
+
+    def test_migracao_automatica_volta_a_tentar(self):
+        # criar_armazenamento("sqlite") migra o JSON na primeira vez; se falhar, a base de dados não fica criada
+        origem = self.escrever_json("exames.json", [exame(1), exame(1)])
+        destino = self.caminho("exames.db")
+        ficheiros = nucleo_exames.FICHEIRO_EXAMES, nucleo_exames.FICHEIRO_SQLITE
+        nucleo_exames.FICHEIRO_EXAMES, nucleo_exames.FICHEIRO_SQLITE = origem, destino
+        try:
+            with self.assertRaises(ErroArmazenamento):
+                criar_armazenamento("sqlite")
+            self.assertFalse(os.path.exists(destino))
+
+            self.escrever_json("exames.json", [exame(1), exame(2)])
+            armazenamento = criar_armazenamento("sqlite")
+            try:
+                self.assertEqual([e["num"] for e in armazenamento.ler()], [1, 2])
+            finally:
+                armazenamento.fechar()
+        finally:
+            nucleo_exames.FICHEIRO_EXAMES, nucleo_exames.FICHEIRO_SQLITE = ficheiros
+
+# =================== GRAVAÇÃO EM SEGUNDO PLANO ===================
+
+class TesteGravacaoDiferida(unittest.TestCase):
+    """A thread da gravação recebe cópias feitas em marcar(), nunca os exames que estão a ser alterados."""
+
+    def setUp(self):
+        self.gravados = []
+        self.falhar = 0
+        # espera longa: nestes testes só se grava com esvaziar(), na thread do teste
+        self.gravacao = GravacaoDiferida(self.gravar, "agrupada", espera=600, espera_maxima=600)
+
+    def tearDown(self):
+        self.gravacao.fechar()
+
+    def gravar(self, alterados, removidos):
+        if self.falhar:
+            self.falhar = self.falhar - 1
+            raise OSError("disco cheio")
+        self.gravados.append((alterados, removidos))
+
+    def test_grava_o_exame_como_estava_ao_marcar(self):
+        registo = Exame.de_dict(exame(1))
+        self.gravacao.marcar([registo])
+        registo["paciente"] = "Alterado sem marcar"
+        self.gravacao.esvaziar()
+
+        (alterados, removidos), = self.gravados
+        self.assertEqual(alterados, [exame(1)])
+        self.assertIsNot(alterados[0], registo)
+        self.assertEqual(removidos, [])
+
+    def test_fica_a_ultima_copia(self):
+        registo = Exame.de_dict(exame(1))
+        apagado = exame(2)
+        self.gravacao.marcar([registo, apagado])
+        registo["paciente"] = "Segunda versão"
+        self.gravacao.marcar([registo], [apagado])
+        self.gravacao.esvaziar()
+
+        (alterados, removidos), = self.gravados
+        self.assertEqual([e["paciente"] for e in alterados], ["Segunda versão"])
+        self.assertEqual(removidos, [exame(2)])
+
+    def test_depois_de_um_erro_volta_a_gravar_a_mesma_copia(self):
+        registo = Exame.de_dict(exame(1))
+        self.falhar = 1
+        self.gravacao.marcar([registo])
+        with self.assertRaises(OSError):
+            self.gravacao.esvaziar()
+        registo["paciente"] = "Alterado sem marcar"
+        self.gravacao.esvaziar()
+        self.assertEqual(self.gravados, [([exame(1)], [])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Gestor de Exames Clínicos - teste diferencial do replaneamento.
+
+O replaneamento incremental (replanear_pendentes_por_tipo com o IndiceOcupacao) tem de dar
+exatamente o mesmo que o algoritmo original (sem índice): os mesmos exames, marcados nas mesmas
+vagas, e a mesma lista de exames alterados. Cada cenário é aleatório (com semente fixa) e inclui
+vagas libertadas, datas estragadas ou fora do formato dd-mm-yyyy, horas que não existem no tipo,
+capacidades reduzidas, nºs repetidos e replaneamentos seguidos com exames apagados pelo meio.
+
+    python -m unittest test_replaneamento        (ou: python -m pytest test_replaneamento.py)
+"""
+
+import copy
+import random
+import unittest
+from datetime import date, timedelta
+
+import nucleo_exames
+from nucleo_exames import (
+    CAPACIDADE_DIARIA, FORMATO_DATA, HORAS_POR_TIPO, TIPOS_EXAME,
+    Exame, IndiceOcupacao, replanear_pendentes_por_tipo,
+)
+
+# =================== CONFIGURAÇÃO ===================
+
+CENARIOS = 400
+REPLANEAMENTOS = 2   # rondas de replaneamento (com exames apagados entre elas) em cada cenário
+
+# =================== CENÁRIOS ===================
+
+def gerar_cenario(semente):
+    """Lista de exames (dicionários) com exames passados e futuros e alguns dados estragados."""
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    dias_futuro = aleatorio.randint(3, 40)
+    exames = []
+    for num in range(1, aleatorio.randint(20, 400) + 1):
+        tipo = aleatorio.choice(TIPOS_EXAME)
+        if aleatorio.random() < 0.9:
+            dia = hoje - timedelta(days=aleatorio.randint(0, 10))
+        else:
+            dia = hoje + timedelta(days=aleatorio.randint(0, dias_futuro))
+        exames.append({
+            "num": num,
+            "paciente": f"Paciente {num}",
+            "utente": str(aleatorio.randint(100000000, 999999999)),
+            "nascimento": "01-01-1980",
+            "tipo": tipo,
+            "data_registo": (dia - timedelta(days=5)).strftime(FORMATO_DATA),
+            "data_marcada": dia.strftime(FORMATO_DATA),
+            "hora_marcada": aleatorio.choice(HORAS_POR_TIPO[tipo]),
+            "resultado": "",
+            "dias_espera": 0,
+        })
+
+    # exames apagados: vagas livres que o replaneamento volta a ocupar
+    for _ in range(min(aleatorio.randint(0, 60), len(exames) - 1)):
+        exames.pop(aleatorio.randrange(len(exames)))
+
+    for exame in exames:
+        sorteio = aleatorio.random()
+        if sorteio < 0.02:
+            exame["data_marcada"] = "lixo"
+        elif sorteio < 0.04:
+            dia = nucleo_exames._ler_data(exame["data_marcada"])
+            exame["data_marcada"] = f"{dia.day}-{dia.month}-{dia.year}"   # sem zeros à esquerda
+        elif sorteio < 0.06:
+            exame["hora_marcada"] = "23:59"
+        elif sorteio < 0.07:
+            del exame["data_marcada"]
+        elif sorteio < 0.075:
+            exame["num"] = aleatorio.choice(exames)["num"]   # nº repetido
+    aleatorio.shuffle(exames)
+    return exames
+
+# =================== TESTES ===================
+
+class TesteReplaneamentoDiferencial(unittest.TestCase):
+
+    def setUp(self):
+        self._capacidade = dict(CAPACIDADE_DIARIA)
+
+    def tearDown(self):
+        CAPACIDADE_DIARIA.clear()
+        CAPACIDADE_DIARIA.update(self._capacidade)
+
+    def _comparar(self, semente, com_exames):
+        aleatorio = random.Random(semente + 1000)
+        CAPACIDADE_DIARIA.clear()
+        CAPACIDADE_DIARIA.update(self._capacidade)
+        if semente % 3 == 0:
+            for tipo in TIPOS_EXAME:
+                CAPACIDADE_DIARIA[tipo] = max(1, self._capacidade[tipo] - aleatorio.randint(0, 2))
+
+        exames = gerar_cenario(semente)
+        if com_exames:
+            exames = [Exame.de_dict(exame) for exame in exames]
+        completo = copy.deepcopy(exames)      # algoritmo original (sem índice)
+        incremental = copy.deepcopy(exames)
+        indice = IndiceOcupacao(incremental)
+
+        for ronda in range(REPLANEAMENTOS):
+            for tipo in aleatorio.sample(TIPOS_EXAME, len(TIPOS_EXAME)):
+                alterados_completo = replanear_pendentes_por_tipo(completo, tipo)
+                alterados_incremental = replanear_pendentes_por_tipo(incremental, tipo, indice=indice)
+                contexto = f"semente {semente}, ronda {ronda}, {tipo}"
+                self.assertEqual([dict(e) for e in completo], [dict(e) for e in incremental], contexto)
+                self.assertEqual([e.get("num") for e in alterados_completo],
+                                 [e.get("num") for e in alterados_incremental], contexto)
+
+            for _ in range(aleatorio.randint(0, 10)):
+                if not completo:
+                    break
+                i = aleatorio.randrange(len(completo))
+                completo.pop(i)
+                indice.remover(incremental.pop(i))
+
+    def test_dicionarios(self):
+        for semente in range(0, CENARIOS, 2):
+            self._comparar(semente, com_exames=False)
+
+    def test_exames(self):
+        for semente in range(1, CENARIOS, 2):
+            self._comparar(semente, com_exames=True)
+
+
+if __name__ == "__main__":
+    unittest.main()